@@ -0,0 +1,9 @@
+'''
+Code shared between the audio lambda functions.
+
+Each function is still deployed as its own container, the Dockerfiles copy this
+package in next to lambda_function.py so it can be imported the same way locally
+and on lambda. Build the images from the repository root, for example:
+
+    docker build -f audio_energy/Dockerfile .
+'''
@@ -0,0 +1,107 @@
+import threading
+import time
+import numpy as np
+
+'''
+Cross request micro-batching.
+
+A model built for a fixed batch (discogs-effnet-bs64 runs 64 patches at a time)
+wastes most of every call when each request sends its own short clip. A
+MicroBatcher sits in front of the model: callers in different threads submit
+their rows, a worker collects rows from every caller for up to max_wait_ms or
+until max_batch_size rows are waiting, runs the model once on all of them and
+hands each caller back its own rows.
+
+Usage:
+    batcher = MicroBatcher(run, max_batch_size=64, max_wait_ms=5)
+    outputs = batcher.submit(rows)  # blocks until this caller's rows are done
+
+run takes an array of rows (any number) and returns one output row per input row.
+'''
+
+
+class _Request:
+    '''Rows from one caller and where to put its result'''
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    '''
+    Batches rows from concurrent submit() calls into single run() calls.
+
+    stats counts the run() calls ("batches"), rows run ("rows") and the
+    submit() calls served ("requests").
+    '''
+
+    def __init__(self, run, max_batch_size=64, max_wait_ms=5):
+        assert max_batch_size > 0, "max_batch_size must be positive"
+        assert max_wait_ms >= 0, "max_wait_ms must not be negative"
+        self.run = run
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = []
+        self.condition = threading.Condition()
+        self.worker = None
+        self.stats = {"batches": 0, "rows": 0, "requests": 0}
+
+    def submit(self, rows):
+        '''Run rows through the model with whatever else is waiting, returns their outputs'''
+        rows = np.asarray(rows)
+        if len(rows) == 0:
+            return self.run(rows)
+
+        request = _Request(rows)
+        with self.condition:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._work, daemon=True)
+                self.worker.start()
+            self.queue.append(request)
+            self.condition.notify()
+
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _take_batch(self):
+        '''Wait for rows then collect requests until the batch is full or max_wait has passed'''
+        with self.condition:
+            while not self.queue:
+                self.condition.wait()
+            deadline = time.monotonic() + self.max_wait
+            while sum(len(request.rows) for request in self.queue) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            # Take whole requests up to a full batch, a request bigger than a batch goes on its own
+            batch, size = [], 0
+            while self.queue and (not batch or size + len(self.queue[0].rows) <= self.max_batch_size):
+                request = self.queue.pop(0)
+                batch.append(request)
+                size += len(request.rows)
+            return batch
+
+    def _work(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                outputs = self.run(np.concatenate([request.rows for request in batch]))
+                self.stats["batches"] += 1
+                self.stats["rows"] += sum(len(request.rows) for request in batch)
+                self.stats["requests"] += len(batch)
+                start = 0
+                for request in batch:
+                    request.result = outputs[start:start + len(request.rows)]
+                    start += len(request.rows)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
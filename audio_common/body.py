@@ -0,0 +1,119 @@
+import os
+import binascii
+import threading
+from audio_common.timing import stage
+
+'''
+Request bodies without the extra copies.
+
+Every handler did base64.b64decode(event["body"]), which allocates the whole
+upload again next to the body string (a third bigger than the audio), and the
+pitch shift and time stretch functions then wrapped that in a BytesIO for pydub,
+which copied it once more.
+
+read_body hands the audio over as a memoryview:
+  - a raw binary body (bytes, bytearray or memoryview, which is what a caller
+    in the same process such as a local server passes) is used as it is, there
+    is no base64 step at all
+  - a base64 body (isBase64Encoded) is decoded CHUNK characters at a time into
+    a buffer that is kept for the next request on the same thread, so the only
+    allocations are one chunk at a time and growing the buffer
+
+The decoders (audio_common.decode), the mp3 and ID3 readers and the cache keys
+all take the memoryview, so the audio is not copied again before ffmpeg reads it.
+
+The view is only valid until the next read_body on the same thread, the next
+request decodes into the same memory. Anything that keeps the audio after the
+request has to copy it (bytes(view)). Buffers bigger than BODY_BUFFER_MAX bytes
+are not kept, so one huge upload does not pin its memory for the container's life.
+'''
+
+# Base64 characters decoded at a time, a multiple of 4 so every chunk decodes on its own
+CHUNK = 4 * 2**16
+BODY_BUFFER_MAX = int(os.environ.get("BODY_BUFFER_MAX", 8 * 2**20))
+RAW_TYPES = (bytes, bytearray, memoryview)
+
+
+def is_raw(body):
+    '''Whether a body is raw binary rather than a string'''
+    return isinstance(body, RAW_TYPES)
+
+
+def accepts_body(event):
+    '''Whether the body of an event can be read, raw binary or flagged as base64'''
+    return is_raw(event.get("body")) or bool(event.get("isBase64Encoded", False))
+
+
+def decoded_length(text):
+    '''Number of bytes a base64 string without whitespace decodes to'''
+    # Only the last two characters are looked at, rstrip would copy the whole body
+    padding = len(text[-2:]) - len(text[-2:].rstrip("="))
+    return len(text) * 3 // 4 - padding
+
+
+class Base64Buffer:
+    '''
+    Decodes base64 into memory kept between calls.
+
+    Usage:
+        view = buffer.decode(text)
+
+    The returned memoryview is over the buffer, the next decode overwrites it.
+    '''
+
+    def __init__(self, max_size=BODY_BUFFER_MAX):
+        self.max_size = max_size
+        self.buffer = bytearray()
+
+    def decode(self, text):
+        if isinstance(text, (bytes, bytearray)):
+            text = text.decode("ascii")
+        if "\n" in text or "\r" in text or " " in text or len(text) % 4:
+            # Wrapped or unpadded base64 cannot be split on 4 characters, decode it in one go
+            return memoryview(binascii.a2b_base64(text))
+
+        size = decoded_length(text)
+        if size > self.max_size:
+            target = bytearray(size)
+        else:
+            if len(self.buffer) < size:
+                # A new buffer rather than a resize, views of the old one may still be held
+                self.buffer = bytearray(size)
+            target = self.buffer
+
+        view = memoryview(target)
+        position = 0
+        for start in range(0, len(text), CHUNK):
+            chunk = binascii.a2b_base64(text[start:start + CHUNK])
+            view[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        return view[:position]
+
+
+# One buffer per thread, a server running handlers on several threads must not share one
+buffers = threading.local()
+
+
+def get_buffer():
+    buffer = getattr(buffers, "buffer", None)
+    if buffer is None:
+        buffer = buffers.buffer = Base64Buffer()
+    return buffer
+
+
+def read_body(event, timer=None, encoded=None):
+    '''
+    Input: lambda event with the audio as its body, whether a string body is
+           base64 (default the event's isBase64Encoded flag)
+    Output: the audio as a memoryview
+
+    Raises ValueError if the body is neither raw binary nor flagged as base64,
+    binascii.Error if it is not valid base64.
+    '''
+    body = event["body"]
+    if is_raw(body):
+        return memoryview(body)
+    if not (event.get("isBase64Encoded", False) if encoded is None else encoded):
+        raise ValueError("Audio file must be in base64 encoding or a raw binary body")
+    with stage(timer, "base64"):
+        return get_buffer().decode(body)
@@ -0,0 +1,205 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+'''
+Cache of model outputs keyed by the content of the upload.
+
+Users send the same track again and again (trying a different top_n on the demo
+page for example), each time paying for the decode and the effnet inference.
+ArrayCache keeps the result under a hash of the input bytes and the model version
+so a repeat upload skips both.
+
+Arrays are stored as float16 to halve their size, in two tiers:
+    memory: LRU in the process, lost when the container is recycled
+    disk: .npy files under /tmp, shared by every process on the container and
+          surviving a restart of the handler, evicted least recently used first
+          once the directory grows past its size limit
+
+Sizes and location come from the environment:
+    EMBEDDING_CACHE_DIR (default /tmp/embedding_cache)
+    EMBEDDING_CACHE_MEMORY_MB (default 64), 0 turns the memory tier off
+    EMBEDDING_CACHE_DISK_MB (default 256), 0 turns the disk tier off
+
+AudioCache keeps decoded audio the same way, for a process serving every
+function (see local_server) where the genre, instrument and pitch shift demos
+are sent the same upload one after the other. Samples are kept as decode gave
+them (float32, read only) in memory only, an entry is as big as the PCM so a
+disk tier would cost more than ffmpeg does. A lambda container serves one
+function, so it is off unless DECODE_CACHE_MB is set.
+'''
+
+CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", os.path.join("/tmp", "embedding_cache"))
+MEMORY_BYTES = int(float(os.environ.get("EMBEDDING_CACHE_MEMORY_MB", 64)) * 2**20)
+DISK_BYTES = int(float(os.environ.get("EMBEDDING_CACHE_DISK_MB", 256)) * 2**20)
+DECODE_BYTES = int(float(os.environ.get("DECODE_CACHE_MB", 0)) * 2**20)
+
+
+def content_key(data, version):
+    '''Hash of the input bytes and the version of whatever produced the cached value'''
+    digest = hashlib.blake2b(version.encode(), digest_size=20)
+    digest.update(b"\x00")
+    digest.update(data)
+    return digest.hexdigest()
+
+
+class ArrayCache:
+    '''
+    Two tier (memory then disk) LRU of float16 arrays.
+
+    get() returns (array as float32 or None, "memory" | "disk" | "miss").
+    stats counts the lookups answered by each tier.
+    '''
+
+    def __init__(self, directory=CACHE_DIR, memory_bytes=MEMORY_BYTES, disk_bytes=DISK_BYTES):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.disk_used = None  # Worked out from the directory on first write
+        self.stats = {"memory": 0, "disk": 0, "miss": 0}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            array = self.memory.get(key)
+            if array is not None:
+                self.memory.move_to_end(key)
+                self.stats["memory"] += 1
+                return array.astype(np.float32), "memory"
+
+        array = self._read_disk(key)
+        with self.lock:
+            if array is None:
+                self.stats["miss"] += 1
+                return None, "miss"
+            self.stats["disk"] += 1
+            self._store_memory(key, array)
+        return array.astype(np.float32), "disk"
+
+    def put(self, key, array):
+        '''Store an array in both tiers'''
+        array = np.asarray(array, dtype=np.float16)
+        with self.lock:
+            self._store_memory(key, array)
+        self._write_disk(key, array)
+
+    def _store_memory(self, key, array):
+        if array.nbytes > self.memory_bytes:
+            return
+        if key in self.memory:
+            self.memory_used -= self.memory.pop(key).nbytes
+        self.memory[key] = array
+        self.memory_used += array.nbytes
+        while self.memory_used > self.memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_used -= evicted.nbytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def _read_disk(self, key):
+        if self.disk_bytes <= 0:
+            return None
+        path = self._path(key)
+        try:
+            array = np.load(path, allow_pickle=False)
+            os.utime(path)  # Mark as recently used for eviction
+            return array
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, array):
+        if self.disk_bytes <= 0 or array.nbytes > self.disk_bytes:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write then rename so a reader never sees half a file
+            temporary = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary, "wb") as f:
+                np.save(f, array, allow_pickle=False)
+            os.replace(temporary, self._path(key))
+            with self.lock:
+                if self.disk_used is None:
+                    self.disk_used = self._directory_size()
+                else:
+                    self.disk_used += os.path.getsize(self._path(key))
+                if self.disk_used > self.disk_bytes:
+                    self._evict_disk()
+        except OSError as e:
+            # A full or read only /tmp only loses the cache, not the request
+            print("Error: embedding cache write failed:", str(e))
+
+    def _directory_size(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.name.endswith(".npy"))
+
+    def _evict_disk(self):
+        '''Delete least recently used files until the directory is back under its limit'''
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.name.endswith(".npy")),
+                         key=lambda entry: entry.stat().st_mtime)
+        used = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if used <= self.disk_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                used -= size
+            except OSError:
+                pass  # Already removed by another process
+        self.disk_used = used
+
+
+class AudioCache:
+    '''
+    In memory LRU of decoded audio, (samples, sample rate) by key.
+
+    get() returns ((samples, sample rate) or None, "memory" | "miss"), the samples
+    are read only and shared by every request that hits. stats counts the
+    lookups of each kind.
+    '''
+
+    def __init__(self, memory_bytes=DECODE_BYTES):
+        self.memory_bytes = memory_bytes
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.stats = {"memory": 0, "miss": 0}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.memory_bytes > 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is None:
+                self.stats["miss"] += 1
+                return None, "miss"
+            self.memory.move_to_end(key)
+            self.stats["memory"] += 1
+            return entry, "memory"
+
+    def put(self, key, samples, sample_rate):
+        '''Keep the samples unless they are bigger than the cache, returns them read only'''
+        samples = np.asarray(samples)
+        samples.flags.writeable = False
+        if samples.nbytes > self.memory_bytes:
+            return samples
+        with self.lock:
+            if key in self.memory:
+                self.memory_used -= self.memory.pop(key)[0].nbytes
+            self.memory[key] = (samples, sample_rate)
+            self.memory_used += samples.nbytes
+            while self.memory_used > self.memory_bytes:
+                _, (evicted, _) = self.memory.popitem(last=False)
+                self.memory_used -= evicted.nbytes
+        return samples
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.memory_used = 0
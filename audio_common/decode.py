@@ -0,0 +1,354 @@
+import os
+import struct
+import subprocess
+import threading
+import numpy as np
+from audio_common.timing import stage, note
+from audio_common.cache import AudioCache, content_key
+
+'''
+Shared in-memory decode for the lambda functions.
+
+The functions used to decode the upload with pydub, export it to a temp file
+(MP3 or WAV) and then decode that file again with essentia's MonoLoader, which is
+two decodes, one encode and a disk write per request.
+
+Here ffmpeg reads the request bytes on stdin and writes float32 PCM on stdout so
+the upload is decoded once and the numpy buffer is handed straight to essentia
+(es.Energy, es.TensorflowPredictEffnetDiscogs, ...) which all take arrays.
+
+BlockDecoder does the same but hands the samples over a block at a time so memory
+use does not depend on the length of the track.
+
+Both take the audio as bytes or as a readable stream (an object in storage, see
+audio_common.storage). A file is given to ffmpeg as its stdin so it reads the
+file itself, other streams are copied in STREAM_CHUNK bytes at a time, so the
+encoded audio is never held in memory whole either.
+
+When a sample_rate is asked for ffmpeg resamples while decoding, so the ML
+functions pull 16 kHz straight out of a 44.1 kHz upload. How well it resamples
+is a quality tier (see RESAMPLE_QUALITIES), "default" is ffmpeg's own default.
+
+decode looks bytes up in decode_cache first (see audio_common.cache), which is
+off unless DECODE_CACHE_MB is set or a server turns it on.
+
+The ffmpeg binary is the one in custom_bins on the PATH, FFMPEG_BINARY overrides it.
+'''
+
+FFMPEG = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+
+# Samples per channel read from ffmpeg at a time when streaming
+BLOCK_SIZE = 2**16
+# Bytes copied at a time from an input stream that is not a file
+STREAM_CHUNK = 2**16
+
+# ffmpeg aresample options for each resampling quality tier
+#   fast: short swr filter, a little quicker and a little more aliasing
+#   default: swr defaults, what ffmpeg -ar gives
+#   high: SoX resampler at 28 bit precision, the slowest
+RESAMPLE_QUALITIES = {
+    "fast": "resampler=swr:filter_size=8:phase_shift=6",
+    "default": "resampler=swr",
+    "high": "resampler=soxr:precision=28",
+}
+DEFAULT_QUALITY = "default"
+# Bumped when the decoded samples change for the same arguments
+DECODE_VERSION = "pcm_f32le/1"
+
+# Shared by everything imported in the same process
+decode_cache = AudioCache()
+
+
+def ffmpeg_command(sample_rate=None, quality=DEFAULT_QUALITY, input_format=()):
+    '''
+    ffmpeg arguments to decode stdin to a float32 WAV stream on stdout,
+    input_format describes raw input that has no header (see resample)
+    '''
+    assert quality in RESAMPLE_QUALITIES, f"quality must be one of: {', '.join(RESAMPLE_QUALITIES)}"
+    command = [FFMPEG, "-hide_banner", "-loglevel", "error", *input_format, "-i", "pipe:0",
+               "-vn", "-map_metadata", "-1", "-f", "wav", "-acodec", "pcm_f32le"]
+    if sample_rate:
+        command += ["-af", f"aresample={int(sample_rate)}:{RESAMPLE_QUALITIES[quality]}"]
+    command.append("pipe:1")
+    return command
+
+
+def is_stream(source):
+    '''Whether audio is given as a readable stream rather than bytes'''
+    return hasattr(source, "read")
+
+
+def file_descriptor(source):
+    '''File descriptor of a file or pipe, None for bytes and streams without one (BytesIO, S3 bodies)'''
+    try:
+        return source.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def feed(stdin, source):
+    '''Write bytes, or a stream STREAM_CHUNK bytes at a time, to ffmpeg's stdin and close it'''
+    try:
+        if is_stream(source):
+            for chunk in iter(lambda: source.read(STREAM_CHUNK), b""):
+                stdin.write(chunk)
+        else:
+            stdin.write(source)
+    except (BrokenPipeError, ValueError):
+        pass  # ffmpeg stopped reading, the error is reported from stderr
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def run_ffmpeg(command, source):
+    '''
+    Run ffmpeg with bytes or a stream on its stdin, returns (return code, stdout, stderr).
+    A file becomes ffmpeg's stdin, any other stream is copied in from a thread.
+    '''
+    if not is_stream(source):
+        process = subprocess.run(command, input=source, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return process.returncode, process.stdout, process.stderr
+
+    descriptor = file_descriptor(source)
+    with subprocess.Popen(command, stdin=subprocess.PIPE if descriptor is None else descriptor,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+        feeder = None
+        if descriptor is None:
+            feeder = threading.Thread(target=feed, args=(process.stdin, source), daemon=True)
+            feeder.start()
+        stdout = process.stdout.read()
+        stderr = process.stderr.read()
+        process.wait()
+        if feeder is not None:
+            feeder.join()
+    return process.returncode, stdout, stderr
+
+
+def decode(audio_bytes, sample_rate=None, mono=True, timer=None, quality=DEFAULT_QUALITY):
+    '''
+    Input: encoded audio (bytes or a readable stream), optional output sample rate (int), resampling quality tier
+    Output: (samples, sample_rate)
+
+    Samples are float32 in [-1, 1). When mono is True the channels are averaged
+    into a 1D array the same way MonoLoader mixes them, otherwise the array has
+    shape (number of samples, channels).
+    If sample_rate is None the source rate is kept.
+
+    With decode_cache on, bytes already decoded with the same arguments are
+    answered from it ("decode_cache" is noted on the timer) and the samples are
+    read only. Streams are not cached.
+    '''
+    assert audio_bytes, "audio_bytes must not be empty"
+
+    cache = decode_cache
+    key = None
+    if cache.enabled and not is_stream(audio_bytes):
+        with stage(timer, "cache"):
+            key = content_key(audio_bytes, f"{DECODE_VERSION}/{sample_rate}/{mono}/{quality}")
+            entry, status = cache.get(key)
+        note(timer, "decode_cache", status)
+        if entry is not None:
+            return entry
+
+    with stage(timer, "decode"):
+        # Resampled by ffmpeg but mixed here, ffmpeg's own downmix scales by 1/sqrt(2)
+        returncode, stdout, stderr = run_ffmpeg(ffmpeg_command(sample_rate, quality), audio_bytes)
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg could not decode audio: {stderr.decode(errors='replace').strip()}")
+
+        channels, rate, samples = read_wav_f32(stdout)
+
+    if mono and channels > 1:
+        with stage(timer, "downmix"):
+            samples = samples.mean(axis=1, dtype=np.float32)
+    elif mono:
+        samples = samples.reshape(-1)
+
+    if key is not None:
+        samples = cache.put(key, samples, rate)
+    return samples, rate
+
+
+def resample(samples, sample_rate, target_rate, mono=True, timer=None, quality=DEFAULT_QUALITY):
+    '''
+    Input: float32 samples, shape (samples,) or (samples, channels), their rate, the rate wanted
+    Output: (samples, target_rate) shaped like decode's output
+
+    For audio that is already decoded (audio_pipeline), the samples are piped to
+    ffmpeg as raw float32 and resampled with the same quality tiers as decode, so
+    resampling a decoded track gives what decoding it at target_rate would.
+    '''
+    samples = np.asarray(samples, dtype=np.float32)
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    assert len(samples), "samples must not be empty"
+
+    if int(sample_rate) == int(target_rate):
+        resampled = samples.reshape(-1, channels)
+    else:
+        with stage(timer, "resample"):
+            input_format = ["-f", "f32le", "-ar", str(int(sample_rate)), "-ac", str(channels)]
+            process = subprocess.run(ffmpeg_command(target_rate, quality, input_format),
+                                     input=samples.astype("<f4", copy=False).tobytes(),
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if process.returncode != 0:
+                raise RuntimeError(f"ffmpeg could not resample audio: {process.stderr.decode(errors='replace').strip()}")
+            _, _, resampled = read_wav_f32(process.stdout)
+
+    if mono and channels > 1:
+        with stage(timer, "downmix"):
+            resampled = resampled.mean(axis=1, dtype=np.float32)
+    elif mono:
+        resampled = resampled.reshape(-1)
+
+    return resampled, int(target_rate)
+
+
+def read_wav_f32(raw):
+    '''
+    Read the float32 WAV ffmpeg writes to a pipe without copying the sample data.
+
+    The data chunk size is not filled in when ffmpeg writes to a pipe, so
+    everything after the data chunk header is taken as samples.
+    Returns (channels, sample_rate, samples with shape (n, channels)).
+    '''
+    if raw[:4] != b"RIFF" or raw[8:12] != b"WAVE":
+        raise ValueError("Decoder output is not a WAV stream")
+
+    channels = rate = None
+    offset = 12
+    while offset + 8 <= len(raw):
+        chunk_id = raw[offset:offset + 4]
+        chunk_size = struct.unpack_from("<I", raw, offset + 4)[0]
+        body = offset + 8
+        if chunk_id == b"fmt ":
+            channels, rate = struct.unpack_from("<HI", raw, body + 2)
+        elif chunk_id == b"data":
+            if channels is None:
+                raise ValueError("WAV stream has no fmt chunk")
+            count = (len(raw) - body) // (4 * channels)
+            if count == 0:
+                raise ValueError("No audio samples decoded")
+            samples = np.frombuffer(raw, dtype="<f4", count=count * channels, offset=body)
+            return channels, rate, samples.reshape(-1, channels)
+        offset = body + chunk_size + (chunk_size & 1)
+
+    raise ValueError("WAV stream has no data chunk")
+
+
+class BlockDecoder:
+    '''
+    Decode encoded audio bytes (or a readable stream) a block at a time.
+
+    Usage:
+        with BlockDecoder(audio_bytes, sample_rate=44100) as decoder:
+            for block in decoder:
+                ...
+
+    Blocks are float32 arrays of at most block_size samples, mono (channels
+    averaged like decode) or shaped (samples, channels). Only one block of PCM is
+    held at a time. decoder.sample_rate and decoder.channels are set on entry and
+    decoder.samples counts the samples read so far. Time spent waiting on ffmpeg
+    is recorded as the "decode" stage if a timer is given.
+    '''
+
+    def __init__(self, audio_bytes, sample_rate=None, mono=True, block_size=BLOCK_SIZE, timer=None,
+                 quality=DEFAULT_QUALITY):
+        assert audio_bytes, "audio_bytes must not be empty"
+        self.audio_bytes = audio_bytes
+        self.requested_rate = sample_rate
+        self.quality = quality
+        self.mono = mono
+        self.block_size = block_size
+        self.timer = timer
+        self.sample_rate = None
+        self.channels = None
+        self.samples = 0
+        self.process = None
+        self.feeder = None
+        self.finished = False
+
+    def __enter__(self):
+        descriptor = file_descriptor(self.audio_bytes) if is_stream(self.audio_bytes) else None
+        self.process = subprocess.Popen(ffmpeg_command(self.requested_rate, self.quality),
+                                        stdin=subprocess.PIPE if descriptor is None else descriptor,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if descriptor is None:
+            # Write the input from another thread so ffmpeg never blocks on a full stdout pipe
+            self.feeder = threading.Thread(target=feed, args=(self.process.stdin, self.audio_bytes), daemon=True)
+            self.feeder.start()
+        try:
+            with stage(self.timer, "decode"):
+                self.channels, self.sample_rate = self._read_header()
+        except ValueError as e:
+            stderr = self._close()
+            raise RuntimeError(f"ffmpeg could not decode audio: {stderr or str(e)}")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stderr = self._close()
+        if exc_type is None and self.finished and self.process.returncode != 0:
+            raise RuntimeError(f"ffmpeg could not decode audio: {stderr}")
+        return False
+
+    def __iter__(self):
+        frame_bytes = 4 * self.channels
+        while True:
+            with stage(self.timer, "decode"):
+                raw = self._read(self.block_size * frame_bytes)
+            count = len(raw) // frame_bytes
+            if count == 0:
+                self.finished = True
+                break
+            block = np.frombuffer(raw, dtype="<f4", count=count * self.channels).reshape(-1, self.channels)
+            if self.mono:
+                block = block.mean(axis=1, dtype=np.float32) if self.channels > 1 else block.reshape(-1)
+            self.samples += count
+            yield block
+
+    def _close(self):
+        '''Stop ffmpeg if the blocks were not all read and return what it wrote to stderr'''
+        if not self.finished and self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        stderr = self.process.stderr.read()
+        self.process.stderr.close()
+        self.process.wait()
+        if self.feeder is not None:
+            self.feeder.join()
+        return stderr.decode(errors="replace").strip()
+
+    def _read(self, size):
+        '''Read exactly size bytes unless the stream ends first'''
+        chunks = []
+        while size > 0:
+            chunk = self.process.stdout.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def _read_header(self):
+        '''Read the WAV header up to the data chunk, returns (channels, sample_rate)'''
+        riff = self._read(12)
+        if riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+            raise ValueError("Decoder output is not a WAV stream")
+
+        channels = rate = None
+        while True:
+            chunk_header = self._read(8)
+            if len(chunk_header) < 8:
+                raise ValueError("WAV stream has no data chunk")
+            chunk_id = chunk_header[:4]
+            chunk_size = struct.unpack("<I", chunk_header[4:])[0]
+            if chunk_id == b"data":
+                if channels is None:
+                    raise ValueError("WAV stream has no fmt chunk")
+                return channels, rate
+            body = self._read(chunk_size + (chunk_size & 1))
+            if chunk_id == b"fmt ":
+                channels, rate = struct.unpack_from("<HI", body, 2)
+
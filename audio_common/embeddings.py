@@ -0,0 +1,166 @@
+import os
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from audio_common.decode import decode, DEFAULT_QUALITY
+from audio_common.timing import stage, note
+from audio_common.models import registry
+from audio_common.cache import ArrayCache, content_key
+from audio_common.batching import MicroBatcher
+
+'''
+Discogs-EffNet embeddings shared by the genre, instrument and tagging functions.
+
+https://essentia.upf.edu/models.html#discogs-effnet
+
+The embedding model is the expensive part of every tagging request, so the
+embedding matrix of an upload is cached (see audio_common.cache) under a hash of
+its bytes, EMBEDDING_VERSION and the resampling quality. Change EMBEDDING_VERSION
+whenever the graph, its output or the way the audio is decoded changes so old
+entries are not used.
+
+The graph takes 16 kHz mono, so uploads are resampled to MODEL_SAMPLE_RATE by
+ffmpeg while they are decoded (see audio_common.decode for the quality tiers).
+
+With EFFNET_MICRO_BATCH=1 the graph is run on mel patches through a MicroBatcher
+(see audio_common.batching) so concurrent requests in one process share batches
+of 64 instead of each padding its own. Lambda gives a container one request at a
+time so it is off by default, it is for hosts serving requests from several
+threads. EFFNET_BATCH_SIZE and EFFNET_BATCH_WAIT_MS configure the batcher.
+'''
+
+EMBEDDING_MODEL = "discogs_effnet"
+EMBEDDING_PATCH_MODEL = "discogs_effnet_patches"
+EMBEDDING_GRAPH = "discogs-effnet-bs64-1.pb"
+EMBEDDING_VERSION = "discogs-effnet-bs64-1/PartitionedCall:1/16k"
+MODEL_SAMPLE_RATE = 16000
+
+# Front end of TensorflowPredictEffnetDiscogs, 96 band mel frames of 512 samples
+# every 256, grouped in patches of 128 frames every 62 frames
+FRAME_SIZE = 512
+FRAME_HOP = 256
+PATCH_SIZE = 128
+PATCH_HOP = 62
+# The graph is built for a fixed batch of patches
+GRAPH_BATCH = 64
+
+MICRO_BATCH = os.environ.get("EFFNET_MICRO_BATCH", "0") == "1"
+BATCH_SIZE = int(os.environ.get("EFFNET_BATCH_SIZE", GRAPH_BATCH))
+BATCH_WAIT_MS = float(os.environ.get("EFFNET_BATCH_WAIT_MS", 5))
+
+
+def build_embedding_model():
+    # Imported here so audio_common does not need essentia to be importable
+    from essentia import standard as es
+    return es.TensorflowPredictEffnetDiscogs(graphFilename=EMBEDDING_GRAPH, output="PartitionedCall:1")
+
+
+def build_patch_model():
+    '''The same graph without its front end, takes a batch of mel patches'''
+    from essentia import standard as es
+    return es.TensorflowPredict(graphFilename=EMBEDDING_GRAPH, inputs=["serving_default_melspectrogram"],
+                                outputs=["PartitionedCall:1"])
+
+
+registry.register(EMBEDDING_MODEL, build_embedding_model)
+# Only preloaded when micro-batching is on
+registry.register(EMBEDDING_PATCH_MODEL, build_patch_model, preload=MICRO_BATCH)
+
+
+def mel_patches(audio):
+    '''
+    Input: mono audio
+    Output: mel patches, shape (patches, PATCH_SIZE, 96)
+
+    The same patches TensorflowPredictEffnetDiscogs feeds its graph, an
+    incomplete last patch is dropped.
+    '''
+    from essentia import standard as es
+    mel = es.TensorflowInputMusiCNN()
+    bands = [mel(frame) for frame in es.FrameGenerator(audio, frameSize=FRAME_SIZE, hopSize=FRAME_HOP,
+                                                       startFromZero=True, validFrameThresholdRatio=1)]
+    if len(bands) < PATCH_SIZE:
+        return np.zeros((0, PATCH_SIZE, 96), dtype=np.float32)
+    # (frames, bands) -> (patches, bands, PATCH_SIZE) -> (patches, PATCH_SIZE, bands)
+    patches = sliding_window_view(np.asarray(bands, dtype=np.float32), PATCH_SIZE, axis=0)[::PATCH_HOP]
+    return np.ascontiguousarray(patches.transpose(0, 2, 1))
+
+
+def run_patches(patches):
+    '''
+    Run any number of mel patches through the graph GRAPH_BATCH at a time,
+    zero padding the last batch. Returns one embedding per patch.
+    '''
+    from essentia import Pool
+    model = registry.get(EMBEDDING_PATCH_MODEL)
+    outputs = []
+    for start in range(0, len(patches), GRAPH_BATCH):
+        batch = patches[start:start + GRAPH_BATCH]
+        padded = np.zeros((GRAPH_BATCH, 1) + batch.shape[1:], dtype=np.float32)
+        padded[:len(batch), 0] = batch
+        pool = Pool()
+        pool.set("serving_default_melspectrogram", padded)
+        embeddings = model(pool)["PartitionedCall:1"]
+        outputs.append(np.asarray(embeddings).reshape(GRAPH_BATCH, -1)[:len(batch)])
+    if not outputs:
+        return np.zeros((0, 1280), dtype=np.float32)
+    return np.concatenate(outputs)
+
+
+# Shared by every function imported in the same process
+embedding_cache = ArrayCache()
+embedding_batcher = MicroBatcher(run_patches, max_batch_size=BATCH_SIZE, max_wait_ms=BATCH_WAIT_MS)
+
+
+def embed_windows(windows, timer=None):
+    '''
+    Input: list of mono audio windows
+    Output: embedding matrix, the rows of every window one after the other
+
+    The patches of every window go through the graph together, so a handful of
+    short windows costs one batch rather than one batch each.
+    '''
+    with stage(timer, "patches"):
+        patches = np.concatenate([mel_patches(window) for window in windows])
+    with stage(timer, "embeddings"):
+        if MICRO_BATCH:
+            return embedding_batcher.submit(patches)
+        return run_patches(patches)
+
+
+def embed_audio(audio, timer=None):
+    '''
+    Input: mono audio at MODEL_SAMPLE_RATE
+    Output: embedding matrix, one row per patch
+
+    Not cached, for audio that is already decoded (get_embeddings caches by upload).
+    '''
+    if MICRO_BATCH:
+        return embed_windows([audio], timer)
+    with stage(timer, "embeddings"):
+        return registry.get(EMBEDDING_MODEL)(audio)
+
+
+def get_embeddings(audio_bytes, timer=None, cache=None, quality=DEFAULT_QUALITY):
+    '''
+    Input: audio bytes, resampling quality tier
+    Output: embedding matrix, one row per patch of the track
+
+    Looks in the cache before decoding. Whether the cache was hit ("memory",
+    "disk" or "miss") is noted on the timer as "embedding_cache".
+    '''
+    cache = embedding_cache if cache is None else cache
+
+    with stage(timer, "cache"):
+        key = content_key(audio_bytes, f"{EMBEDDING_VERSION}/{quality}")
+        embeddings, status = cache.get(key)
+    note(timer, "embedding_cache", status)
+    if embeddings is not None:
+        return embeddings
+
+    # Decode once in memory, resampled to the rate the graph takes
+    audio, _ = decode(audio_bytes, sample_rate=MODEL_SAMPLE_RATE, timer=timer, quality=quality)
+    embeddings = embed_audio(audio, timer)
+
+    with stage(timer, "cache"):
+        cache.put(key, embeddings)
+    return embeddings
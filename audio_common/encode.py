@@ -0,0 +1,313 @@
+import io
+import wave
+import struct
+import subprocess
+import threading
+import numpy as np
+from audio_common.decode import FFMPEG, STREAM_CHUNK, file_descriptor
+from audio_common.timing import stage
+
+'''
+Encode int16 audio for the response in the format the client asks for.
+
+The pitch shift and time stretch functions always answered with MP3 at 320 kbps,
+which costs an ffmpeg encode per request and a lossy generation every time the
+output is fed into another function. The client now picks the format:
+
+    pcm_s16le   raw interleaved int16, no encode at all
+    pcm_f32le   raw interleaved float32 in [-1, 1)
+    wav         int16 WAV, header written here
+    flac        lossless, ffmpeg
+    opus        Ogg Opus at bitrate (default 128k), ffmpeg
+    mp3         MP3 at bitrate (default 320k, the old output), ffmpeg
+
+negotiate() picks the format from the output_format query parameter or else the
+request's Accept header, mp3 when neither names one.
+
+Raw PCM and WAV skip the encode but are about 5x the size of 320k MP3. A lambda
+response is capped at 6 MB of base64, which is about 25 s of 44.1 kHz stereo.
+Past that write the output to storage (see audio_common.storage), encode_to has
+ffmpeg write straight into the object.
+
+BlockEncoder encodes audio handed over a block at a time, for output that is
+produced as a stream (see audio_time_stretch) and never held whole.
+'''
+
+DEFAULT_FORMAT = "mp3"
+
+# format -> (content type, ffmpeg arguments or None if encoded here, bitrates, default bitrate)
+OUTPUT_FORMATS = {
+    "pcm_s16le": ("audio/x-raw; format=S16LE", None, (), None),
+    "pcm_f32le": ("audio/x-raw; format=F32LE", None, (), None),
+    "wav": ("audio/wav", None, (), None),
+    "flac": ("audio/flac", ["-c:a", "flac", "-f", "flac"], (), None),
+    "opus": ("audio/ogg; codecs=opus", ["-c:a", "libopus", "-f", "ogg"], ("32k", "64k", "96k", "128k", "192k", "256k"), "128k"),
+    "mp3": ("audio/mpeg", ["-c:a", "libmp3lame", "-f", "mp3"], ("96k", "128k", "192k", "256k", "320k"), "320k"),
+}
+
+# File extension of each format, for object keys
+FILE_EXTENSIONS = {
+    "pcm_s16le": "raw",
+    "pcm_f32le": "raw",
+    "wav": "wav",
+    "flac": "flac",
+    "opus": "ogg",
+    "mp3": "mp3",
+}
+
+# Accept header media types -> format
+MEDIA_TYPES = {
+    "audio/mpeg": "mp3",
+    "audio/mp3": "mp3",
+    "audio/wav": "wav",
+    "audio/wave": "wav",
+    "audio/x-wav": "wav",
+    "audio/flac": "flac",
+    "audio/x-flac": "flac",
+    "audio/ogg": "opus",
+    "audio/opus": "opus",
+    "audio/x-raw": "pcm_s16le",
+    "application/octet-stream": "pcm_s16le",
+}
+
+
+def parse_accept(accept):
+    '''Media types of an Accept header, most preferred first, without the ones refused with q=0'''
+    types = []
+    for position, part in enumerate(accept.split(",")):
+        media_type, *parameters = [item.strip() for item in part.split(";")]
+        quality = 1.0
+        for parameter in parameters:
+            if parameter.startswith("q="):
+                try:
+                    quality = float(parameter[2:])
+                except ValueError:
+                    quality = 0.0
+        if media_type and quality > 0:
+            types.append((-quality, position, media_type.lower()))
+    return [media_type for _, _, media_type in sorted(types)]
+
+
+def negotiate(parameters, headers):
+    '''
+    Input: query parameters, request headers
+    Output: (format, bitrate)
+
+    Raises ValueError with a message for the client if output_format or bitrate is not supported.
+    '''
+    parameters = parameters or {}
+    output_format = parameters.get("output_format")
+    if output_format is None:
+        output_format = DEFAULT_FORMAT
+        accept = {name.lower(): value for name, value in (headers or {}).items()}.get("accept", "")
+        for media_type in parse_accept(accept):
+            if media_type in MEDIA_TYPES:
+                output_format = MEDIA_TYPES[media_type]
+                break
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"output_format parameter must be one of: {', '.join(OUTPUT_FORMATS)}")
+
+    _, _, bitrates, bitrate = OUTPUT_FORMATS[output_format]
+    if "bitrate" in parameters:
+        bitrate = str(parameters["bitrate"]).lower()
+        if bitrate not in bitrates:
+            raise ValueError(f"bitrate parameter for {output_format} must be one of: {', '.join(bitrates) or 'none'}")
+    return output_format, bitrate
+
+
+def content_type(output_format, sample_rate, channels):
+    '''Content-Type of the response, raw PCM also carries its rate and channels'''
+    media_type = OUTPUT_FORMATS[output_format][0]
+    if output_format.startswith("pcm_"):
+        media_type += f"; rate={sample_rate}; channels={channels}"
+    return media_type
+
+
+def encode(samples, sample_rate, output_format=DEFAULT_FORMAT, bitrate=None, timer=None):
+    '''
+    Input: int16 samples, shape (samples,) or (samples, channels), sample rate, format, bitrate
+    Output: (encoded bytes, content type)
+    '''
+    assert output_format in OUTPUT_FORMATS, f"output_format must be one of: {', '.join(OUTPUT_FORMATS)}"
+    samples = np.asarray(samples, dtype=np.int16)
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+
+    with stage(timer, "encode"):
+        if OUTPUT_FORMATS[output_format][1] is not None:
+            process = subprocess.run(encode_command(sample_rate, channels, output_format, bitrate),
+                                     input=samples.astype("<i2", copy=False).tobytes(),
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            check_encoded(process.returncode, process.stderr, output_format)
+            data = process.stdout
+        elif output_format == "pcm_s16le":
+            data = samples.astype("<i2", copy=False).tobytes()
+        elif output_format == "pcm_f32le":
+            data = (samples.astype("<f4") / 2**15).tobytes()
+        elif output_format == "wav":
+            buffer = io.BytesIO()
+            with wave.open(buffer, "wb") as f:
+                f.setnchannels(channels)
+                f.setsampwidth(2)
+                f.setframerate(sample_rate)
+                f.writeframes(samples.astype("<i2", copy=False).tobytes())
+            data = buffer.getvalue()
+
+    return data, content_type(output_format, sample_rate, channels)
+
+
+def encode_command(sample_rate, channels, output_format, bitrate=None):
+    '''ffmpeg arguments to encode interleaved int16 on stdin to output_format on stdout'''
+    _, arguments, _, default_bitrate = OUTPUT_FORMATS[output_format]
+    command = [FFMPEG, "-hide_banner", "-loglevel", "error", "-f", "s16le", "-ar", str(int(sample_rate)),
+               "-ac", str(channels), "-i", "pipe:0"] + arguments
+    if bitrate or default_bitrate:
+        command += ["-b:a", bitrate or default_bitrate]
+    command.append("pipe:1")
+    return command
+
+
+def check_encoded(returncode, stderr, output_format):
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg could not encode {output_format}: {stderr.decode(errors='replace').strip()}")
+
+
+def encode_to(output, samples, sample_rate, output_format=DEFAULT_FORMAT, bitrate=None, timer=None):
+    '''
+    Input: writable binary file object, then the same as encode
+    Output: content type
+
+    encode() written to output instead of returned. When output is a file or a
+    pipe ffmpeg writes the encoded audio straight into it, so it is never held
+    in memory.
+    '''
+    assert output_format in OUTPUT_FORMATS, f"output_format must be one of: {', '.join(OUTPUT_FORMATS)}"
+    descriptor = file_descriptor(output)
+    if OUTPUT_FORMATS[output_format][1] is None or descriptor is None:
+        data, media_type = encode(samples, sample_rate, output_format, bitrate, timer)
+        output.write(data)
+        return media_type
+
+    samples = np.asarray(samples, dtype=np.int16)
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    output.flush()
+    with stage(timer, "encode"):
+        process = subprocess.run(encode_command(sample_rate, channels, output_format, bitrate),
+                                 input=samples.astype("<i2", copy=False).tobytes(),
+                                 stdout=descriptor, stderr=subprocess.PIPE)
+        check_encoded(process.returncode, process.stderr, output_format)
+    return content_type(output_format, sample_rate, channels)
+
+
+def wav_header(sample_rate, channels, frames=None):
+    '''int16 WAV header, sizes of 0xFFFFFFFF (as ffmpeg writes to a pipe) when the length is not known'''
+    data_size = 0xFFFFFFFF if frames is None else frames * channels * 2
+    riff_size = 0xFFFFFFFF if frames is None else data_size + 36
+    fmt = struct.pack("<HHIIHH", 1, channels, sample_rate, sample_rate * channels * 2, channels * 2, 16)
+    return (b"RIFF" + struct.pack("<I", riff_size) + b"WAVE" + b"fmt " + struct.pack("<I", len(fmt)) + fmt
+            + b"data" + struct.pack("<I", data_size))
+
+
+class BlockEncoder:
+    '''
+    Encode int16 audio handed over a block at a time into a writable binary file object.
+
+    Usage:
+        with BlockEncoder(output, 44100, channels=2, output_format="mp3") as encoder:
+            for block in blocks:
+                encoder.write(block)
+
+    Blocks are (samples,) or (samples, channels). ffmpeg formats go through one
+    ffmpeg process for the whole stream, writing straight into output when it
+    is a file or a pipe and otherwise copied into it STREAM_CHUNK bytes at a time
+    from another thread. Raw PCM and WAV are written here, a WAV's sizes are
+    filled in on exit when output can seek and left as 0xFFFFFFFF otherwise.
+    encoder.content_type is the Content-Type of the output. Time spent encoding
+    is recorded as the "encode" stage if a timer is given.
+    '''
+
+    def __init__(self, output, sample_rate, channels=1, output_format=DEFAULT_FORMAT, bitrate=None, timer=None):
+        assert output_format in OUTPUT_FORMATS, f"output_format must be one of: {', '.join(OUTPUT_FORMATS)}"
+        self.output = output
+        self.sample_rate = int(sample_rate)
+        self.channels = channels
+        self.output_format = output_format
+        self.bitrate = bitrate
+        self.timer = timer
+        self.content_type = content_type(output_format, sample_rate, channels)
+        self.frames = 0
+        self.process = None
+        self.copier = None
+        self.start = None
+
+    def __enter__(self):
+        if OUTPUT_FORMATS[self.output_format][1] is not None:
+            descriptor = file_descriptor(self.output)
+            if descriptor is not None:
+                self.output.flush()
+            self.process = subprocess.Popen(encode_command(self.sample_rate, self.channels, self.output_format, self.bitrate),
+                                            stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+                                            stdout=subprocess.PIPE if descriptor is None else descriptor)
+            if descriptor is None:
+                # Read from another thread so ffmpeg never blocks on a full stdout pipe
+                self.copier = threading.Thread(target=self._copy, daemon=True)
+                self.copier.start()
+        elif self.output_format == "wav":
+            self.start = self.output.tell() if self.output.seekable() else None
+            self.output.write(wav_header(self.sample_rate, self.channels))
+        return self
+
+    def write(self, samples):
+        samples = np.asarray(samples, dtype=np.int16)
+        if len(samples) == 0:
+            return
+        assert (1 if samples.ndim == 1 else samples.shape[1]) == self.channels, "block has the wrong number of channels"
+        if self.output_format == "pcm_f32le":
+            data = (samples.astype("<f4") / 2**15).tobytes()
+        else:
+            data = samples.astype("<i2", copy=False).tobytes()
+        with stage(self.timer, "encode"):
+            (self.process.stdin if self.process else self.output).write(data)
+        self.frames += len(samples)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.process is not None:
+            if exc_type is not None:
+                self.process.kill()
+            with stage(self.timer, "encode"):
+                try:
+                    self.process.stdin.close()
+                except BrokenPipeError:
+                    pass
+                stderr = self.process.stderr.read()
+                self.process.stderr.close()
+                self.process.wait()
+                if self.copier is not None:
+                    self.copier.join()
+            if exc_type is None:
+                check_encoded(self.process.returncode, stderr, self.output_format)
+        elif self.start is not None and exc_type is None:
+            # Fill in the sizes now the length is known
+            end = self.output.tell()
+            self.output.seek(self.start)
+            self.output.write(wav_header(self.sample_rate, self.channels, self.frames))
+            self.output.seek(end)
+        return False
+
+    def _copy(self):
+        for chunk in iter(lambda: self.process.stdout.read(STREAM_CHUNK), b""):
+            self.output.write(chunk)
+        self.process.stdout.close()
+
+
+def encode_blocks(blocks, sample_rate, channels=1, output_format=DEFAULT_FORMAT, bitrate=None, timer=None):
+    '''
+    Input: iterable of int16 blocks, then the same as encode
+    Output: (encoded bytes, content type)
+
+    Only the encoded output is held, not the samples.
+    '''
+    output = io.BytesIO()
+    with BlockEncoder(output, sample_rate, channels, output_format, bitrate, timer) as encoder:
+        for block in blocks:
+            encoder.write(block)
+    return output.getvalue(), encoder.content_type
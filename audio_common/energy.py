@@ -0,0 +1,123 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+'''
+Vectorised frame energy, replaces calling es.Energy() on every frame from
+es.FrameGenerator in a Python loop.
+
+Frames are laid out exactly like FrameGenerator with its defaults
+(startFromZero=False): the first frame is centred on the first sample, frames
+start every hop_size samples and anything outside the signal is zero. The last
+frame is the first one centred past the end of the signal (or the last one that
+starts inside it if that comes sooner). The energy of a frame is its sum of
+squares, the same as es.Energy.
+
+Frames that lie inside the signal are taken as one strided view (no copy) and
+reduced together, the few frames hanging over either end only need the part
+that overlaps the signal because the padding is zero.
+'''
+
+
+def first_frame_start(frame_size):
+    '''Start of the first frame, before the signal so the frame is centred on sample 0'''
+    return -((frame_size + 1) // 2)
+
+
+def number_of_frames(length, frame_size, hop_size):
+    '''Number of frames FrameGenerator gives for a signal of length samples'''
+    if length <= 0:
+        return 0
+    padding = -first_frame_start(frame_size)
+    starting_inside = -(-(length + padding) // hop_size)  # ceil
+    centred_inside = -(-(length + padding - frame_size // 2) // hop_size)
+    return min(starting_inside, centred_inside + 1)
+
+
+def frame_energies(signal, frame_size=1024, hop_size=1024):
+    '''
+    Input: 1D signal, frame size and hop size in samples
+    Output: energy of every frame (float64 array)
+    '''
+    signal = np.asarray(signal, dtype=np.float32)
+    assert signal.ndim == 1, "signal must be one dimensional"
+    assert frame_size > 0 and hop_size > 0, "frame_size and hop_size must be positive"
+
+    length = len(signal)
+    count = number_of_frames(length, frame_size, hop_size)
+    energies = np.zeros(count, dtype=np.float64)
+    starts = np.arange(count) * hop_size + first_frame_start(frame_size)
+
+    inside = np.flatnonzero((starts >= 0) & (starts + frame_size <= length))
+    if len(inside):
+        first, last = inside[0], inside[-1]
+        windows = sliding_window_view(signal, frame_size)[starts[first]:starts[last] + 1:hop_size]
+        energies[first:last + 1] = np.einsum("ij,ij->i", windows, windows)
+
+    # Frames hanging over either end of the signal
+    for index in np.flatnonzero((starts < 0) | (starts + frame_size > length)):
+        part = signal[max(starts[index], 0):starts[index] + frame_size]
+        energies[index] = np.dot(part, part)
+
+    return energies
+
+
+def average_energy(signal, frame_size=1024, hop_size=1024):
+    '''Average energy of the frames of a signal'''
+    energies = frame_energies(signal, frame_size, hop_size)
+    assert len(energies), "signal must not be empty"
+    return float(energies.sum() / len(energies))
+
+
+class RunningEnergy:
+    '''
+    Running sum of frame energies for a signal that arrives in blocks.
+
+    Usage:
+        running = RunningEnergy(frame_size=1024, hop_size=512)
+        for block in blocks:
+            running.add(block)
+        running.average()
+
+    Gives the same frames as frame_energies on the whole signal but only keeps the
+    samples of the frame still in progress, so memory is one block plus one frame.
+    '''
+
+    def __init__(self, frame_size=1024, hop_size=1024):
+        assert frame_size > 0 and hop_size > 0, "frame_size and hop_size must be positive"
+        self.frame_size = frame_size
+        self.hop_size = hop_size
+        # Samples not yet used by a complete frame, starting with the centring zeros
+        self.carry = np.zeros(-first_frame_start(frame_size), dtype=np.float32)
+        self.total = 0.0
+        self.frames = 0
+        self.samples = 0
+        # Samples to drop before the next frame starts when hop_size > frame_size
+        self.skip = 0
+
+    def add(self, block):
+        '''Add the energy of every frame completed by block'''
+        block = np.asarray(block, dtype=np.float32)
+        self.samples += len(block)
+        dropped = min(self.skip, len(block))
+        self.skip -= dropped
+        buffer = np.concatenate((self.carry, block[dropped:]))
+        if len(buffer) >= self.frame_size:
+            windows = sliding_window_view(buffer, self.frame_size)[::self.hop_size]
+            self.total += float(np.einsum("ij,ij->i", windows, windows).sum(dtype=np.float64))
+            self.frames += len(windows)
+            used = len(windows) * self.hop_size
+            self.skip = max(used - len(buffer), 0)
+            buffer = buffer[used:]
+        self.carry = buffer
+
+    def average(self):
+        '''Average frame energy, the zero padded frames at the end are included'''
+        total, frames = self.total, self.frames
+        # Frames still to come start in the carry and run past the end of the signal
+        count = number_of_frames(self.samples, self.frame_size, self.hop_size)
+        for offset in range(0, (count - frames) * self.hop_size, self.hop_size):
+            part = self.carry[offset:offset + self.frame_size]
+            total += float(np.dot(part, part))
+
+        assert count, "signal must not be empty"
+        return total / count
@@ -0,0 +1,254 @@
+import re
+import struct
+from bisect import bisect_right
+from audio_common.mp3 import id3v2_size
+
+'''
+ID3 tag reading straight from the raw mp3 bytes.
+
+https://id3.org/id3v2.4.0-structure
+https://id3.org/id3v2.3.0
+https://id3.org/ID3v1
+
+Only the tag bytes at the start (ID3v2) and the last 128 bytes (ID3v1) are
+looked at so the time taken does not depend on the length of the audio.
+Pictures are not copied, their position in the file is returned instead.
+'''
+
+# Common frames returned under the names essentia's MetadataReader used
+FRAME_NAMES = {
+    "TIT2": "title", "TT2": "title",
+    "TPE1": "artist", "TP1": "artist",
+    "TALB": "album", "TAL": "album",
+    "TCON": "genre", "TCO": "genre",
+    "TRCK": "tracknumber", "TRK": "tracknumber",
+    "TDRC": "date", "TYER": "date", "TYE": "date",
+    "COMM": "comment", "COM": "comment",
+}
+
+TEXT_ENCODINGS = ("latin-1", "utf-16", "utf-16-be", "utf-8")
+
+
+def _terminator(encoding):
+    '''Null terminator for an ID3 text encoding byte'''
+    return b"\x00\x00" if encoding in (1, 2) else b"\x00"
+
+
+def _string_end(data, encoding):
+    '''Index of the null terminator that ends the first string in data, -1 if there is none'''
+    terminator = _terminator(encoding)
+    end = data.find(terminator)
+    # utf-16 terminators must be aligned to a character
+    while end != -1 and end % len(terminator):
+        end = data.find(terminator, end + 1)
+    return end
+
+
+def _split_string(data, encoding):
+    '''Split one null terminated string off the front of data, returns (text, rest)'''
+    end = _string_end(data, encoding)
+    if end == -1:
+        return _decode_text(data, encoding), b""
+    return _decode_text(data[:end], encoding), data[end + len(_terminator(encoding)):]
+
+
+def _decode_text(data, encoding):
+    '''Decode ID3 text, dropping trailing nulls'''
+    codec = TEXT_ENCODINGS[encoding] if encoding < len(TEXT_ENCODINGS) else "latin-1"
+    return bytes(data).decode(codec, errors="replace").rstrip("\x00")
+
+
+def _remove_unsynchronisation(data):
+    '''Undo ID3 unsynchronisation (0xFF 0x00 -> 0xFF)'''
+    return bytes(data).replace(b"\xff\x00", b"\xff")
+
+
+def _unsynchronised_body(data):
+    '''
+    Undo the unsynchronisation of a whole v2.2/v2.3 tag body.
+    Returns (body, shifts), position p in body is p + bisect_right(shifts, p) in data
+    '''
+    removed = [match.start() + 1 for match in re.finditer(b"\xff\x00", bytes(data))]
+    return _remove_unsynchronisation(data), [position - count for count, position in enumerate(removed)]
+
+
+def _syncsafe(data):
+    '''Read a 4 byte syncsafe integer'''
+    size = 0
+    for byte in data:
+        size = (size << 7) | (byte & 0x7F)
+    return size
+
+
+def _parse_frame(frame_id, content, offset, unsynchronised):
+    '''
+    Parse the content of one frame.
+
+    Returns (kind, value) where kind is "text", "comment", "picture" or None for
+    frames we do not read. offset is where content starts in the file.
+    '''
+    if not content:
+        return None, None
+
+    if frame_id in ("APIC", "PIC"):
+        # The mime type and description are short, the image itself is never copied
+        head = bytes(content[:1024])
+        encoding = head[0]
+        if frame_id == "PIC":
+            mime = "image/" + head[1:4].decode("latin-1").lower()
+            position = 4
+        else:
+            end = head.find(b"\x00", 1)
+            mime = head[1:end].decode("latin-1")
+            position = end + 1
+        picture_type = head[position]
+        position += 1
+        end = _string_end(head[position:], encoding)
+        description = _decode_text(head[position:position + max(end, 0)], encoding)
+        data_start = position + end + len(_terminator(encoding)) if end != -1 else position
+        return "picture", {
+            "mime": mime,
+            "type": picture_type,
+            "description": description,
+            "offset": offset + data_start,
+            "length": len(content) - data_start,
+            "unsynchronised": unsynchronised,
+        }
+
+    content = bytes(content)
+    if unsynchronised:
+        content = _remove_unsynchronisation(content)
+
+    if frame_id in ("COMM", "COM"):
+        encoding = content[0]
+        _, text = _split_string(content[4:], encoding)
+        return "comment", _decode_text(text, encoding)
+
+    if frame_id in ("TXXX", "TXX"):
+        encoding = content[0]
+        description, value = _split_string(content[1:], encoding)
+        return "text", {description: _decode_text(value, encoding)}
+
+    if frame_id.startswith("T"):
+        encoding = content[0]
+        # v2.4 allows several null separated values
+        return "text", _decode_text(content[1:], encoding).replace("\x00", "/")
+
+    return None, None
+
+
+def read_id3v2(data):
+    '''
+    Input: mp3 bytes
+    Output: dict of tags or None if there is no ID3v2 tag
+
+    The result has "version", the recognised fields (title, artist, ...), every
+    text frame by its frame id under "tags" and embedded images under "pictures"
+    as byte offsets into data rather than the image itself.
+    '''
+    size = id3v2_size(data)
+    if size == 0:
+        return None
+
+    major = data[3]
+    flags = data[5]
+    end = min(10 + _syncsafe(data[6:10]), len(data))
+    position = 10
+
+    # v2.2 and v2.3 unsynchronise the whole tag, frame headers and sizes included,
+    # so it is undone before the frames are walked. v2.4 flags each frame instead
+    shifts = None
+    if flags & 0x80 and major < 4:
+        body, shifts = _unsynchronised_body(data[10:end])
+        data = bytes(data[:10]) + body
+        shifts = [10 + shift for shift in shifts]
+        end = len(data)
+    view = memoryview(data)
+
+    # Skip the extended header
+    if flags & 0x40:
+        if major == 3:
+            position += 4 + struct.unpack_from(">I", data, position)[0]
+        elif major == 4:
+            position += _syncsafe(data[position:position + 4])
+
+    id_length, header_length = (3, 6) if major == 2 else (4, 10)
+
+    output = {"version": f"2.{major}", "tags": {}, "pictures": []}
+    while position + header_length <= end:
+        frame_id = bytes(data[position:position + id_length])
+        if frame_id[0] == 0:
+            break  # padding
+        if major == 2:
+            frame_size = int.from_bytes(data[position + 3:position + 6], "big")
+            frame_flags = 0
+        elif major == 3:
+            frame_size = struct.unpack_from(">I", data, position + 4)[0]
+            frame_flags = struct.unpack_from(">H", data, position + 8)[0]
+        else:
+            frame_size = _syncsafe(data[position + 4:position + 8])
+            frame_flags = struct.unpack_from(">H", data, position + 8)[0]
+
+        content_start = position + header_length
+        content_end = min(content_start + frame_size, end)
+        position = content_start + frame_size
+
+        try:
+            frame_id = frame_id.decode("ascii")
+        except UnicodeDecodeError:
+            break
+
+        unsynchronised = False
+        if major == 3 and frame_flags & 0x00C0:
+            continue  # compressed or encrypted
+        if major == 4:
+            if frame_flags & 0x000C:
+                continue  # compressed or encrypted
+            unsynchronised = bool(frame_flags & 0x0002)
+            if frame_flags & 0x0001:
+                content_start += 4  # data length indicator
+
+        kind, value = _parse_frame(frame_id, view[content_start:content_end], content_start, unsynchronised)
+        if kind == "picture":
+            if shifts is not None:
+                # Offsets into the input, where the image is still unsynchronised
+                start, stop = value["offset"], value["offset"] + value["length"]
+                start, stop = start + bisect_right(shifts, start), stop + bisect_right(shifts, stop)
+                value.update(offset=start, length=stop - start, unsynchronised=True)
+            output["pictures"].append(value)
+        elif kind == "text" and isinstance(value, dict):
+            output["tags"].setdefault(frame_id, {}).update(value)
+        elif kind is not None:
+            output["tags"][frame_id] = value
+            name = FRAME_NAMES.get(frame_id)
+            if name is not None and name not in output:
+                output[name] = value
+
+    return output
+
+
+def read_id3v1(data):
+    '''
+    Input: mp3 bytes
+    Output: dict of tags from the ID3v1 tag in the last 128 bytes or None if there is none
+    '''
+    if len(data) < 128 or data[-128:-125] != b"TAG":
+        return None
+    tag = bytes(data[-128:])
+
+    def text(start, length):
+        return tag[start:start + length].split(b"\x00")[0].decode("latin-1").strip()
+
+    output = {
+        "title": text(3, 30),
+        "artist": text(33, 30),
+        "album": text(63, 30),
+        "date": text(93, 4),
+        "comment": text(97, 30),
+        "genre_id": tag[127],
+    }
+    # ID3v1.1 puts the track number in the last byte of the comment
+    if tag[125] == 0 and tag[126] != 0:
+        output["comment"] = text(97, 28)
+        output["tracknumber"] = str(tag[126])
+    return {key: value for key, value in output.items() if value != ""}
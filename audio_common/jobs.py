@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import uuid
+import importlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from audio_common.timing import StageTimer, stage, parse_server_timing
+from audio_common.encode import negotiate, FILE_EXTENSIONS
+from audio_common.storage import get_storage
+
+'''
+Jobs for audio operations that take too long to hold a request open for.
+
+Pitch shift, time stretch and the ML functions on a full length track can take
+most of a function's timeout while the client waits on the connection. A job
+runs the same handler later instead:
+
+    submit      the input is written to storage (see audio_common.storage), a job
+                record is made and the job id queued, the client gets the id back
+    worker      takes the job, runs the operation's handler on an event naming
+                the input object (and an output object for operations that make
+                audio) and stores the handler's answer in the record
+    status      the record: state, step, queue position or time running, result
+
+A record is JSON:
+    {"job_id", "operation", "state": queued|running|done|failed, "step",
+     "submitted_at", "started_at", "finished_at" (unix seconds),
+     "queue_position" (queued only), "timings": {"queue_ms", "run_ms", "total_ms",
+     and the handler's own stages from its Server-Timing header as handler_<stage>},
+     "status_code", "result" (the handler's JSON body) or "error"}
+
+Queue and store are adapters like storage's, the local ones need no cloud
+services:
+    FileJobStore    a JSON file per job under AUDIO_JOB_ROOT (default /tmp/audio_jobs),
+                    written to a temporary file and renamed so a reader never sees
+                    half a record
+    LocalQueue      a process pool of AUDIO_JOB_WORKERS processes (default the CPU
+                    count), so a job does not hold the GIL of the process serving
+                    requests. Workers are spawned rather than forked, the serving
+                    process has threads (the server's pool, the micro-batcher,
+                    TensorFlow's) and a fork taken while one holds a lock can
+                    deadlock the child, so workers are configured from the
+                    environment like the functions. A job whose worker dies (run
+                    out of memory on a long track) is marked failed and the
+                    broken pool is replaced. Jobs queued when the process stops
+                    are not picked up again.
+
+Lambda has no /dev/shm so the process pool only runs locally (see
+audio_jobs and the local server), a cloud deployment would put an SQS queue and
+a worker function behind the same submit and status calls.
+'''
+
+JOB_ROOT = os.environ.get("AUDIO_JOB_ROOT", os.path.join("/tmp", "audio_jobs"))
+JOB_WORKERS = int(os.environ.get("AUDIO_JOB_WORKERS", os.cpu_count() or 1))
+# Bucket the inputs and outputs of jobs are kept in
+JOB_BUCKET = os.environ.get("AUDIO_JOB_BUCKET", "jobs")
+
+# operation -> (handler module, handler function, whether it makes audio)
+OPERATIONS = {
+    "pitch_shift": ("audio_pitch_shift.lambda_function", "lambda_handler", True),
+    "time_stretch": ("audio_time_stretch.lambda_function", "lambda_handler", True),
+    "pitch_time": ("audio_pitch_time.lambda_function", "lambda_handler", True),
+    "pipeline": ("audio_pipeline.lambda_function", "handler", True),
+    "genre": ("audio_genre.lambda_function", "handler", False),
+    "instrument": ("audio_instrument_detection.lambda_function", "handler", False),
+    "tagging": ("audio_tagging.lambda_function", "handler", False),
+    "energy": ("audio_energy.lambda_function", "lambda_handler", False),
+    "length": ("audio_length.lambda_function", "lambda_handler", False),
+    "metadata": ("audio_metadata.lambda_function", "lambda_handler", False),
+}
+
+
+class FileJobStore:
+    '''Job records as JSON files under root'''
+
+    def __init__(self, root=JOB_ROOT):
+        self.root = root
+
+    def path(self, job_id):
+        # Ids are made by new_job_id, anything else cannot name a record
+        if not isinstance(job_id, str) or len(job_id) != 32 or not all(c in "0123456789abcdef" for c in job_id):
+            raise ValueError("job_id must be a job id from a submit call")
+        return os.path.join(self.root, f"{job_id}.json")
+
+    def put(self, record):
+        os.makedirs(self.root, exist_ok=True)
+        path = self.path(record["job_id"])
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(record, f)
+        os.replace(temporary, path)
+
+    def get(self, job_id):
+        '''The record, None if there is no such job'''
+        try:
+            with open(self.path(job_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def update(self, job_id, **fields):
+        '''Change fields of a record, only the job's worker writes to it once it is queued'''
+        record = self.get(job_id)
+        record.update(fields)
+        self.put(record)
+        return record
+
+    def queued_before(self, record):
+        '''Number of queued jobs submitted before record'''
+        count = 0
+        for name in os.listdir(self.root):
+            if not name.endswith(".json"):
+                continue
+            other = self.get(name[:-5])
+            if other and other["state"] == "queued" and other["submitted_at"] < record["submitted_at"]:
+                count += 1
+        return count
+
+
+class LocalQueue:
+    '''Jobs run by a pool of spawned worker processes, made on first submit'''
+
+    def __init__(self, workers=JOB_WORKERS, store_root=JOB_ROOT):
+        self.workers = workers
+        self.store_root = store_root
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self.pool
+
+    def submit(self, job_id):
+        pool = self.get_pool()
+        try:
+            future = pool.submit(run_job, job_id, self.store_root)
+        except BrokenProcessPool:
+            # A worker died since the last job, the pool's callbacks may not have replaced it yet
+            self.replace(pool)
+            pool = self.get_pool()
+            future = pool.submit(run_job, job_id, self.store_root)
+        future.add_done_callback(lambda future: self.done(job_id, pool, future))
+        return future
+
+    def done(self, job_id, pool, future):
+        '''A job's worker call is over, record anything that went wrong outside the handler'''
+        error = RuntimeError("job was cancelled") if future.cancelled() else future.exception()
+        if error is None:
+            return
+        store = FileJobStore(self.store_root)
+        record = store.get(job_id)
+        if record is not None and record["state"] not in ("done", "failed"):
+            finished_at = time.time()
+            timings = dict(record["timings"], total_ms=round((finished_at - record["submitted_at"]) * 1000, 3))
+            store.update(job_id, state="failed", step="finished", finished_at=finished_at, timings=timings,
+                         error=f"worker failed: {error!r}")
+        if isinstance(error, BrokenProcessPool):
+            self.replace(pool)
+
+    def replace(self, pool):
+        '''Drop a broken pool, the next submit makes a new one'''
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+        pool.shutdown(wait=False)
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+
+default_store = None
+default_queue = None
+
+
+def get_store():
+    global default_store
+    if default_store is None:
+        default_store = FileJobStore()
+    return default_store
+
+
+def get_queue():
+    global default_queue
+    if default_queue is None:
+        default_queue = LocalQueue(store_root=get_store().root)
+    return default_queue
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+def submit(operation, parameters=None, headers=None, audio=None, input_reference=None, timer=None):
+    '''
+    Input: operation (see OPERATIONS), its query parameters and request headers,
+           and the audio (bytes-like) or (bucket, key) of an object already in storage
+    Output: the new job record
+
+    Audio is written to JOB_BUCKET as <job id>/input. Operations that make audio
+    write it to JOB_BUCKET as <job id>/output.<ext> unless output_bucket is given.
+    Raises ValueError with a message for the client for an unknown operation or
+    output format.
+    '''
+    if operation not in OPERATIONS:
+        raise ValueError(f"operation parameter must be one of: {', '.join(OPERATIONS)}")
+    job_id = new_job_id()
+    parameters = dict(parameters or {})
+    parameters.pop("operation", None)
+    if OPERATIONS[operation][2] and "output_bucket" not in parameters:
+        output_format, _ = negotiate(parameters, headers)
+        parameters.update(output_bucket=JOB_BUCKET, output_key=f"{job_id}/output.{FILE_EXTENSIONS[output_format]}")
+
+    if input_reference is None:
+        input_reference = (JOB_BUCKET, f"{job_id}/input")
+        with stage(timer, "storage"):
+            with get_storage().writer(*input_reference) as f:
+                f.write(audio)
+    parameters.update(input_bucket=input_reference[0], input_key=input_reference[1])
+
+    record = {
+        "job_id": job_id,
+        "operation": operation,
+        "parameters": parameters,
+        "headers": dict(headers or {}),
+        "state": "queued",
+        "step": "queued",
+        "submitted_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "timings": {},
+    }
+    get_store().put(record)
+    get_queue().submit(job_id)
+    return record
+
+
+def status(job_id):
+    '''The job record for the client, None if there is no such job. Raises ValueError for a malformed id'''
+    store = get_store()
+    record = store.get(job_id)
+    if record is None:
+        return None
+    record.pop("headers", None)
+    if record["state"] == "queued":
+        record["queue_position"] = store.queued_before(record)
+    elif record["state"] == "running":
+        record["timings"]["elapsed_ms"] = round((time.time() - record["started_at"]) * 1000, 3)
+    return record
+
+
+def run_job(job_id, store_root=JOB_ROOT):
+    '''Worker: run a queued job's handler and store what it answered'''
+    store = FileJobStore(store_root)
+    record = store.get(job_id)
+    started_at = time.time()
+    store.update(job_id, state="running", step="loading", started_at=started_at,
+                 timings={"queue_ms": round((started_at - record["submitted_at"]) * 1000, 3)})
+
+    timer = StageTimer()
+    try:
+        module, function, _ = OPERATIONS[record["operation"]]
+        with timer.stage("load"):
+            handler = getattr(importlib.import_module(module), function)
+        store.update(job_id, step="running")
+        with timer.stage("run"):
+            response = handler({"queryStringParameters": record["parameters"], "headers": record["headers"]}, None)
+    except Exception as e:
+        finish(store, job_id, started_at, timer, state="failed", error=str(e))
+        return
+
+    body = response.get("body")
+    try:
+        result = json.loads(body) if isinstance(body, str) else body
+    except ValueError:
+        result = body
+    # The handler's own stages, see audio_common.timing
+    stages = parse_server_timing((response.get("headers") or {}).get("Server-Timing"))
+    if response.get("statusCode") == 200:
+        finish(store, job_id, started_at, timer, stages, state="done", status_code=200, result=result)
+    else:
+        finish(store, job_id, started_at, timer, stages, state="failed", status_code=response.get("statusCode"),
+               error=result)
+
+
+def finish(store, job_id, started_at, timer, stages=None, **fields):
+    '''Store the outcome of a job with its timings'''
+    finished_at = time.time()
+    record = store.get(job_id)
+    timings = dict(record["timings"], **timer.report())
+    timings.update({f"handler_{name}": ms for name, ms in (stages or {}).items()})
+    timings["run_ms"] = round((finished_at - started_at) * 1000, 3)
+    timings["total_ms"] = round((finished_at - record["submitted_at"]) * 1000, 3)
+    store.update(job_id, step="finished", finished_at=finished_at, timings=timings, **fields)
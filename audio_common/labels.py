@@ -1,4 +1,26 @@
-labels = [
+import numpy as np
+
+'''
+Class labels of the classifier heads, in the order of the model outputs.
+
+https://essentia.upf.edu/models.html
+genre_discogs400-discogs-effnet-1 labels are "Parent---Child" Discogs styles,
+mtg_jamendo_instrument-discogs-effnet-1 labels are instruments.
+
+Each list is wrapped once at import in a LabelSet (GENRES, INSTRUMENTS) holding
+the label -> index map and, for the genres, the parent genre of every label. The
+handlers keep activations as numpy arrays and only build a dict for the n labels
+they return:
+
+    GENRES.top(activations, n)          {label: activation} for the n largest
+    GENRES.top_parents(activations, n)  the same for parent genres
+    GENRES.parent_scores(activations)   activation of every parent genre
+
+Every method takes one track (labels,) or a matrix of tracks (tracks, labels),
+for a matrix the dicts come back as a list, one per track.
+'''
+
+GENRE_LABELS = [
     "Blues---Boogie Woogie",
     "Blues---Chicago Blues",
     "Blues---Country Blues",
@@ -399,4 +421,142 @@ labels = [
     "Stage & Screen---Score",
     "Stage & Screen---Soundtrack",
     "Stage & Screen---Theme",
-]
\ No newline at end of file
+]
+
+INSTRUMENT_LABELS = [
+    "accordion",
+    "acousticbassguitar",
+    "acousticguitar",
+    "bass",
+    "beat",
+    "bell",
+    "bongo",
+    "brass",
+    "cello",
+    "clarinet",
+    "classicalguitar",
+    "computer",
+    "doublebass",
+    "drummachine",
+    "drums",
+    "electricguitar",
+    "electricpiano",
+    "flute",
+    "guitar",
+    "harmonica",
+    "harp",
+    "horn",
+    "keyboard",
+    "oboe",
+    "orchestra",
+    "organ",
+    "pad",
+    "percussion",
+    "piano",
+    "pipeorgan",
+    "rhodes",
+    "sampler",
+    "saxophone",
+    "strings",
+    "synthesizer",
+    "trombone",
+    "trumpet",
+    "viola",
+    "violin",
+    "voice",
+]
+
+
+def top_n(activations, n):
+    '''
+    Indices of the n largest activations along the last axis, largest first.
+    Ties keep label order, as a stable sort of the whole row would. n is from 0
+    (no labels) to one less than the number of labels.
+    '''
+    activations = np.asarray(activations)
+    assert 0 <= n < activations.shape[-1], 'N must be less than the number of predictions'
+    if n == 0:
+        return np.zeros(activations.shape[:-1] + (0,), dtype=np.intp)
+    indices = np.argpartition(-activations, n - 1, axis=-1)[..., :n]
+    indices.sort(axis=-1)
+    values = np.take_along_axis(activations, indices, axis=-1)
+    order = np.argsort(-values, axis=-1, kind='stable')
+    return np.take_along_axis(indices, order, axis=-1)
+
+
+def check_top_n(n, count, parameter="top_n parameter"):
+    '''Raise ValueError with a message for the client unless top_n takes n for count labels'''
+    if not 0 <= n < count:
+        raise ValueError(f"{parameter} must be an integer from 0 to {count - 1}")
+
+
+def top_items(predictions, n):
+    '''Top n of a {label: activation} dict, largest first'''
+    assert 0 <= n < len(predictions), 'N must be less than the number of predictions'
+    names = list(predictions)
+    values = np.fromiter(predictions.values(), dtype=np.float64, count=len(names))
+    return {names[i]: predictions[names[i]] for i in top_n(values, n)}
+
+
+class LabelSet:
+    '''
+    Labels of one classifier head in model output order.
+
+    names: label per output, index: label -> output
+    With a separator ("Parent---Child" labels) also:
+        parents: parent names in order of first appearance
+        parent_index: parent of every output as an index into parents
+    '''
+
+    def __init__(self, names, separator=None):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        assert len(self.index) == len(self.names), 'Labels must be unique'
+        self.parents = None
+        if separator is not None:
+            parent_names = [name.split(separator, 1)[0] for name in self.names]
+            self.parents = list(dict.fromkeys(parent_names))
+            parent_position = {parent: i for i, parent in enumerate(self.parents)}
+            self.parent_index = np.array([parent_position[parent] for parent in parent_names])
+            # Outputs grouped by parent so every parent is one contiguous segment for reduceat
+            self._segment_order = np.argsort(self.parent_index, kind='stable')
+            if np.array_equal(self._segment_order, np.arange(len(self.names))):
+                self._segment_order = None  # Already grouped, as the Discogs styles are
+            self._segment_starts = np.searchsorted(np.sort(self.parent_index), np.arange(len(self.parents)))
+
+    def __len__(self):
+        return len(self.names)
+
+    def _dicts(self, names, activations, n):
+        activations = np.asarray(activations)
+        indices = top_n(activations, n)
+        if activations.ndim == 1:
+            return {names[i]: float(activations[i]) for i in indices}
+        values = np.take_along_axis(activations, indices, axis=-1)
+        return [{names[i]: float(value) for i, value in zip(row, row_values)}
+                for row, row_values in zip(indices, values)]
+
+    def top(self, activations, n):
+        '''{label: activation} for the n largest activations'''
+        assert 0 <= n < len(self.names), 'N must be less than the number of predictions'
+        return self._dicts(self.names, activations, n)
+
+    def parent_scores(self, activations, reduce=np.maximum):
+        '''
+        Score of every parent from its labels, by default its highest activation.
+        reduce is any numpy ufunc with reduceat, np.add sums them instead.
+        '''
+        assert self.parents is not None, 'Labels have no parents'
+        activations = np.asarray(activations)
+        if self._segment_order is not None:
+            activations = activations[..., self._segment_order]
+        return reduce.reduceat(activations, self._segment_starts, axis=-1)
+
+    def top_parents(self, activations, n, reduce=np.maximum):
+        '''{parent: score} for the n highest scoring parents'''
+        assert 0 <= n < len(self.parents), 'N must be less than the number of parent predictions'
+        return self._dicts(self.parents, self.parent_scores(activations, reduce), n)
+
+
+GENRES = LabelSet(GENRE_LABELS, separator="---")
+INSTRUMENTS = LabelSet(INSTRUMENT_LABELS)
@@ -0,0 +1,147 @@
+import os
+import threading
+from time import perf_counter_ns
+
+'''
+Models kept for the lifetime of the container.
+
+get_genres and get_instruments used to build es.TensorflowPredictEffnetDiscogs
+and es.TensorflowPredict2D inside the request, so every invocation read and
+initialised the graphs from disk again. Functions now register how to build each
+model when lambda_function is imported and fetch it from the registry when
+needed. A model is built the first time it is asked for (or during the init
+phase with preload) and the same object is returned to every later request.
+
+Usage:
+    registry.register("effnet", lambda: es.TensorflowPredictEffnetDiscogs(...))
+    if preload_enabled():
+        registry.preload()
+    ...
+    model = registry.get("effnet")
+
+Essentia algorithms are not safe to call from several threads at once, and the
+local server and the embedding micro-batcher call the same model from several
+threads. get() hands back the model behind a SerialModel, which lets one call
+through at a time, each model having its own lock so different models still
+run side by side.
+'''
+
+
+class SerialModel:
+    '''
+    A model that runs one call at a time.
+
+    Calling it calls the model while holding the model's lock, anything else is
+    looked up on the model.
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self.lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        with self.lock:
+            return self.model(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+class ModelRegistry:
+    '''
+    Lazily built, shared models by name.
+
+    report() gives, for each registered model, whether it is loaded, how long the
+    load took (ms) and the number of get() calls that found it already loaded
+    (hits) or had to load it (misses).
+    '''
+
+    def __init__(self):
+        self.factories = {}
+        self.preloaded = []
+        self.models = {}
+        self.load_ns = {}
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, factory, preload=True):
+        '''
+        Register a function that builds a model. Registering a name that is
+        already known does nothing so functions sharing a model can both register it.
+        preload=False leaves the model out of preload() unless it is named.
+        '''
+        with self.lock:
+            if name not in self.factories:
+                self.factories[name] = factory
+                if preload:
+                    self.preloaded.append(name)
+                self.hits[name] = 0
+                self.misses[name] = 0
+
+    def get(self, name):
+        '''Return the model as a SerialModel, building it if this is the first time it is used'''
+        if name not in self.factories:
+            raise KeyError(f"No model registered as {name}")
+
+        model = self.models.get(name)
+        if model is not None:
+            self.hits[name] += 1
+            return model
+
+        with self.lock:
+            # Another thread may have loaded it while we waited
+            if name in self.models:
+                self.hits[name] += 1
+                return self.models[name]
+            self.misses[name] += 1
+            start = perf_counter_ns()
+            model = SerialModel(self.factories[name]())
+            self.load_ns[name] = perf_counter_ns() - start
+            self.models[name] = model
+        return model
+
+    def preload(self, names=None):
+        '''Build the named models (the ones registered to be preloaded by default) without counting a request'''
+        for name in list(self.preloaded) if names is None else names:
+            if name not in self.models:
+                self.get(name)
+                self.misses[name] -= 1
+
+    def report(self):
+        '''Load time (ms) and hit/miss counts of every registered model'''
+        return {
+            name: {
+                "loaded": name in self.models,
+                "load_ms": round(self.load_ns[name] / 1e6, 3) if name in self.load_ns else None,
+                "hits": self.hits[name],
+                "misses": self.misses[name],
+            }
+            for name in self.factories
+        }
+
+    def clear(self):
+        '''Drop the loaded models and counters, the registered factories are kept'''
+        with self.lock:
+            self.models.clear()
+            self.load_ns.clear()
+            for name in self.factories:
+                self.hits[name] = 0
+                self.misses[name] = 0
+
+
+def preload_enabled():
+    '''
+    Whether to build the models while the module is imported.
+
+    PRELOAD_MODELS=1 or 0 decides, otherwise models are preloaded on lambda (so
+    the init phase pays for them) and loaded on first use everywhere else (tests).
+    '''
+    setting = os.environ.get("PRELOAD_MODELS")
+    if setting is not None:
+        return setting == "1"
+    return "AWS_LAMBDA_FUNCTION_NAME" in os.environ
+
+
+# Shared by everything imported in the same process
+registry = ModelRegistry()
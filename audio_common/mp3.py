@@ -0,0 +1,233 @@
+import struct
+
+'''
+Reading MPEG audio (mp3) structure straight from the raw bytes, no decoding.
+
+https://www.codeproject.com/Articles/8295/MPEG-Audio-Frame-Header
+http://gabriel.mp3-tech.org/mp3infotag.html
+
+Every mp3 is a run of frames, each starting with a 4 byte header that gives the
+bitrate, sample rate, channel mode and so the length of the frame. Encoders put a
+Xing/Info (or Fraunhofer VBRI) header in the first frame that already holds the
+frame count, so the duration can be read without touching the rest of the file.
+'''
+
+# Bitrates in kbps indexed by [version is MPEG1][layer][bitrate index]
+BITRATES = {
+    True: {
+        1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    },
+    False: {
+        1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    },
+}
+
+# Sample rates indexed by the 2 version bits, 0b01 is reserved
+SAMPLE_RATES = {
+    0b11: (44100, 48000, 32000),  # MPEG 1
+    0b10: (22050, 24000, 16000),  # MPEG 2
+    0b00: (11025, 12000, 8000),   # MPEG 2.5
+}
+VERSIONS = {0b11: "1", 0b10: "2", 0b00: "2.5"}
+LAYERS = {0b11: 1, 0b10: 2, 0b01: 3}
+CHANNEL_MODES = ("stereo", "joint stereo", "dual channel", "mono")
+
+# Encoders that write the LAME extension (with encoder delay and padding) after the Xing header
+LAME_ENCODERS = (b"LAME", b"Lavf", b"Lavc")
+
+# Bytes that may be scanned past while looking for the first frame
+MAX_SYNC_SCAN = 64 * 1024
+
+
+def id3v2_size(data, offset=0):
+    '''Return the size of the ID3v2 tag at offset (header included), 0 if there is none'''
+    if data[offset:offset + 3] != b"ID3" or len(data) < offset + 10:
+        return 0
+    flags = data[offset + 5]
+    # Size is 4 syncsafe bytes, 7 bits each
+    size = 0
+    for byte in data[offset + 6:offset + 10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if flags & 0x10 else 0
+    return 10 + size + footer
+
+
+def parse_frame_header(data, offset):
+    '''
+    Parse the 4 byte frame header at offset.
+
+    Returns a dict describing the frame or None if the bytes are not a valid header.
+    Free format bitrates are treated as invalid because the frame length is unknown.
+    '''
+    if offset + 4 > len(data):
+        return None
+    header = struct.unpack_from(">I", data, offset)[0]
+    if header >> 21 != 0x7FF:
+        return None
+
+    version_bits = (header >> 19) & 0b11
+    layer_bits = (header >> 17) & 0b11
+    bitrate_index = (header >> 12) & 0b1111
+    sample_rate_index = (header >> 10) & 0b11
+    if version_bits == 0b01 or layer_bits == 0 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    mpeg1 = version_bits == 0b11
+    layer = LAYERS[layer_bits]
+    bitrate = BITRATES[mpeg1][layer][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version_bits][sample_rate_index]
+    padding = (header >> 9) & 1
+    channel_mode = CHANNEL_MODES[(header >> 6) & 0b11]
+
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 2 or mpeg1:
+        samples = 1152
+        length = 144 * bitrate // sample_rate + padding
+    else:
+        samples = 576
+        length = 72 * bitrate // sample_rate + padding
+
+    return {
+        "version": VERSIONS[version_bits],
+        "layer": layer,
+        "bitrate": bitrate,
+        "sample_rate": sample_rate,
+        "channel_mode": channel_mode,
+        "channels": 1 if channel_mode == "mono" else 2,
+        "padding": padding,
+        "samples": samples,
+        "length": length,
+    }
+
+
+def find_first_frame(data):
+    '''
+    Return (offset, header) of the first audio frame, skipping any ID3v2 tag.
+
+    A sync word is only accepted if the next frame also starts with a header
+    of the same version, layer and sample rate, so junk that happens to look
+    like a header is skipped. Returns (None, None) if no frame is found.
+    '''
+    start = id3v2_size(data)
+    # At most MAX_SYNC_SCAN bytes are searched, copied so a memoryview body can be searched too
+    scan = bytes(data[start:start + MAX_SYNC_SCAN])
+    position = scan.find(b"\xff")
+    while position != -1:
+        offset = start + position
+        header = parse_frame_header(data, offset)
+        if header is not None:
+            following = parse_frame_header(data, offset + header["length"])
+            last_frame = offset + header["length"] >= len(data)
+            if last_frame or (following is not None and same_stream(header, following)):
+                return offset, header
+        position = scan.find(b"\xff", position + 1)
+    return None, None
+
+
+def same_stream(header, other):
+    '''Check two frame headers belong to the same stream'''
+    return (header["version"], header["layer"], header["sample_rate"]) == \
+        (other["version"], other["layer"], other["sample_rate"])
+
+
+def side_info_size(header):
+    '''Size of the layer III side information that follows the frame header'''
+    if header["version"] == "1":
+        return 17 if header["channels"] == 1 else 32
+    return 9 if header["channels"] == 1 else 17
+
+
+def read_vbr_header(data, offset, header):
+    '''
+    Read a Xing/Info or VBRI header from the frame at offset.
+
+    Returns a dict with the header "type", the number of audio "frames" and
+    the encoder "delay" and "padding" in samples, or None if there is no
+    header or it does not hold the frame count.
+    '''
+    frame = data[offset:offset + header["length"]]
+
+    xing = 4 + side_info_size(header)
+    if frame[xing:xing + 4] in (b"Xing", b"Info"):
+        flags = struct.unpack_from(">I", frame, xing + 4)[0]
+        if not flags & 0x1:
+            return None
+        frames = struct.unpack_from(">I", frame, xing + 8)[0]
+        position = xing + 12
+        if flags & 0x2:
+            position += 4  # byte count
+        if flags & 0x4:
+            position += 100  # seek table
+        if flags & 0x8:
+            position += 4  # quality
+        delay = padding = 0
+        if frame[position:position + 4] in LAME_ENCODERS and len(frame) >= position + 24:
+            gapless = int.from_bytes(frame[position + 21:position + 24], "big")
+            delay, padding = gapless >> 12, gapless & 0xFFF
+        return {"type": bytes(frame[xing:xing + 4]).decode().lower(), "frames": frames, "delay": delay, "padding": padding}
+
+    if frame[36:40] == b"VBRI":
+        frames = struct.unpack_from(">I", frame, 36 + 14)[0]
+        return {"type": "vbri", "frames": frames, "delay": 0, "padding": 0}
+
+    return None
+
+
+def is_trailing_tag(data, offset):
+    '''Check if the bytes at offset are a tag that can follow the last frame'''
+    return data[offset:offset + 3] == b"TAG" or data[offset:offset + 8] in (b"APETAGEX", b"LYRICSBE") \
+        or data[offset:offset + 3] == b"ID3"
+
+
+def get_duration_ms(data):
+    '''
+    Input: mp3 bytes
+    Output: (duration in milliseconds (float), method (string))
+
+    Reads the Xing/Info/VBRI header if the first frame has one ("xing", "info"
+    or "vbri"), otherwise walks every frame header adding up the samples
+    ("frames"). Only headers are read so memory use does not depend on the
+    length of the track.
+
+    Raises ValueError if the stream is not a well formed mp3.
+    '''
+    offset, header = find_first_frame(data)
+    if header is None:
+        raise ValueError("No MPEG audio frames found")
+
+    sample_rate = header["sample_rate"]
+
+    if header["layer"] == 3:
+        vbr_header = read_vbr_header(data, offset, header)
+        if vbr_header is not None and vbr_header["frames"]:
+            samples = vbr_header["frames"] * header["samples"] - vbr_header["delay"] - vbr_header["padding"]
+            return 1000 * max(samples, 0) / sample_rate, vbr_header["type"]
+        if vbr_header is not None:
+            # Info frame without a frame count, it holds no audio so skip it
+            offset += header["length"]
+
+    samples = 0
+    while offset < len(data):
+        frame = parse_frame_header(data, offset)
+        if frame is None:
+            if len(data) - offset < 4 or is_trailing_tag(data, offset):
+                break
+            raise ValueError(f"Lost frame sync at byte {offset}")
+        if not same_stream(header, frame):
+            raise ValueError(f"Frame at byte {offset} does not match the stream")
+        if offset + frame["length"] > len(data):
+            # Truncated last frame, the decoder drops it as well
+            break
+        samples += frame["samples"]
+        offset += frame["length"]
+
+    if samples == 0:
+        raise ValueError("No complete MPEG audio frames found")
+
+    return 1000 * samples / sample_rate, "frames"
@@ -0,0 +1,115 @@
+import numpy as np
+from audio_common.labels import top_n
+
+'''
+Fast mode for the tagging functions: classify a few windows of the track instead
+of every patch.
+
+The genre and instrument models average their activations over every patch of
+the track, so the cost of a request grows with its length. Sampling K windows
+spread over the track gives an estimate of the same mean at a fixed cost.
+
+Windows are placed at fractions of the track:
+    even: the centres of K equal strata
+    stratified: a random point in each of K strata (seeded, so repeatable)
+
+With stable_n set more windows are added, one in the middle of every gap, until
+the top n labels (in order) come out the same twice in a row or max_windows is
+reached. A track too short for the windows to be worth it is analysed whole.
+
+How often the fast top n matches full analysis has not been measured yet,
+benchmarks/eval_fast_mode.py reports it given the graphs and a set of tracks.
+'''
+
+WINDOW_SECONDS = 6
+DEFAULT_WINDOWS = 8
+MAX_WINDOWS = 32
+STRATEGIES = ("even", "stratified")
+
+
+def initial_positions(count, strategy="even", rng=None):
+    '''Fractions of the track (0 start, 1 end) for the first count windows'''
+    assert strategy in STRATEGIES, f"strategy must be one of: {', '.join(STRATEGIES)}"
+    offsets = np.full(count, 0.5) if strategy == "even" else rng.random(count)
+    return (np.arange(count) + offsets) / count
+
+
+def refine_positions(positions, strategy="even", rng=None):
+    '''A new position inside every gap between positions (and the ends of the track)'''
+    edges = np.concatenate([[0.0], np.sort(positions), [1.0]])
+    low, width = edges[:-1], np.diff(edges)
+    offsets = np.full(len(low), 0.5) if strategy == "even" else 0.25 + 0.5 * rng.random(len(low))
+    return low + width * offsets
+
+
+def cut_windows(audio, positions, window):
+    '''Windows of window samples starting at fractions of the part of audio a window can start in'''
+    starts = np.round(np.asarray(positions) * (len(audio) - window)).astype(int)
+    return [audio[start:start + window] for start in starts]
+
+
+def sampled_activations(audio, sample_rate, predict, windows=DEFAULT_WINDOWS, strategy="even", stable_n=None,
+                        max_windows=MAX_WINDOWS, window_seconds=WINDOW_SECONDS, seed=0):
+    '''
+    Input: mono audio, its sample rate, predict(list of windows) -> activations (rows, labels)
+    Output: (mean activation of every label, windows used or None if the track was analysed whole)
+    '''
+    assert windows > 0, "windows must be positive"
+    window = int(window_seconds * sample_rate)
+    # Once the windows would cover the track there is nothing to save
+    if len(audio) <= window * windows:
+        return np.mean(predict([audio]), axis=0), None
+
+    rng = np.random.default_rng(seed)
+    positions = initial_positions(windows, strategy, rng)
+    activations = predict(cut_windows(audio, positions, window))
+    total, rows = activations.sum(axis=0, dtype=np.float64), len(activations)
+    used = windows
+
+    if stable_n is not None:
+        previous = top_n(total / rows, stable_n)
+        while used < max_windows and len(audio) > window * used:
+            new_positions = refine_positions(positions, strategy, rng)[:max_windows - used]
+            activations = predict(cut_windows(audio, new_positions, window))
+            total += activations.sum(axis=0, dtype=np.float64)
+            rows += len(activations)
+            positions = np.concatenate([positions, new_positions])
+            used += len(new_positions)
+
+            ranking = top_n(total / rows, stable_n)
+            if np.array_equal(ranking, previous):
+                break
+            previous = ranking
+
+    return (total / rows).astype(np.float32), used
+
+
+def fast_mode_options(parameters, n):
+    '''
+    Query parameters -> keyword arguments for sampled_activations, None for full analysis
+
+        mode: full (default) or fast
+        windows: windows to start with (default DEFAULT_WINDOWS)
+        strategy: even (default) or stratified
+        stable: true to add windows until the top n labels stop changing
+
+    Raises ValueError with a message for the client if a parameter is invalid.
+    '''
+    mode = parameters.get("mode", "full")
+    if mode not in ("full", "fast"):
+        raise ValueError("mode parameter must be full or fast")
+    if mode == "full":
+        return None
+
+    try:
+        windows = int(parameters.get("windows", DEFAULT_WINDOWS))
+    except (TypeError, ValueError):
+        windows = 0
+    if not 0 < windows <= MAX_WINDOWS:
+        raise ValueError(f"windows parameter must be an integer from 1 to {MAX_WINDOWS}")
+    strategy = parameters.get("strategy", "even")
+    if strategy not in STRATEGIES:
+        raise ValueError(f"strategy parameter must be one of: {', '.join(STRATEGIES)}")
+    stable = str(parameters.get("stable", "false")).lower() == "true"
+
+    return {"windows": windows, "strategy": strategy, "stable_n": n if stable else None}
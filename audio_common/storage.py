@@ -0,0 +1,305 @@
+import os
+import mmap
+import uuid
+import threading
+from contextlib import contextmanager
+from audio_common.timing import stage
+from audio_common.body import read_body, accepts_body, is_raw
+from audio_common.decode import is_stream
+from audio_common.encode import encode_to, content_type, BlockEncoder, FILE_EXTENSIONS
+
+'''
+Audio in and out of an object store instead of the request and response body.
+
+API Gateway caps a body at 10 MB (6 MB for a lambda response) and Step Functions
+passes state as JSON of at most 256 KB, which is what limited the pitch and time
+chain demo to about 5 s of audio, and every byte went through base64 both ways.
+Any audio function can instead be given an object reference with the query
+parameters
+
+    input_bucket, input_key      read the audio from this object, no body needed
+    output_bucket, output_key    write the audio output to this object and answer
+                                 with {"bucket", "key", "content_type"} only;
+                                 output_key defaults to <function>/<random>.<ext>
+
+Storage goes through an adapter chosen with AUDIO_STORAGE:
+    local   files under AUDIO_STORAGE_ROOT/<bucket>/<key> (default /tmp/audio_storage),
+            runs and tests offline
+    s3      Amazon S3 through boto3 (imported only when used)
+
+Objects are streamed rather than read whole: an input is handed to the decoder as
+a stream (a local file becomes ffmpeg's stdin, an S3 body is copied in chunks,
+see audio_common.decode) and ffmpeg writes an encoded output straight into the
+object (see audio_common.encode.encode_to). Readers that need the whole file at
+once (the mp3 and ID3 readers, the embedding cache's content hash) get a memory
+map of a local object, so it is paged in from disk rather than copied.
+
+Adapters implement:
+    exists(bucket, key)                     whether there is an object
+    open(bucket, key)                       readable binary stream, the caller closes it
+    read(bucket, key)                       the whole object as a bytes-like object
+    writer(bucket, key, content_type)       context manager giving a writable binary stream,
+                                            the object only appears once it is closed and
+                                            not at all if the with block raises
+'''
+
+STORAGE = os.environ.get("AUDIO_STORAGE", "local")
+STORAGE_ROOT = os.environ.get("AUDIO_STORAGE_ROOT", os.path.join("/tmp", "audio_storage"))
+
+
+def check_reference(bucket, key):
+    '''Raise ValueError with a message for the client unless bucket and key are usable names'''
+    if not isinstance(bucket, str) or not bucket or "/" in bucket or bucket in (".", ".."):
+        raise ValueError("bucket must be a name without /")
+    if not isinstance(key, str) or not key or key.startswith("/") or \
+            any(part in ("", ".", "..") for part in key.split("/")):
+        raise ValueError("key must be a relative path without empty, . or .. parts")
+
+
+class LocalStorage:
+    '''Objects as files under root/bucket/key'''
+
+    def __init__(self, root=STORAGE_ROOT):
+        self.root = root
+
+    def path(self, bucket, key):
+        check_reference(bucket, key)
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def open(self, bucket, key):
+        return open(self.path(bucket, key), "rb")
+
+    def read(self, bucket, key):
+        with self.open(bucket, key) as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            # The map stays valid after the file is closed, a view of it is bytes-like for every reader
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def exists(self, bucket, key):
+        return os.path.isfile(self.path(bucket, key))
+
+    @contextmanager
+    def writer(self, bucket, key, content_type=None):
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so a reader never sees half an object
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary, "wb") as f:
+                yield f
+            os.replace(temporary, path)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+
+class S3Storage:
+    '''Objects in Amazon S3, uploads are streamed from a pipe as a multipart upload'''
+
+    def __init__(self, client=None):
+        if client is None:
+            # Imported here so nothing else needs boto3
+            import boto3
+            client = boto3.client("s3")
+        self.client = client
+
+    def open(self, bucket, key):
+        check_reference(bucket, key)
+        return self.client.get_object(Bucket=bucket, Key=key)["Body"]
+
+    def exists(self, bucket, key):
+        check_reference(bucket, key)
+        # Imported here so nothing else needs botocore
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                return False
+            raise
+        return True
+
+    def read(self, bucket, key):
+        body = self.open(bucket, key)
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    @contextmanager
+    def writer(self, bucket, key, content_type=None):
+        check_reference(bucket, key)
+        read_end, write_end = os.pipe()
+        aborted = threading.Event()
+        errors = []
+
+        def upload():
+            with os.fdopen(read_end, "rb") as source:
+                try:
+                    extra = {"ContentType": content_type} if content_type else None
+                    self.client.upload_fileobj(UploadSource(source, aborted), bucket, key, ExtraArgs=extra)
+                except Exception as e:
+                    errors.append(e)
+                    source.read()  # Drain the pipe so the writer is not blocked
+
+        uploader = threading.Thread(target=upload, daemon=True)
+        uploader.start()
+        sink = os.fdopen(write_end, "wb")
+        try:
+            yield sink
+        except BaseException:
+            # Set before the pipe is closed so the uploader fails rather than finishing on the end of file
+            aborted.set()
+            raise
+        finally:
+            try:
+                sink.close()
+            finally:
+                uploader.join()
+        if errors:
+            raise errors[0]
+
+
+class UploadSource:
+    '''
+    The read end of S3Storage.writer's pipe as the uploader sees it.
+
+    Once the writer has failed every read raises, so upload_fileobj fails and
+    aborts the multipart upload instead of completing it with what was written
+    so far.
+    '''
+
+    def __init__(self, source, aborted):
+        self.source = source
+        self.aborted = aborted
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        if self.aborted.is_set():
+            raise IOError("upload aborted, writing the object failed")
+        return data
+
+
+ADAPTERS = {"local": LocalStorage, "s3": S3Storage}
+default = None
+
+
+def get_storage():
+    '''The adapter chosen by AUDIO_STORAGE, made on first use'''
+    global default
+    if default is None:
+        assert STORAGE in ADAPTERS, f"AUDIO_STORAGE must be one of: {', '.join(ADAPTERS)}"
+        default = ADAPTERS[STORAGE]()
+    return default
+
+
+def input_reference(event):
+    '''
+    (bucket, key) of the object named by input_bucket and input_key, None if the
+    audio is in the body. Raises ValueError for an incomplete or invalid reference.
+    '''
+    parameters = event.get("queryStringParameters") or {}
+    bucket, key = parameters.get("input_bucket"), parameters.get("input_key")
+    if bucket is None and key is None:
+        return None
+    if bucket is None or key is None:
+        raise ValueError("input_bucket and input_key parameters must be given together")
+    check_reference(bucket, key)
+    return bucket, key
+
+
+def output_reference(parameters, prefix, output_format):
+    '''
+    (bucket, key) to write the audio output to, None to return it in the body.
+    Raises ValueError for an invalid reference.
+    '''
+    parameters = parameters or {}
+    bucket, key = parameters.get("output_bucket"), parameters.get("output_key")
+    if bucket is None:
+        if key is not None:
+            raise ValueError("output_key parameter needs an output_bucket")
+        return None
+    if key is None:
+        key = f"{prefix}/{uuid.uuid4().hex}.{FILE_EXTENSIONS[output_format]}"
+    check_reference(bucket, key)
+    return bucket, key
+
+
+def has_input(event):
+    '''Whether the request has audio, a body or (part of) an object reference'''
+    parameters = event.get("queryStringParameters") or {}
+    return "body" in event or "input_bucket" in parameters or "input_key" in parameters
+
+
+def accepts_input(event, encoded=None):
+    '''Whether the request's audio can be read, an object reference or a body read_body takes'''
+    parameters = event.get("queryStringParameters") or {}
+    if "input_bucket" in parameters or "input_key" in parameters:
+        return True
+    if encoded is None:
+        return accepts_body(event)
+    return is_raw(event.get("body")) or bool(encoded)
+
+
+def check_input(event):
+    '''
+    Validate the request's object reference before anything runs.
+    Returns (bucket, key) or None when the audio is in the body.
+    Raises ValueError for an invalid reference, LookupError if the object does not exist.
+    '''
+    reference = input_reference(event)
+    if reference is not None and not get_storage().exists(*reference):
+        raise LookupError(f"input object {reference[0]}/{reference[1]} does not exist")
+    return reference
+
+
+def read_input(event, timer=None, stream=True, encoded=None):
+    '''
+    Input: lambda event, whether the decoders will read the audio as a stream,
+           whether a string body is base64 (see audio_common.body.read_body)
+    Output: the request's audio
+
+    The body comes back as a memoryview. An object reference comes back as a
+    readable stream for the decoders (stream=True), or whole as a bytes-like
+    object for readers that need random access (stream=False). Pass the result
+    to close_input when done.
+    '''
+    reference = input_reference(event)
+    if reference is None:
+        return read_body(event, timer, encoded)
+    with stage(timer, "storage"):
+        storage = get_storage()
+        return storage.open(*reference) if stream else storage.read(*reference)
+
+
+def close_input(audio):
+    '''Close an input stream from read_input, bodies and whole objects need nothing'''
+    if is_stream(audio):
+        audio.close()
+
+
+def write_audio(reference, samples, sample_rate, output_format, bitrate=None, timer=None):
+    '''
+    Encode int16 samples into the object at reference (bucket, key).
+    Returns the JSON the function answers with in place of the audio.
+    '''
+    bucket, key = reference
+    # The content type only depends on the format, rate and channels so is known before encoding
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    media_type = content_type(output_format, sample_rate, channels)
+    # Timed as the encode, ffmpeg writes into the object as it encodes
+    with get_storage().writer(bucket, key, media_type) as output:
+        encode_to(output, samples, sample_rate, output_format, bitrate, timer)
+    return {"bucket": bucket, "key": key, "content_type": media_type}
+
+
+def write_audio_blocks(reference, blocks, sample_rate, channels, output_format, bitrate=None, timer=None):
+    '''write_audio for int16 audio handed over a block at a time (see audio_common.encode.BlockEncoder)'''
+    bucket, key = reference
+    media_type = content_type(output_format, sample_rate, channels)
+    with get_storage().writer(bucket, key, media_type) as output:
+        with BlockEncoder(output, sample_rate, channels, output_format, bitrate, timer) as encoder:
+            for block in blocks:
+                encoder.write(block)
+    return {"bucket": bucket, "key": key, "content_type": media_type}
@@ -0,0 +1,13 @@
+import numpy as np
+
+'''
+Helpers shared by the functions' unit tests.
+'''
+
+RATE = 44100
+
+
+def sine(frequency, duration, rate=RATE):
+    '''int16 sine at full scale lasting duration seconds'''
+    t = np.linspace(0, duration, int(rate * duration))
+    return (np.sin(2 * np.pi * frequency * t) * 32767).astype(np.int16)
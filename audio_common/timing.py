@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import functools
+import contextvars
+from time import perf_counter_ns
+from contextlib import contextmanager
+
+'''
+Stage timings of a request.
+
+Every handler is wrapped with timed_handler, which gives the request a
+RequestTimer and makes it the current timer while the handler runs. Handlers
+take it with request_timer() and pass it down, and stage() and note() fall back
+to it when they are given no timer, so decode, encode, storage and base64 are
+timed even where a helper was called without one. When the handler returns:
+
+    - the response gets a Server-Timing header with every stage and the total
+      (decode;dur=12.345, vocoder;dur=80.1, total;dur=101.2), which browsers show
+      next to the request and the local server passes through
+    - one JSON line is printed in CloudWatch embedded metric format, the stages
+      and the total as millisecond metrics of METRICS_NAMESPACE with the function
+      as dimension, the status code, request id and the timer's notes as
+      properties, so CloudWatch makes the metrics from the log without a
+      PutMetricData call
+
+REQUEST_TIMING=0 turns both off, a handler is then called straight through and
+request_timer() is a plain StageTimer, so all that is left is the perf_counter_ns
+pair around each stage.
+'''
+
+ENABLED = os.environ.get("REQUEST_TIMING", "1") == "1"
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "AudioAPI")
+
+
+class StageTimer:
+    '''
+    Records how long each stage of a request takes.
+
+    Usage:
+        timer = StageTimer()
+        with timer.stage("decode"):
+            ...
+        timer.report()  # {"decode": 12.345}
+
+    Times are wall clock milliseconds, a stage entered more than once is summed.
+    timer.note(name, value) keeps anything else worth reporting about the
+    request (a cache hit for example) in timer.notes.
+    '''
+
+    def __init__(self):
+        self.stages = {}
+        self.notes = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter_ns()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter_ns() - start
+            self.stages[name] = self.stages.get(name, 0) + elapsed
+
+    def note(self, name, value):
+        self.notes[name] = value
+
+    def report(self):
+        '''Return the recorded stages in milliseconds'''
+        return {name: round(ns / 1e6, 3) for name, ns in self.stages.items()}
+
+
+class RequestTimer(StageTimer):
+    '''
+    StageTimer of one handler invocation, timed from when it is made.
+
+    server_timing() and metrics() format the stages for the Server-Timing header
+    and the embedded metric log line.
+    '''
+
+    def __init__(self, function, request_id=None):
+        super().__init__()
+        self.function = function
+        self.request_id = request_id
+        self.start = perf_counter_ns()
+        self.total = None
+
+    def finish(self):
+        self.total = round((perf_counter_ns() - self.start) / 1e6, 3)
+        return self.total
+
+    def server_timing(self):
+        '''Server-Timing header value, stages in the order they first ran then the total'''
+        stages = dict(self.report(), total=self.total)
+        return ", ".join(f"{name};dur={ms}" for name, ms in stages.items())
+
+    def metrics(self, status_code=None):
+        '''The request as a CloudWatch embedded metric format record'''
+        stages = dict(self.report(), total=self.total)
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["function"]],
+                    "Metrics": [{"Name": name, "Unit": "Milliseconds"} for name in stages],
+                }],
+            },
+            "function": self.function,
+            "request_id": self.request_id,
+            "status_code": status_code,
+            "notes": self.notes,
+        }
+        record.update(stages)
+        return record
+
+
+def parse_server_timing(value):
+    '''Stages of a Server-Timing header value as {name: ms}, entries without a duration are left out'''
+    stages = {}
+    for entry in (value or "").split(","):
+        name, *parameters = [part.strip() for part in entry.split(";")]
+        for parameter in parameters:
+            if parameter.startswith("dur="):
+                try:
+                    stages[name] = float(parameter[4:])
+                except ValueError:
+                    pass
+    return stages
+
+
+current = contextvars.ContextVar("request_timer", default=None)
+
+
+def current_timer():
+    '''The timer of the request being handled, None outside a timed handler or with timing off'''
+    return current.get()
+
+
+def request_timer():
+    '''The timer for a handler to record its stages on'''
+    timer = current.get()
+    return StageTimer() if timer is None else timer
+
+
+def request_id(event, context):
+    '''Lambda's request id, or API Gateway's when called some other way (tests, the local server)'''
+    if context is not None and getattr(context, "aws_request_id", None):
+        return context.aws_request_id
+    return ((event or {}).get("requestContext") or {}).get("requestId")
+
+
+def timed_handler(function):
+    '''
+    Decorator for a lambda handler: time the request, add the Server-Timing header
+    to its response and print the embedded metric log line. function names it in
+    the metrics (AWS_LAMBDA_FUNCTION_NAME on lambda).
+    '''
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if not ENABLED:
+                return handler(event, context)
+
+            timer = RequestTimer(os.environ.get("AWS_LAMBDA_FUNCTION_NAME", function), request_id(event, context))
+            token = current.set(timer)
+            response = None
+            try:
+                response = handler(event, context)
+                return response
+            finally:
+                current.reset(token)
+                timer.finish()
+                status_code = response.get("statusCode") if isinstance(response, dict) else None
+                if isinstance(response, dict):
+                    response["headers"] = dict(response.get("headers") or {}, **{"Server-Timing": timer.server_timing()})
+                print(json.dumps(timer.metrics(status_code), default=str))
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def stage(timer, name):
+    '''Time a stage on the timer given, or the request's timer, otherwise do nothing'''
+    if timer is None:
+        timer = current.get()
+    if timer is None:
+        yield
+    else:
+        with timer.stage(name):
+            yield
+
+
+def note(timer, name, value):
+    '''Record a note on the timer given, or the request's timer'''
+    if timer is None:
+        timer = current.get()
+    if timer is not None:
+        timer.note(name, value)
@@ -0,0 +1,1338 @@
+import unittest
+import io
+import json
+import os
+import re
+import base64
+import binascii
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+import numpy as np
+from base64 import b64decode
+from audio_common import timing
+from audio_common.timing import StageTimer, RequestTimer, stage, note, timed_handler, request_timer, parse_server_timing
+from audio_common.decode import decode, resample, read_wav_f32, BlockDecoder, RESAMPLE_QUALITIES
+from audio_common.mp3 import parse_frame_header, find_first_frame, get_duration_ms, id3v2_size
+from audio_common.id3 import read_id3v2, read_id3v1
+from audio_common.energy import number_of_frames, frame_energies, average_energy, RunningEnergy
+from audio_common.vocoder import phase_vocoder, StreamingVocoder, StreamingNormaliser, overlap_gain, shift_and_stretch, speedx, PEAK_LEVEL
+from audio_common.models import ModelRegistry, preload_enabled
+from audio_common.encode import encode, encode_to, encode_blocks, BlockEncoder, negotiate, parse_accept
+from audio_common.cache import ArrayCache, AudioCache, content_key
+from audio_common import decode as decode_module
+from audio_common.batching import MicroBatcher
+from audio_common.sampling import sampled_activations, fast_mode_options, initial_positions, refine_positions
+from audio_common.labels import GENRES, INSTRUMENTS, GENRE_LABELS, LabelSet, top_n, top_items, check_top_n
+from audio_common.body import Base64Buffer, read_body, accepts_body
+from audio_common import body
+from audio_common import storage
+from audio_common.storage import LocalStorage, check_input, read_input, close_input, output_reference, write_audio, write_audio_blocks
+
+try:
+    from essentia import standard as es
+except ImportError:
+    es = None
+
+'''
+Run from the repository root: python -m unittest audio_common.unit_tests
+'''
+
+TESTING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'general_testing')
+
+
+def load_test_mp3():
+    '''Return the mp3 bytes from the api gateway test payload'''
+    with open(os.path.join(TESTING_DIR, 'mp3_api_gateway.json')) as f:
+        payload = json.load(f)
+    return b64decode(payload['body'])
+
+
+def make_wav_f32(samples, sample_rate, extra_chunk=False):
+    '''Build a float32 WAV stream the way ffmpeg writes it to a pipe (no data size)'''
+    samples = np.asarray(samples, dtype='<f4')
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    fmt = struct.pack('<HHIIHH', 3, channels, sample_rate, sample_rate * channels * 4, channels * 4, 32)
+    chunks = b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+    if extra_chunk:
+        chunks += b'LIST' + struct.pack('<I', 3) + b'abc\x00'
+    chunks += b'data' + struct.pack('<I', 0xFFFFFFFF) + samples.tobytes()
+    return b'RIFF' + struct.pack('<I', 0xFFFFFFFF) + b'WAVE' + chunks
+
+
+def reference_energies(signal, frame_size, hop_size):
+    '''Frame energies one frame at a time, padding the way FrameGenerator does'''
+    energies = []
+    start = -((frame_size + 1) // 2)
+    while start < len(signal):
+        frame = np.zeros(frame_size, dtype=np.float64)
+        first, last = max(start, 0), min(start + frame_size, len(signal))
+        frame[first - start:last - start] = signal[first:last]
+        energies.append(np.sum(frame ** 2))
+        # The frame centred past the end is the last one
+        if start + frame_size // 2 >= len(signal):
+            break
+        start += hop_size
+    return np.array(energies)
+
+
+def reference_stretch(sound_array, f, window_size, h):
+    '''The phase vocoder loop audio_time_stretch and audio_pitch_shift used, one hop at a time'''
+    phase = np.zeros(window_size)
+    hanning_window = np.hanning(window_size)
+    result = np.zeros(int(len(sound_array) / f + window_size))
+
+    for i in np.arange(0, len(sound_array) - (window_size + h), h * f):
+        a1 = sound_array[int(i): int(i) + window_size]
+        a2 = sound_array[int(i) + h: int(i) + window_size + h]
+
+        s1 = np.fft.fft(hanning_window * a1)
+        s2 = np.fft.fft(hanning_window * a2)
+        phase = (phase + np.angle(s2 / s1)) % (2 * np.pi)
+        a2_rephased = np.fft.ifft(np.abs(s2) * np.exp(1j * phase))
+
+        i2 = int(i / f)
+        result[i2: i2 + window_size] += (hanning_window * a2_rephased.real)
+    return result
+
+
+def make_frame(padding=0, xing=None):
+    '''Build one MPEG1 layer III, 128kbps, 44.1kHz joint stereo frame of silence'''
+    header = 0xFFFB9040 | (padding << 9)
+    frame = bytearray(144 * 128000 // 44100 + padding)
+    struct.pack_into('>I', frame, 0, header)
+    if xing is not None:
+        frames, delay, padding_samples = xing
+        struct.pack_into('>4sII', frame, 36, b'Info', 0x1, frames)
+        frame[48:52] = b'LAME'
+        frame[48 + 21:48 + 24] = ((delay << 12) | padding_samples).to_bytes(3, 'big')
+    return bytes(frame)
+
+
+def make_id3v2(size):
+    '''Build an empty ID3v2.4 tag with a body of size bytes'''
+    syncsafe = bytes((size >> shift) & 0x7F for shift in (21, 14, 7, 0))
+    return b'ID3\x04\x00\x00' + syncsafe + bytes(size)
+
+
+def make_id3v23_frame(frame_id, content):
+    '''Build one ID3v2.3 frame'''
+    return frame_id + struct.pack('>IH', len(content), 0) + content
+
+
+def make_id3v23(*frames, unsynchronise=False):
+    '''Build an ID3v2.3 tag holding the given frames and some padding, unsynchronised as a whole if asked'''
+    body = b''.join(frames) + bytes(20)
+    if unsynchronise:
+        # A zero after every 0xFF that is followed by 0x00 or 0xE0 and above
+        body = re.sub(b'\xff(?=[\x00\xe0-\xff])', b'\xff\x00', body)
+    syncsafe = bytes((len(body) >> shift) & 0x7F for shift in (21, 14, 7, 0))
+    return b'ID3\x03' + (b'\x00\x80' if unsynchronise else b'\x00\x00') + syncsafe + body
+
+
+class TestStageTimer(unittest.TestCase):
+
+    def test_stages_recorded(self):
+        '''Test every stage is reported in milliseconds'''
+        timer = StageTimer()
+        with timer.stage('decode'):
+            pass
+        with timer.stage('energy'):
+            pass
+
+        report = timer.report()
+        self.assertEqual(list(report.keys()), ['decode', 'energy'])
+        self.assertTrue(all(value >= 0 for value in report.values()))
+
+    def test_repeated_stage_summed(self):
+        '''Test a stage entered twice is summed'''
+        timer = StageTimer()
+        timer.stages['decode'] = 1_000_000
+        with timer.stage('decode'):
+            pass
+
+        self.assertGreaterEqual(timer.report()['decode'], 1.0)
+
+    def test_stage_without_timer(self):
+        '''Test stage helper does nothing when there is no timer'''
+        with stage(None, 'decode'):
+            value = 1
+        self.assertEqual(value, 1)
+
+    def test_server_timing(self):
+        '''Test the header lists every stage and the total, and reads back'''
+        timer = RequestTimer('audio_energy')
+        timer.stages = {'decode': 12_345_000, 'energy': 1_500_000}
+        timer.finish()
+        timer.total = 20.0
+
+        self.assertEqual(timer.server_timing(), 'decode;dur=12.345, energy;dur=1.5, total;dur=20.0')
+        self.assertEqual(parse_server_timing(timer.server_timing()), {'decode': 12.345, 'energy': 1.5, 'total': 20.0})
+        self.assertEqual(parse_server_timing('cache;desc="hit", db;dur=x'), {})
+
+    def test_embedded_metrics(self):
+        '''Test the log record is CloudWatch embedded metric format with a metric per stage'''
+        timer = RequestTimer('audio_energy', 'request-1')
+        timer.stages = {'decode': 2_000_000}
+        timer.note('embedding_cache', 'memory')
+        timer.finish()
+
+        record = timer.metrics(200)
+        directive = record['_aws']['CloudWatchMetrics'][0]
+        self.assertEqual(directive['Dimensions'], [['function']])
+        self.assertEqual([metric['Name'] for metric in directive['Metrics']], ['decode', 'total'])
+        for metric in directive['Metrics']:
+            self.assertIsInstance(record[metric['Name']], float)
+        self.assertEqual((record['function'], record['request_id'], record['status_code']),
+                         ('audio_energy', 'request-1', 200))
+        self.assertEqual(record['notes'], {'embedding_cache': 'memory'})
+
+    def test_timed_handler(self):
+        '''Test stages without a timer land on the request's, and the response and log carry them'''
+        @timed_handler('audio_test')
+        def handler(event, context):
+            with stage(None, 'decode'):
+                note(None, 'cache', 'miss')
+            timer = request_timer()
+            with timer.stage('encode'):
+                pass
+            return {'statusCode': 200, 'headers': {'Content-Type': 'audio/wav'}, 'body': ''}
+
+        output = io.StringIO()
+        with patch('sys.stdout', output):
+            response = handler({'requestContext': {'requestId': 'abc'}}, None)
+
+        self.assertEqual(response['headers']['Content-Type'], 'audio/wav')
+        self.assertEqual(list(parse_server_timing(response['headers']['Server-Timing'])), ['decode', 'encode', 'total'])
+        record = json.loads(output.getvalue())
+        self.assertEqual((record['function'], record['request_id'], record['status_code']), ('audio_test', 'abc', 200))
+        self.assertEqual(record['notes'], {'cache': 'miss'})
+        # Nothing is left behind for code run outside the request
+        self.assertIsNone(timing.current_timer())
+
+    def test_timing_disabled(self):
+        '''Test a disabled handler is called straight through'''
+        @timed_handler('audio_test')
+        def handler(event, context):
+            with stage(None, 'decode'):
+                pass
+            return {'statusCode': 200, 'body': '', 'timer': request_timer()}
+
+        output = io.StringIO()
+        with patch.object(timing, 'ENABLED', False), patch('sys.stdout', output):
+            response = handler({}, None)
+
+        self.assertNotIn('headers', response)
+        self.assertEqual(response['timer'].report(), {})
+        self.assertEqual(output.getvalue(), '')
+
+
+class TestDecode(unittest.TestCase):
+
+    def test_read_wav_stereo(self):
+        '''Test samples and format are read from a piped WAV stream'''
+        samples = np.array([[0.5, -0.5], [0.25, -0.25], [0.0, 1.0]], dtype=np.float32)
+
+        channels, rate, output = read_wav_f32(make_wav_f32(samples, 44100, extra_chunk=True))
+
+        self.assertEqual(channels, 2)
+        self.assertEqual(rate, 44100)
+        np.testing.assert_array_equal(output, samples)
+
+    def test_read_wav_not_wav(self):
+        '''Test non WAV decoder output raises an error'''
+        with self.assertRaises(ValueError):
+            read_wav_f32(b'not a wav stream at all')
+
+    def test_read_wav_no_samples(self):
+        '''Test a WAV stream without samples raises an error'''
+        with self.assertRaises(ValueError):
+            read_wav_f32(make_wav_f32(np.zeros(0), 44100))
+
+    def test_decode_empty_bytes(self):
+        '''Test with no audio bytes'''
+        with self.assertRaises(AssertionError) as assertion:
+            decode(b'')
+        self.assertEqual(str(assertion.exception), 'audio_bytes must not be empty')
+
+    def test_decode_mp3(self):
+        '''Test decoding the test mp3 to mono and stereo float32 arrays'''
+        timer = StageTimer()
+        audio = load_test_mp3()
+
+        mono, rate = decode(audio, timer=timer)
+        stereo, _ = decode(audio, mono=False)
+
+        self.assertEqual(rate, 44100)
+        self.assertEqual(mono.dtype, np.float32)
+        self.assertEqual(mono.ndim, 1)
+        self.assertEqual(stereo.shape, (len(mono), 2))
+        np.testing.assert_allclose(mono, stereo.mean(axis=1), atol=1e-6)
+        self.assertIn('decode', timer.report())
+
+    def test_decode_cache(self):
+        '''Test repeat decodes of the same bytes and arguments are answered from the cache'''
+        audio = load_test_mp3()
+        with patch.object(decode_module, 'decode_cache', AudioCache(memory_bytes=2**26)):
+            first, rate = decode(audio)
+            timer = StageTimer()
+            second, _ = decode(audio, timer=timer)
+            stereo, _ = decode(audio, mono=False)
+
+            self.assertIs(second, first)
+            self.assertEqual(timer.notes['decode_cache'], 'memory')
+            self.assertNotIn('decode', timer.report())
+            self.assertFalse(second.flags.writeable)
+            self.assertEqual(stereo.ndim, 2)
+            self.assertEqual(decode_module.decode_cache.stats, {'memory': 1, 'miss': 2})
+
+    def test_decode_resample(self):
+        '''Test decoding at a different sample rate'''
+        mono, rate = decode(load_test_mp3())
+        resampled, new_rate = decode(load_test_mp3(), sample_rate=16000)
+
+        self.assertEqual(new_rate, 16000)
+        self.assertAlmostEqual(len(resampled) / new_rate, len(mono) / rate, places=2)
+
+    def test_resample_quality(self):
+        '''Test every quality tier gives the same length and a close signal'''
+        reference, _ = decode(load_test_mp3(), sample_rate=16000, quality='high')
+        for quality in RESAMPLE_QUALITIES:
+            resampled, rate = decode(load_test_mp3(), sample_rate=16000, quality=quality)
+            self.assertEqual(rate, 16000)
+            self.assertEqual(len(resampled), len(reference))
+            self.assertLess(np.abs(resampled - reference).max(), 0.01)
+
+        with self.assertRaises(AssertionError):
+            decode(load_test_mp3(), sample_rate=16000, quality='best')
+
+    def test_resampled_stereo_mixed_like_monoloader(self):
+        '''Test channels are averaged after resampling, not mixed down by ffmpeg'''
+        stereo, _ = decode(load_test_mp3(), sample_rate=16000, mono=False)
+        mono, _ = decode(load_test_mp3(), sample_rate=16000)
+        np.testing.assert_array_equal(mono, stereo.mean(axis=1, dtype=np.float32))
+
+    def test_resample_decoded(self):
+        '''Test resampling decoded audio gives what decoding at the new rate does'''
+        stereo, rate = decode(load_test_mp3(), mono=False)
+        expected, _ = decode(load_test_mp3(), sample_rate=16000)
+        timer = StageTimer()
+
+        resampled, new_rate = resample(stereo, rate, 16000, timer=timer)
+
+        self.assertEqual(new_rate, 16000)
+        self.assertEqual(resampled.shape, expected.shape)
+        self.assertLess(np.abs(resampled - expected).max(), 1e-4)
+        self.assertIn('resample', timer.report())
+
+    def test_resample_same_rate(self):
+        '''Test nothing is resampled at the same rate, stereo is still mixed'''
+        stereo = np.array([[0.5, -0.5], [0.25, 0.75]], dtype=np.float32)
+        mono, rate = resample(stereo, 44100, 44100)
+        self.assertEqual(rate, 44100)
+        np.testing.assert_array_equal(mono, [0.0, 0.5])
+
+    def test_block_decoder(self):
+        '''Test blocks joined together match the whole decoded track'''
+        audio = load_test_mp3()
+        timer = StageTimer()
+
+        whole, rate = decode(audio)
+        with BlockDecoder(audio, block_size=10000, timer=timer) as decoder:
+            blocks = [block.copy() for block in decoder]
+
+        self.assertEqual(decoder.sample_rate, rate)
+        self.assertEqual(decoder.samples, len(whole))
+        self.assertTrue(all(len(block) <= 10000 for block in blocks))
+        np.testing.assert_array_equal(np.concatenate(blocks), whole)
+        self.assertIn('decode', timer.report())
+
+    def test_block_decoder_stop_early(self):
+        '''Test leaving before every block is read stops ffmpeg without an error'''
+        with BlockDecoder(load_test_mp3(), block_size=1024) as decoder:
+            first = next(iter(decoder))
+
+        self.assertEqual(len(first), 1024)
+        self.assertIsNotNone(decoder.process.returncode)
+
+    def test_block_decoder_invalid_audio(self):
+        '''Test bytes that are not audio raise an error'''
+        with self.assertRaises(RuntimeError):
+            with BlockDecoder(b'Not audio'):
+                pass
+
+    def test_decode_invalid_audio(self):
+        '''Test bytes that are not audio raise an error'''
+        with self.assertRaises(RuntimeError):
+            decode(b'Not audio')
+
+
+class TestMp3Headers(unittest.TestCase):
+
+    def test_parse_frame_header(self):
+        '''Test reading bitrate, sample rate and frame length from a header'''
+        header = parse_frame_header(make_frame(padding=1), 0)
+
+        self.assertEqual(header['version'], '1')
+        self.assertEqual(header['layer'], 3)
+        self.assertEqual(header['bitrate'], 128000)
+        self.assertEqual(header['sample_rate'], 44100)
+        self.assertEqual(header['channel_mode'], 'joint stereo')
+        self.assertEqual(header['samples'], 1152)
+        self.assertEqual(header['length'], 418)
+
+    def test_parse_invalid_header(self):
+        '''Test bytes without a sync word or with reserved values are rejected'''
+        self.assertIsNone(parse_frame_header(b'\x00\x00\x00\x00', 0))
+        self.assertIsNone(parse_frame_header(b'\xff\xfb\xf0\x40', 0))  # bitrate index 15
+        self.assertIsNone(parse_frame_header(b'\xff\xfb', 0))
+
+    def test_find_first_frame_after_id3(self):
+        '''Test the ID3v2 tag and leading junk are skipped'''
+        tag = make_id3v2(100)
+        data = tag + b'\xff\x00junk' + make_frame() * 3
+
+        offset, header = find_first_frame(data)
+
+        self.assertEqual(id3v2_size(data), 110)
+        self.assertEqual(offset, len(tag) + 6)
+        self.assertEqual(header['sample_rate'], 44100)
+
+    def test_duration_from_frames(self):
+        '''Test duration when there is no Xing header and a trailing ID3v1 tag'''
+        data = make_frame() * 10 + b'TAG' + bytes(125)
+
+        duration, method = get_duration_ms(data)
+
+        self.assertEqual(method, 'frames')
+        self.assertAlmostEqual(duration, 1000 * 10 * 1152 / 44100)
+
+    def test_duration_from_info_header(self):
+        '''Test the frame count and gapless info from the Info header are used'''
+        data = make_frame(xing=(1000, 576, 1000)) + make_frame() * 2
+
+        duration, method = get_duration_ms(data)
+
+        self.assertEqual(method, 'info')
+        self.assertAlmostEqual(duration, 1000 * (1000 * 1152 - 1576) / 44100)
+
+    def test_duration_malformed(self):
+        '''Test losing frame sync raises an error'''
+        with self.assertRaises(ValueError):
+            get_duration_ms(make_frame() * 3 + b'garbage bytes' + make_frame())
+        with self.assertRaises(ValueError):
+            get_duration_ms(b'Not an mp3')
+
+    def test_duration_matches_decode(self):
+        '''Test the header duration matches the decoded length of the test mp3'''
+        audio = load_test_mp3()
+
+        duration, method = get_duration_ms(audio)
+        samples, rate = decode(audio)
+
+        self.assertEqual(method, 'frames')
+        self.assertAlmostEqual(duration, 1000 * len(samples) / rate, places=3)
+
+
+class TestId3(unittest.TestCase):
+
+    def test_read_id3v2(self):
+        '''Test text, comment and picture frames are read from an ID3v2.3 tag'''
+        image = b'\x89PNG' + bytes(200)
+        tag = make_id3v23(
+            make_id3v23_frame(b'TIT2', b'\x01' + 'Tïtle'.encode('utf-16')),
+            make_id3v23_frame(b'TPE1', b'\x00Artist'),
+            make_id3v23_frame(b'COMM', b'\x00eng\x00A comment'),
+            make_id3v23_frame(b'APIC', b'\x00image/png\x00\x03Cover\x00' + image),
+        )
+        data = tag + make_frame() * 2
+
+        output = read_id3v2(data)
+
+        self.assertEqual(output['version'], '2.3')
+        self.assertEqual(output['title'], 'Tïtle')
+        self.assertEqual(output['artist'], 'Artist')
+        self.assertEqual(output['comment'], 'A comment')
+        picture = output['pictures'][0]
+        self.assertEqual(picture['mime'], 'image/png')
+        self.assertEqual(picture['type'], 3)
+        self.assertEqual(picture['description'], 'Cover')
+        self.assertEqual(data[picture['offset']:picture['offset'] + picture['length']], image)
+
+    def test_read_id3v2_unsynchronised(self):
+        '''Test a v2.3 tag unsynchronised as a whole, frame sizes included, is read frame by frame'''
+        image = b'\xff\xd8\xff\xe0' + bytes(493)  # 0xFF in the image and in the frame size, 0x1FF
+        tag = make_id3v23(
+            make_id3v23_frame(b'TIT2', b'\x00Title'),
+            make_id3v23_frame(b'APIC', b'\x00image/jpeg\x00\x03\x00' + image),
+            make_id3v23_frame(b'TPE1', b'\x01' + 'Ärtist\u00ff'.encode('utf-16')),
+            unsynchronise=True,
+        )
+        data = tag + make_frame()
+        self.assertIn(b'\x00\x00\x01\xff\x00\x00\x00', data)  # the APIC frame size is unsynchronised
+
+        output = read_id3v2(data)
+
+        self.assertEqual(output['title'], 'Title')
+        self.assertEqual(output['artist'], 'Ärtist\u00ff')
+        picture = output['pictures'][0]
+        self.assertEqual(picture['mime'], 'image/jpeg')
+        self.assertTrue(picture['unsynchronised'])
+        stored = data[picture['offset']:picture['offset'] + picture['length']]
+        self.assertEqual(stored.replace(b'\xff\x00', b'\xff'), image)
+
+    def test_read_id3v2_missing(self):
+        '''Test audio without a tag'''
+        self.assertIsNone(read_id3v2(make_frame()))
+
+    def test_read_id3v1(self):
+        '''Test the ID3v1.1 tag at the end of the file'''
+        tag = b'TAG' + b'Title'.ljust(30, b'\x00') + b'Artist'.ljust(30, b'\x00') + b'Album'.ljust(30, b'\x00') \
+            + b'1999' + b'Comment'.ljust(28, b'\x00') + b'\x00\x07' + b'\x11'
+
+        output = read_id3v1(make_frame() + tag)
+
+        self.assertEqual(output, {
+            'title': 'Title', 'artist': 'Artist', 'album': 'Album', 'date': '1999',
+            'comment': 'Comment', 'tracknumber': '7', 'genre_id': 17,
+        })
+        self.assertIsNone(read_id3v1(make_frame()))
+
+
+
+class TestEnergy(unittest.TestCase):
+
+    SIZES = [(1024, 1024), (1024, 512), (2048, 256), (1001, 333), (256, 1024)]
+
+    def setUp(self):
+        self.signal = np.random.default_rng(0).uniform(-1, 1, 44100).astype(np.float32)
+
+    def test_frame_energies(self):
+        '''Test the frames match a frame by frame reference for several frame and hop sizes'''
+        for frame_size, hop_size in self.SIZES:
+            for length in (len(self.signal), 1000, 1, frame_size // 2):
+                signal = self.signal[:length]
+                expected = reference_energies(signal, frame_size, hop_size)
+                output = frame_energies(signal, frame_size, hop_size)
+                self.assertEqual(len(output), number_of_frames(length, frame_size, hop_size))
+                np.testing.assert_allclose(output, expected, rtol=1e-5)
+
+    def test_empty_signal(self):
+        '''Test an empty signal has no frames'''
+        self.assertEqual(len(frame_energies(np.zeros(0, dtype=np.float32))), 0)
+        with self.assertRaises(AssertionError):
+            average_energy(np.zeros(0, dtype=np.float32))
+
+    @unittest.skipIf(es is None, 'essentia is not installed')
+    def test_matches_essentia(self):
+        '''Test against the es.Energy loop over es.FrameGenerator'''
+        energy = es.Energy()
+        for frame_size, hop_size in self.SIZES:
+            expected = [energy(frame) for frame in es.FrameGenerator(self.signal, frameSize=frame_size, hopSize=hop_size)]
+            np.testing.assert_allclose(frame_energies(self.signal, frame_size, hop_size), expected, rtol=1e-5)
+
+    def test_running_energy(self):
+        '''Test blocks of any size give the same average as the whole signal'''
+        for frame_size, hop_size in self.SIZES:
+            for block_size in (100, 1024, 5000):
+                running = RunningEnergy(frame_size, hop_size)
+                for start in range(0, len(self.signal), block_size):
+                    running.add(self.signal[start:start + block_size])
+
+                expected = average_energy(self.signal, frame_size, hop_size)
+                self.assertAlmostEqual(running.average() / expected, 1, places=6)
+
+
+class TestVocoder(unittest.TestCase):
+
+    def setUp(self):
+        self.signal = (np.random.default_rng(0).standard_normal(3 * 44100) * 3000).astype(np.int16)
+
+    def test_matches_loop(self):
+        '''Test the batched vocoder gives the same output as the loop for stretching and pitch shifting factors'''
+        for factor in (1.5, 0.75, 1.0, 2 ** (3 / 12), 1 / 2 ** (5 / 12)):
+            expected = reference_stretch(self.signal, factor, 2**12, 2**10)
+            output = phase_vocoder(self.signal, factor, 2**12, 2**10)
+            self.assertEqual(output.shape, expected.shape)
+            np.testing.assert_allclose(output, expected, atol=1e-9 * np.abs(expected).max())
+
+    def test_stereo(self):
+        '''Test a stereo signal with the same channel twice is stretched like the channel on its own'''
+        stereo = np.column_stack((self.signal, self.signal))
+
+        output = phase_vocoder(stereo, 1.5, 2**12, 2**10)
+
+        self.assertEqual(output.shape[1], 2)
+        expected = phase_vocoder(self.signal, 1.5, 2**12, 2**10)
+        for channel in range(2):
+            np.testing.assert_allclose(output[:, channel], expected, atol=1e-9 * np.abs(expected).max())
+
+    def test_stereo_image(self):
+        '''Test the phase difference between the channels is kept'''
+        t = np.arange(3 * 44100) / 44100
+        for difference in (np.pi / 3, -np.pi / 2, 2.5):
+            stereo = np.column_stack((np.sin(2 * np.pi * 441 * t), 0.5 * np.sin(2 * np.pi * 441 * t + difference)))
+            for factor in (0.8, 1.5):
+                output = phase_vocoder(stereo, factor, 2**12, 2**10)[2**13:-2**13]
+                left, right = np.fft.rfft(output, axis=0).T
+                peak = np.abs(left).argmax()
+                self.assertAlmostEqual(np.angle(right[peak] * np.conj(left[peak])), difference, delta=0.05)
+                self.assertAlmostEqual(np.abs(output[:, 1]).max() / np.abs(output[:, 0]).max(), 0.5, delta=0.02)
+
+    def test_shift_and_stretch(self):
+        '''Test a stretch is the vocoder at PEAK_LEVEL and a shift the same then speedx'''
+        stereo = np.column_stack((self.signal, self.signal[::-1]))
+        stretched = phase_vocoder(stereo, 1.5, 2**12, 2**10)
+        np.testing.assert_allclose(shift_and_stretch(stereo, 0.0, 1.5, 2**12, 2**10),
+                                   PEAK_LEVEL * stretched / stretched.max())
+
+        factor = 2**(4 / 12.0)
+        stretched = phase_vocoder(stereo, 0.75 / factor, 2**12, 2**10)
+        expected = speedx((PEAK_LEVEL * stretched / stretched.max())[2**12:], factor)
+        timer = StageTimer()
+        np.testing.assert_allclose(shift_and_stretch(stereo, 4.0, 0.75, 2**12, 2**10, timer), expected)
+        self.assertEqual(list(timer.report()), ['vocoder', 'speedx'])
+
+    def test_silence(self):
+        '''Test silent frames do not give NaN'''
+        signal = self.signal.copy()
+        signal[44100:2 * 44100] = 0
+        self.assertTrue(np.isfinite(phase_vocoder(signal, 1.5)).all())
+
+    def test_short_signal(self):
+        '''Test a signal shorter than a window gives silence'''
+        output = phase_vocoder(self.signal[:1000], 1.5, 2**12, 2**10)
+        self.assertEqual(len(output), int(1000 / 1.5 + 2**12))
+        self.assertFalse(output.any())
+
+    def test_streaming_matches_batch(self):
+        '''Test the streaming vocoder gives the batch output whatever the block size'''
+        stereo = np.column_stack((self.signal, self.signal[::-1]))
+        for factor, block_size in ((1.5, 4096), (0.3, 10000), (1.0, 333), (2.5, 2**16)):
+            expected = phase_vocoder(stereo, factor, 2**12, 2**10)
+            vocoder = StreamingVocoder(factor, 2, 2**12, 2**10)
+            blocks = [vocoder.push(stereo[i:i + block_size]) for i in range(0, len(stereo), block_size)]
+            output = np.concatenate(blocks + [vocoder.finish()])
+            self.assertEqual(output.shape, expected.shape)
+            np.testing.assert_allclose(output, expected, atol=1e-9 * np.abs(expected).max())
+
+    def test_streaming_memory(self):
+        '''Test the streaming vocoder holds about a batch of frames however long the signal'''
+        vocoder = StreamingVocoder(0.25, 1, 2**12, 2**10)
+        held = 0
+        for _ in range(200):
+            vocoder.push(self.signal[:4096])
+            held = max(held, vocoder.input.shape[1], vocoder.output.shape[1])
+        self.assertLess(held, 2 * 128 * 2**10 + 2**12)
+
+    def test_normaliser(self):
+        '''Test the gain is fixed, so a fade stays a fade, silence stays silent and peaks are clipped'''
+        normaliser = StreamingNormaliser(1, level=100, window_size=2**12, hop=2**10)
+        gain = 100 / overlap_gain(2**12, 2**10)
+        fade = np.linspace(0, 1, 3000).reshape(-1, 1)
+        output = [normaliser.push(np.zeros((1000, 1))), normaliser.push(fade), normaliser.push(np.full(10, 1e3))]
+        output = np.concatenate(output + [normaliser.finish()])[:, 0]
+
+        self.assertAlmostEqual(overlap_gain(2**12, 2**10), 0.75, places=3)
+        self.assertEqual(len(output), 4010)
+        self.assertFalse(output[:1000].any())
+        # Nothing was held back waiting for a louder passage
+        np.testing.assert_array_equal(output[1000:4000], (fade[:, 0] * gain).astype(np.int16))
+        self.assertTrue((output[4000:] == 2**15 - 1).all())
+
+    def test_overlap_gain(self):
+        '''Test the RMS gain of the vocoder on a steady noise is within 3 dB of overlap_gain'''
+        noise = np.random.default_rng(0).uniform(-1, 1, 10 * 2**12)
+        for factor in (0.5, 1.0, 2.0):
+            result = phase_vocoder(noise, factor, 2**12, 2**10)[2**12:-2**13]
+            rms = np.sqrt((result ** 2).mean()) / np.sqrt((noise ** 2).mean())
+            self.assertTrue(0.9 < rms / overlap_gain(2**12, 2**10) < 2 ** 0.5, rms)
+
+
+class TestModelRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = 0
+        self.registry = ModelRegistry()
+        self.registry.register('model', self.build)
+
+    def build(self):
+        self.loads += 1
+        return object()
+
+    def test_loaded_once(self):
+        '''Test the model is built on first use and then shared'''
+        self.assertEqual(self.loads, 0)
+        first = self.registry.get('model')
+        second = self.registry.get('model')
+
+        self.assertIs(first, second)
+        self.assertEqual(self.loads, 1)
+        report = self.registry.report()['model']
+        self.assertTrue(report['loaded'])
+        self.assertIsNotNone(report['load_ms'])
+        self.assertEqual((report['hits'], report['misses']), (1, 1))
+
+    def test_preload(self):
+        '''Test preloading builds the model without counting a miss'''
+        self.registry.preload()
+        self.registry.get('model')
+
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(self.registry.report()['model']['hits'], 1)
+        self.assertEqual(self.registry.report()['model']['misses'], 0)
+
+    def test_preload_opt_out(self):
+        '''Test a model registered with preload=False is only preloaded when named'''
+        self.registry.register('patches', lambda: 'patches', preload=False)
+        self.registry.preload()
+        self.assertNotIn('patches', self.registry.models)
+
+        self.registry.preload(['patches'])
+        self.assertIn('patches', self.registry.models)
+
+    def test_register_twice(self):
+        '''Test a second registration under the same name keeps the first'''
+        self.registry.register('model', lambda: 'other')
+        self.assertIsNot(self.registry.get('model'), 'other')
+
+    def test_unknown_model(self):
+        '''Test asking for a model that was never registered'''
+        with self.assertRaises(KeyError):
+            self.registry.get('missing')
+
+    def test_concurrent_first_use(self):
+        '''Test threads asking at the same time only build the model once'''
+        threads = [threading.Thread(target=self.registry.get, args=('model',)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.loads, 1)
+
+    def test_concurrent_calls(self):
+        '''Test a model that is not re-entrant is only ever called by one thread at a time'''
+        class Model:
+            running = False
+            calls = 0
+
+            def __call__(self, value):
+                if self.running:
+                    raise RuntimeError("called again while running")
+                self.running = True
+                time.sleep(0.002)
+                self.calls += 1
+                self.running = False
+                return value * 2
+
+        self.registry.register('stub', Model)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda value: self.registry.get('stub')(value), range(32)))
+
+        self.assertEqual(results, [value * 2 for value in range(32)])
+        self.assertEqual(self.registry.get('stub').calls, 32)
+
+    def test_preload_enabled(self):
+        '''Test preloading defaults to on lambda only and can be overridden'''
+        with patch.dict(os.environ, {'AWS_LAMBDA_FUNCTION_NAME': 'audio-genre'}, clear=True):
+            self.assertTrue(preload_enabled())
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertFalse(preload_enabled())
+        with patch.dict(os.environ, {'AWS_LAMBDA_FUNCTION_NAME': 'audio-genre', 'PRELOAD_MODELS': '0'}, clear=True):
+            self.assertFalse(preload_enabled())
+
+
+class TestArrayCache(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.array = np.random.default_rng(0).standard_normal((10, 1280)).astype(np.float32)
+
+    def test_content_key(self):
+        '''Test the key depends on both the bytes and the version'''
+        self.assertEqual(content_key(b'audio', 'v1'), content_key(b'audio', 'v1'))
+        self.assertNotEqual(content_key(b'audio', 'v1'), content_key(b'audio', 'v2'))
+        self.assertNotEqual(content_key(b'audio', 'v1'), content_key(b'other', 'v1'))
+
+    def test_memory_then_disk(self):
+        '''Test a stored array comes back from memory, and from disk in a new process'''
+        cache = ArrayCache(self.directory, memory_bytes=2**20, disk_bytes=2**20)
+        self.assertEqual(cache.get('key'), (None, 'miss'))
+
+        cache.put('key', self.array)
+        array, status = cache.get('key')
+        self.assertEqual(status, 'memory')
+        self.assertEqual(array.dtype, np.float32)
+        np.testing.assert_allclose(array, self.array, rtol=1e-3, atol=1e-3)
+
+        array, status = ArrayCache(self.directory, memory_bytes=2**20, disk_bytes=2**20).get('key')
+        self.assertEqual(status, 'disk')
+        np.testing.assert_allclose(array, self.array, rtol=1e-3, atol=1e-3)
+
+    def test_stored_as_float16(self):
+        '''Test entries take half the space of float32'''
+        cache = ArrayCache(self.directory, memory_bytes=2**20, disk_bytes=2**20)
+        cache.put('key', self.array)
+        self.assertEqual(cache.memory_used, self.array.nbytes // 2)
+
+    def test_memory_eviction(self):
+        '''Test the least recently used entry is dropped from memory first'''
+        cache = ArrayCache(self.directory, memory_bytes=self.array.nbytes, disk_bytes=0)
+        cache.put('a', self.array)
+        cache.put('b', self.array)
+        cache.get('a')
+        cache.put('c', self.array)
+
+        self.assertEqual(cache.get('b'), (None, 'miss'))
+        self.assertEqual(cache.get('a')[1], 'memory')
+        self.assertEqual(cache.get('c')[1], 'memory')
+
+    def test_disk_eviction(self):
+        '''Test the disk tier is kept under its size by deleting the oldest files'''
+        entry_size = self.array.nbytes // 2 + 128  # npy header
+        cache = ArrayCache(self.directory, memory_bytes=0, disk_bytes=int(entry_size * 2.5))
+        for index, key in enumerate(['a', 'b', 'c']):
+            cache.put(key, self.array)
+            os.utime(os.path.join(self.directory, f'{key}.npy'), (index, index))
+
+        cache.put('d', self.array)
+
+        self.assertEqual(sorted(os.listdir(self.directory)), ['c.npy', 'd.npy'])
+        self.assertEqual(cache.get('a'), (None, 'miss'))
+        self.assertEqual(cache.get('d')[1], 'disk')
+
+
+class TestAudioCache(unittest.TestCase):
+
+    def setUp(self):
+        self.samples = np.zeros(1000, dtype=np.float32)
+
+    def test_off_by_default(self):
+        '''Test the cache is off without a size'''
+        self.assertFalse(AudioCache(memory_bytes=0).enabled)
+        self.assertTrue(AudioCache(memory_bytes=1).enabled)
+
+    def test_round_trip(self):
+        '''Test entries come back as stored, read only'''
+        cache = AudioCache(memory_bytes=2**20)
+        self.assertEqual(cache.get('key'), (None, 'miss'))
+        cache.put('key', self.samples, 44100)
+        (samples, rate), status = cache.get('key')
+
+        self.assertEqual(status, 'memory')
+        self.assertEqual(rate, 44100)
+        self.assertIs(samples, self.samples)
+        with self.assertRaises(ValueError):
+            samples[0] = 1
+
+    def test_eviction(self):
+        '''Test the least recently used entry goes first and oversized entries are not kept'''
+        cache = AudioCache(memory_bytes=2 * self.samples.nbytes)
+        cache.put('a', self.samples, 44100)
+        cache.put('b', self.samples.copy(), 44100)
+        cache.get('a')
+        cache.put('c', self.samples.copy(), 44100)
+        cache.put('big', np.zeros(10000, dtype=np.float32), 44100)
+
+        self.assertEqual(cache.get('b'), (None, 'miss'))
+        self.assertEqual(cache.get('big'), (None, 'miss'))
+        self.assertEqual(cache.get('a')[1], 'memory')
+        self.assertEqual(cache.memory_used, 2 * self.samples.nbytes)
+
+
+class TestMicroBatcher(unittest.TestCase):
+
+    def run_concurrently(self, batcher, requests):
+        '''Submit every request from its own thread, returns outputs and errors by index'''
+        outputs, errors = {}, {}
+        def submit(i, rows):
+            try:
+                outputs[i] = batcher.submit(rows)
+            except Exception as e:
+                errors[i] = e
+        threads = [threading.Thread(target=submit, args=(i, rows)) for i, rows in enumerate(requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return outputs, errors
+
+    def test_concurrent_requests_share_a_batch(self):
+        '''Test rows from concurrent callers are run together and each gets its own rows back'''
+        calls = []
+        def run(rows):
+            calls.append(len(rows))
+            return rows * 2
+        batcher = MicroBatcher(run, max_batch_size=64, max_wait_ms=200)
+        requests = [np.full((i + 1, 3), i, dtype=np.float32) for i in range(4)]
+
+        outputs, errors = self.run_concurrently(batcher, requests)
+
+        self.assertEqual(errors, {})
+        for i, rows in enumerate(requests):
+            np.testing.assert_array_equal(outputs[i], rows * 2)
+        self.assertLess(len(calls), len(requests))
+        self.assertEqual(sum(calls), 10)
+        self.assertEqual(batcher.stats['rows'], 10)
+        self.assertEqual(batcher.stats['requests'], 4)
+
+    def test_batch_size_limit(self):
+        '''Test no batch is bigger than max_batch_size unless one request is'''
+        calls = []
+        def run(rows):
+            calls.append(len(rows))
+            return rows
+        batcher = MicroBatcher(run, max_batch_size=4, max_wait_ms=50)
+        requests = [np.zeros((3, 2)) for _ in range(4)] + [np.zeros((9, 2))]
+
+        outputs, errors = self.run_concurrently(batcher, requests)
+
+        self.assertEqual(errors, {})
+        self.assertEqual([len(outputs[i]) for i in range(5)], [3, 3, 3, 3, 9])
+        self.assertTrue(all(size <= 4 or size == 9 for size in calls))
+
+    def test_error_propagates(self):
+        '''Test an exception from the model is raised in every caller of that batch'''
+        def run(rows):
+            raise ValueError('model failed')
+        batcher = MicroBatcher(run, max_batch_size=64, max_wait_ms=50)
+
+        outputs, errors = self.run_concurrently(batcher, [np.zeros((2, 2)), np.zeros((1, 2))])
+
+        self.assertEqual(outputs, {})
+        self.assertEqual([str(errors[i]) for i in range(2)], ['model failed'] * 2)
+
+        # The worker carries on after a failed batch
+        batcher.run = lambda rows: rows + 1
+        np.testing.assert_array_equal(batcher.submit(np.zeros((1, 2))), np.ones((1, 2)))
+
+
+class TestLabels(unittest.TestCase):
+
+    def setUp(self):
+        self.activations = np.random.default_rng(0).random((5, len(GENRES))).astype(np.float32)
+
+    def test_registry(self):
+        '''Test labels are indexed in model output order with their parent genre'''
+        self.assertEqual(len(GENRES), 400)
+        self.assertEqual(len(INSTRUMENTS), 40)
+        self.assertEqual(GENRES.index['Blues---Boogie Woogie'], 0)
+        self.assertEqual(len(GENRES.parents), 15)
+        for name, parent in zip(GENRE_LABELS, GENRES.parent_index):
+            self.assertEqual(GENRES.parents[parent], name.split('---')[0])
+
+    def test_top_matches_sort(self):
+        '''Test the argpartition top n matches sorting the whole dict'''
+        row = self.activations[0]
+        expected = dict(sorted(zip(GENRES.names, row.tolist()), key=lambda item: item[1], reverse=True)[:10])
+        self.assertEqual(list(GENRES.top(row, 10).items()), list(expected.items()))
+
+    def test_top_ties_keep_label_order(self):
+        '''Test equal activations come back in label order like a stable sort'''
+        np.testing.assert_array_equal(top_n(np.array([0.1, 0.5, 0.5, 0.2, 0.5]), 3), [1, 2, 4])
+        self.assertEqual(list(top_items({'a': 0.2, 'b': 0.5, 'c': 0.5}, 2)), ['b', 'c'])
+
+    def test_top_zero(self):
+        '''Test asking for no labels gives none'''
+        self.assertEqual(GENRES.top(self.activations[0], 0), {})
+        self.assertEqual(GENRES.top(self.activations, 0), [{}] * 5)
+        self.assertEqual(top_items({'a': 0.2, 'b': 0.5}, 0), {})
+        with self.assertRaises(ValueError):
+            check_top_n(-1, 40)
+        with self.assertRaises(ValueError):
+            check_top_n(40, 40)
+        check_top_n(39, 40)
+
+    def test_matrix_of_tracks(self):
+        '''Test a matrix gives the same result as each track on its own'''
+        tops = GENRES.top(self.activations, 5)
+        self.assertEqual(tops, [GENRES.top(row, 5) for row in self.activations])
+
+    def test_parent_scores(self):
+        '''Test parent scores against a loop over the labels'''
+        row = self.activations[0]
+        best, total = {}, {}
+        for name, value in zip(GENRES.names, row.tolist()):
+            parent = name.split('---')[0]
+            best[parent] = max(best.get(parent, 0), value)
+            total[parent] = total.get(parent, 0) + value
+
+        np.testing.assert_allclose(GENRES.parent_scores(row), [best[parent] for parent in GENRES.parents])
+        np.testing.assert_allclose(GENRES.parent_scores(row, np.add), [total[parent] for parent in GENRES.parents], rtol=1e-5)
+        self.assertEqual(GENRES.parent_scores(self.activations).shape, (5, 15))
+        self.assertEqual(list(GENRES.top_parents(row, 3)),
+                         sorted(best, key=best.get, reverse=True)[:3])
+
+    def test_ungrouped_parents(self):
+        '''Test parents whose labels are not next to each other'''
+        labels = LabelSet(['A---x', 'B---y', 'A---z'], separator='---')
+        np.testing.assert_array_equal(labels.parent_scores(np.array([1, 5, 3])), [3, 5])
+        np.testing.assert_array_equal(labels.parent_scores(np.array([1, 5, 3]), np.add), [4, 5])
+
+    def test_n_too_large(self):
+        '''Test asking for as many labels as there are'''
+        with self.assertRaises(AssertionError) as assertion:
+            INSTRUMENTS.top(np.zeros(40), 40)
+
+        self.assertEqual(str(assertion.exception), 'N must be less than the number of predictions')
+
+
+class TestSampling(unittest.TestCase):
+
+    def setUp(self):
+        # 60 s at 100 Hz whose value is the position in the track, the fake
+        # model gives one row per second of window with that mean as label 0
+        # and its opposite as label 1
+        self.audio = np.linspace(0, 1, 6000, dtype=np.float32)
+        self.calls = []
+
+    def predict(self, windows):
+        self.calls.append(len(windows))
+        rows = np.concatenate([window.reshape(-1, 100).mean(axis=1) for window in windows])
+        return np.stack([rows, 1 - rows, np.full_like(rows, 0.25)], axis=1)
+
+    def test_positions(self):
+        '''Test windows start in the middle of equal strata and refine into the gaps'''
+        np.testing.assert_allclose(initial_positions(4), [0.125, 0.375, 0.625, 0.875])
+        np.testing.assert_allclose(refine_positions(initial_positions(2)), [0.125, 0.5, 0.875])
+        stratified = initial_positions(4, 'stratified', np.random.default_rng(0))
+        self.assertTrue(np.all((stratified >= np.arange(4) / 4) & (stratified < np.arange(1, 5) / 4)))
+
+    def test_fixed_windows(self):
+        '''Test K windows are predicted in one call and approximate the full mean'''
+        activations, windows = sampled_activations(self.audio, 100, self.predict, windows=4, window_seconds=2)
+
+        self.assertEqual(windows, 4)
+        self.assertEqual(self.calls, [4])
+        np.testing.assert_allclose(activations, np.mean(self.predict([self.audio]), axis=0), atol=0.02)
+
+    def test_short_track_analysed_whole(self):
+        '''Test a track the windows would cover is analysed in full'''
+        activations, windows = sampled_activations(self.audio[:1000], 100, self.predict, windows=8, window_seconds=2)
+
+        self.assertIsNone(windows)
+        self.assertEqual(self.calls, [1])
+
+    def test_stable_stops_adding_windows(self):
+        '''Test windows are added until the top n is the same twice in a row'''
+        _, windows = sampled_activations(self.audio, 100, self.predict, windows=2, stable_n=2,
+                                         max_windows=16, window_seconds=1)
+
+        # 2 windows, then 3 more with the same ranking
+        self.assertEqual(windows, 5)
+        self.assertEqual(self.calls, [2, 3])
+
+    def test_max_windows(self):
+        '''Test refinement never goes past max_windows'''
+        changing = iter(range(100))
+        def predict(windows):
+            # A different label comes out on top every call
+            rows = np.zeros((len(windows), 40), dtype=np.float32)
+            rows[:, next(changing) % 40] = 1000
+            return rows
+
+        _, windows = sampled_activations(self.audio, 100, predict, windows=3, stable_n=1, max_windows=10, window_seconds=1)
+        self.assertEqual(windows, 10)
+
+    def test_fast_mode_options(self):
+        '''Test the query parameters of fast mode'''
+        self.assertIsNone(fast_mode_options({}, 5))
+        self.assertEqual(fast_mode_options({'mode': 'fast', 'windows': '4', 'stable': 'true'}, 5),
+                         {'windows': 4, 'strategy': 'even', 'stable_n': 5})
+        for parameters, message in [({'mode': 'quick'}, 'mode parameter must be full or fast'),
+                                    ({'mode': 'fast', 'windows': 'many'}, 'windows parameter must be an integer from 1 to 32'),
+                                    ({'mode': 'fast', 'strategy': 'random'}, 'strategy parameter must be one of: even, stratified')]:
+            with self.assertRaises(ValueError) as error:
+                fast_mode_options(parameters, 5)
+            self.assertEqual(str(error.exception), message)
+
+
+class TestEncode(unittest.TestCase):
+
+    def setUp(self):
+        t = np.arange(44100) / 44100
+        left = np.sin(2 * np.pi * 440 * t) * 10000
+        self.stereo = np.column_stack((left, left / 2)).astype(np.int16)
+
+    def test_negotiate_parameter(self):
+        '''Test output_format and bitrate parameters win over the Accept header'''
+        self.assertEqual(negotiate({}, {}), ('mp3', '320k'))
+        self.assertEqual(negotiate({'output_format': 'opus', 'bitrate': '64K'}, {'Accept': 'audio/flac'}), ('opus', '64k'))
+        self.assertEqual(negotiate({'output_format': 'wav'}, None), ('wav', None))
+
+    def test_negotiate_accept(self):
+        '''Test the most preferred supported media type of the Accept header is used'''
+        self.assertEqual(parse_accept('audio/flac;q=0.5, audio/wav, text/html;q=0'), ['audio/wav', 'audio/flac'])
+        self.assertEqual(negotiate({}, {'accept': 'text/html, audio/flac;q=0.9, audio/mpeg;q=0.1'}), ('flac', None))
+        self.assertEqual(negotiate({}, {'Accept': 'application/json'}), ('mp3', '320k'))
+
+    def test_negotiate_invalid(self):
+        '''Test unknown formats and bitrates'''
+        for parameters, message in [({'output_format': 'aac'}, 'output_format parameter must be one of: pcm_s16le, pcm_f32le, wav, flac, opus, mp3'),
+                                    ({'output_format': 'mp3', 'bitrate': '1000k'}, 'bitrate parameter for mp3 must be one of: 96k, 128k, 192k, 256k, 320k'),
+                                    ({'output_format': 'flac', 'bitrate': '128k'}, 'bitrate parameter for flac must be one of: none')]:
+            with self.assertRaises(ValueError) as error:
+                negotiate(parameters, {})
+            self.assertEqual(str(error.exception), message)
+
+    def test_raw_pcm(self):
+        '''Test raw PCM is the samples as they are'''
+        data, media_type = encode(self.stereo, 44100, 'pcm_s16le')
+        self.assertEqual(media_type, 'audio/x-raw; format=S16LE; rate=44100; channels=2')
+        np.testing.assert_array_equal(np.frombuffer(data, '<i2').reshape(-1, 2), self.stereo)
+
+        data, media_type = encode(self.stereo[:, 0], 44100, 'pcm_f32le')
+        self.assertEqual(media_type, 'audio/x-raw; format=F32LE; rate=44100; channels=1')
+        np.testing.assert_array_equal(np.frombuffer(data, '<f4'), self.stereo[:, 0] / 2**15)
+
+    def test_lossless_round_trip(self):
+        '''Test WAV and FLAC decode back to the same samples'''
+        for output_format, expected_type in [('wav', 'audio/wav'), ('flac', 'audio/flac')]:
+            data, media_type = encode(self.stereo, 44100, output_format)
+            self.assertEqual(media_type, expected_type)
+            samples, rate = decode(data, mono=False)
+            self.assertEqual(rate, 44100)
+            np.testing.assert_array_equal(np.round(samples * 2**15).astype(np.int16), self.stereo)
+
+    def test_lossy_formats(self):
+        '''Test Opus and MP3 decode to about the same length, a lower bitrate giving less data'''
+        for output_format, low, high in [('opus', '32k', '128k'), ('mp3', '96k', '320k')]:
+            small, _ = encode(self.stereo, 44100, output_format, low)
+            large, _ = encode(self.stereo, 44100, output_format, high)
+            self.assertLess(len(small), len(large))
+            samples, rate = decode(large, mono=False)
+            self.assertAlmostEqual(len(samples) / rate, 1, delta=0.1)
+
+
+    def test_block_encoder(self):
+        '''Test audio encoded a block at a time is the same as encoded whole'''
+        blocks = [self.stereo[i:i + 10000] for i in range(0, len(self.stereo), 10000)]
+        for output_format in ('wav', 'pcm_f32le'):
+            data, media_type = encode_blocks(iter(blocks), 44100, 2, output_format)
+            self.assertEqual((data, media_type), encode(self.stereo, 44100, output_format))
+
+        data, media_type = encode_blocks(iter(blocks), 44100, 2, 'flac')
+        self.assertEqual(media_type, 'audio/flac')
+        samples, _ = decode(data, mono=False)
+        np.testing.assert_array_equal(np.round(samples * 2**15).astype(np.int16), self.stereo)
+
+    def test_block_encoder_file(self):
+        '''Test ffmpeg writes straight into a file and a WAV to a pipe keeps its open ended sizes'''
+        with tempfile.TemporaryFile() as f:
+            with BlockEncoder(f, 44100, 2, 'mp3') as encoder:
+                encoder.write(self.stereo)
+            f.seek(0)
+            samples, _ = decode(f.read(), mono=False)
+        self.assertAlmostEqual(len(samples) / 44100, 1, delta=0.1)
+
+        read_end, write_end = os.pipe()
+        with os.fdopen(read_end, 'rb') as source, os.fdopen(write_end, 'wb') as sink:
+            with BlockEncoder(sink, 44100, 2, 'wav') as encoder:
+                encoder.write(self.stereo[:100])
+            sink.close()
+            data = source.read()
+        self.assertEqual(data[4:8], b'\xff\xff\xff\xff')
+        self.assertEqual(len(data), 44 + 400)
+
+
+class TestBody(unittest.TestCase):
+
+    def test_raw_body(self):
+        '''Test a raw binary body is used without a copy'''
+        data = bytearray(b'raw audio')
+        event = {'body': data}
+        view = read_body(event)
+
+        self.assertTrue(accepts_body(event))
+        self.assertIs(view.obj, data)
+
+    def test_base64_body(self):
+        '''Test base64 bodies of every padding decode like b64decode, over several chunks'''
+        for size in (0, 1, 2, 3, 1000, 3 * body.CHUNK // 4 + 5):
+            data = os.urandom(size)
+            text = base64.b64encode(data).decode('ascii')
+            self.assertEqual(bytes(read_body({'body': text, 'isBase64Encoded': True})), data)
+
+    def test_buffer_reused(self):
+        '''Test the buffer is kept between requests and only grows'''
+        buffer = Base64Buffer()
+        first = buffer.decode(base64.b64encode(b'a' * 300).decode())
+        memory = buffer.buffer
+        second = buffer.decode(base64.b64encode(b'b' * 200).decode())
+
+        self.assertIs(buffer.buffer, memory)
+        self.assertEqual(bytes(second), b'b' * 200)
+        buffer.decode(base64.b64encode(b'c' * 400).decode())
+        self.assertIsNot(buffer.buffer, memory)
+        self.assertEqual(len(first), 300)
+
+    def test_large_body_not_kept(self):
+        '''Test bodies over max_size get their own memory'''
+        buffer = Base64Buffer(max_size=100)
+        view = buffer.decode(base64.b64encode(b'x' * 300).decode())
+        self.assertEqual(bytes(view), b'x' * 300)
+        self.assertEqual(len(buffer.buffer), 0)
+
+    def test_wrapped_base64(self):
+        '''Test base64 with line breaks still decodes'''
+        data = os.urandom(200)
+        text = base64.encodebytes(data).decode('ascii')
+        self.assertEqual(bytes(Base64Buffer().decode(text)), data)
+
+    def test_invalid_body(self):
+        '''Test unflagged string bodies and invalid base64 raise errors'''
+        self.assertFalse(accepts_body({'body': 'text'}))
+        with self.assertRaises(ValueError):
+            read_body({'body': 'text'})
+        with self.assertRaises(binascii.Error):
+            read_body({'body': 'Not base64', 'isBase64Encoded': True})
+
+    def test_decode_memoryview(self):
+        '''Test the decoder and mp3 reader take the view'''
+        audio = load_test_mp3()
+        view = read_body({'body': base64.b64encode(audio).decode('ascii'), 'isBase64Encoded': True})
+
+        np.testing.assert_array_equal(decode(view)[0], decode(audio)[0])
+        self.assertEqual(get_duration_ms(view), get_duration_ms(audio))
+
+
+class StubS3:
+    '''upload_fileobj reads the whole source and only then stores the object, like a multipart upload'''
+
+    def __init__(self, error=None):
+        self.objects = {}
+        self.aborted = []
+        self.error = error
+
+    def upload_fileobj(self, source, bucket, key, ExtraArgs=None):
+        parts = []
+        try:
+            while True:
+                part = source.read(2**16)
+                if not part:
+                    break
+                parts.append(part)
+                if self.error is not None:
+                    raise self.error
+        except Exception:
+            self.aborted.append((bucket, key))
+            raise
+        self.objects[(bucket, key)] = (b''.join(parts), ExtraArgs)
+
+
+class TestS3Storage(unittest.TestCase):
+
+    def test_upload(self):
+        '''Test a write larger than the pipe is uploaded whole with its content type'''
+        client = StubS3()
+        data = os.urandom(2**20)
+        with storage.S3Storage(client).writer('audio', 'out.wav', 'audio/wav') as f:
+            f.write(data)
+
+        self.assertEqual(client.objects[('audio', 'out.wav')], (data, {'ContentType': 'audio/wav'}))
+
+    def test_upload_error(self):
+        '''Test an upload that fails raises from the writer without blocking the producer'''
+        client = StubS3(error=IOError('access denied'))
+        with self.assertRaises(IOError) as error:
+            with storage.S3Storage(client).writer('audio', 'out.wav') as f:
+                f.write(os.urandom(2**20))
+
+        self.assertEqual(str(error.exception), 'access denied')
+        self.assertEqual(client.objects, {})
+
+    def test_producer_error(self):
+        '''Test a writer that raises part way aborts the upload instead of storing what was written'''
+        client = StubS3()
+        with self.assertRaises(ValueError):
+            with storage.S3Storage(client).writer('audio', 'out.wav') as f:
+                f.write(os.urandom(2**18))
+                raise ValueError('ffmpeg failed')
+
+        self.assertEqual(client.objects, {})
+        self.assertEqual(client.aborted, [('audio', 'out.wav')])
+
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.storage = LocalStorage(self.directory.name)
+        patcher = patch.object(storage, 'default', self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+
+    def put(self, bucket, key, data):
+        with self.storage.writer(bucket, key) as f:
+            f.write(data)
+
+    def test_round_trip(self):
+        '''Test an object written is read back whole and as a stream, and only appears when closed'''
+        with self.storage.writer('audio', 'in/track.mp3') as f:
+            f.write(b'audio')
+            self.assertFalse(self.storage.exists('audio', 'in/track.mp3'))
+        self.assertTrue(self.storage.exists('audio', 'in/track.mp3'))
+        self.assertEqual(bytes(self.storage.read('audio', 'in/track.mp3')), b'audio')
+        with self.storage.open('audio', 'in/track.mp3') as f:
+            self.assertEqual(f.read(), b'audio')
+
+    def test_invalid_references(self):
+        '''Test names that would leave the bucket are refused'''
+        for bucket, key in [('audio', '../secret'), ('audio', '/etc/passwd'), ('..', 'key'), ('a/b', 'key'),
+                            ('audio', 'a//b'), ('', 'key'), ('audio', '')]:
+            with self.assertRaises(ValueError):
+                self.storage.path(bucket, key)
+        with self.assertRaises(ValueError):
+            check_input({'queryStringParameters': {'input_bucket': 'audio'}})
+        with self.assertRaises(ValueError):
+            output_reference({'output_key': 'out.mp3'}, 'prefix', 'mp3')
+
+    def test_missing_input(self):
+        '''Test a reference to an object that does not exist'''
+        with self.assertRaises(LookupError):
+            check_input({'queryStringParameters': {'input_bucket': 'audio', 'input_key': 'missing.mp3'}})
+        self.assertIsNone(check_input({'body': b'audio'}))
+
+    def test_decode_stream(self):
+        '''Test a file and a stream without a file descriptor decode like the bytes'''
+        audio = load_test_mp3()
+        self.put('audio', 'track.mp3', audio)
+        event = {'queryStringParameters': {'input_bucket': 'audio', 'input_key': 'track.mp3'}}
+        expected = decode(audio)[0]
+
+        source = read_input(event)
+        try:
+            np.testing.assert_array_equal(decode(source)[0], expected)
+        finally:
+            close_input(source)
+        np.testing.assert_array_equal(decode(io.BytesIO(audio))[0], expected)
+        with self.storage.open('audio', 'track.mp3') as f, BlockDecoder(f) as decoder:
+            np.testing.assert_array_equal(np.concatenate(list(decoder)), expected)
+        # Read whole for the mp3 reader
+        self.assertEqual(get_duration_ms(read_input(event, stream=False)), get_duration_ms(audio))
+
+    def test_write_audio(self):
+        '''Test encoded output is written to the object, to a file or a buffer the same'''
+        samples = (np.sin(np.arange(44100) / 10) * 10000).astype(np.int16)
+        reference = output_reference({'output_bucket': 'audio'}, 'test', 'flac')
+        self.assertTrue(reference[1].startswith('test/') and reference[1].endswith('.flac'))
+
+        output = write_audio(reference, samples, 44100, 'flac')
+        self.assertEqual(output, {'bucket': 'audio', 'key': reference[1], 'content_type': 'audio/flac'})
+        decoded, _ = decode(self.storage.read(*reference))
+        np.testing.assert_array_equal(np.round(decoded * 2**15).astype(np.int16), samples)
+
+        buffer = io.BytesIO()
+        self.assertEqual(encode_to(buffer, samples, 44100, 'wav'), 'audio/wav')
+        self.assertEqual(buffer.getvalue(), encode(samples, 44100, 'wav')[0])
+
+        output = write_audio_blocks(('audio', 'blocks.wav'), [samples[:1000], samples[1000:]], 44100, 1, 'wav')
+        self.assertEqual(output['content_type'], 'audio/wav')
+        self.assertEqual(bytes(self.storage.read('audio', 'blocks.wav')), encode(samples, 44100, 'wav')[0])
@@ -0,0 +1,311 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from audio_common.timing import stage
+
+'''
+Batched phase vocoder shared by audio_time_stretch and audio_pitch_shift.
+
+https://zulko.github.io/blog/2014/03/29/soundstretching-and-pitch-shifting-in-python/
+
+The functions used to loop over every hop in Python, doing two complex FFTs, a
+complex division and an inverse FFT per frame. Here the analysis frames are rows
+of a strided view of the signal and a batch of them is transformed with one real
+FFT call. The phase advance of every frame is accumulated with a cumulative
+product of unit phasors (the same as summing the angles modulo 2 pi without the
+angle/exp calls) and the synthesis frames are overlap-added in a handful of
+vectorised adds.
+
+Frames are worked through FRAME_BATCH at a time so memory stays at a few MB
+whatever the length of the track, the phase is carried over between batches.
+Multi-channel audio is stacked channels first and transformed in the same calls,
+with one phase advance for all of them (see rephase) so the stereo image is kept.
+
+phase_vocoder still takes the whole signal and returns the whole (unnormalised,
+float64) result, which for a 10 min track slowed to 0.25x is over 1 GB of stereo.
+StreamingVocoder takes the signal a block at a time and hands back the output
+as soon as no later frame can add to it, so it only ever holds about a batch of
+frames of input and of output. shift_and_stretch is the pitch shift and time
+stretch every function runs on a whole signal: one vocoder pass, the result
+scaled so its peak is PEAK_LEVEL, then speedx for the shift. Scaling to the peak
+needs the whole output, StreamingNormaliser scales with a fixed gain from the
+window's overlap-add gain instead.
+'''
+
+# Frames transformed together, each batch holds about 4 * FRAME_BATCH * window_size floats
+FRAME_BATCH = 128
+# int16 peak of the normalised output, 18 dB of headroom
+PEAK_LEVEL = 2**12
+
+
+def analysis_positions(length, factor, window_size, hop):
+    '''Start of every analysis frame, one every hop * factor samples (same as the old loop)'''
+    positions = np.arange(0, length - (window_size + hop), hop * factor)
+    return positions.astype(int), (positions / factor).astype(int)
+
+
+def overlap_add(result, frames, starts):
+    '''
+    Add each frame into result at its start, frames has shape (channels, frames, window_size)
+    and result (channels, samples).
+
+    Frames that are far enough apart not to overlap are added together with one
+    fancy index, so this takes about window_size / hop adds rather than one per frame.
+    '''
+    if len(starts) == 0:
+        return
+    window_size = frames.shape[-1]
+    spacing = max(int(np.diff(starts).min()), 1) if len(starts) > 1 else window_size
+    groups = window_size // spacing + 1
+    offsets = np.arange(window_size)
+    for group in range(groups):
+        rows = slice(group, None, groups)
+        result[:, starts[rows, None] + offsets] += frames[:, rows]
+
+
+def overlap_gain(window_size, hop):
+    '''
+    RMS gain of the vocoder on a signal of steady level.
+
+    Each rephased frame keeps the energy of its windowed analysis frame but not
+    its phase, so frames are windowed again and overlap-added every hop without
+    adding up coherently and their energies sum. For the Hann window at a quarter
+    window hop this is 0.75, frames that overlap are still partly alike so the
+    gain measured on noise or music is 0.7 to 1 (within 3 dB of it).
+    '''
+    energy = (np.hanning(window_size) ** 2).sum()
+    return float(np.sqrt(energy * energy / (window_size * hop)))
+
+
+def initial_phasor(window_size):
+    '''Phase of every bin before the first frame'''
+    return np.ones(window_size // 2 + 1, dtype=complex)
+
+
+def rephase(frames, starts, window, hop, phasor):
+    '''
+    Input: strided frames (channels, positions, window_size), analysis starts of a
+           batch, window, hop, phase carried over from the batch before
+    Output: (windowed synthesis frames (channels, batch, window_size), phase for the next batch)
+
+    The phase advance is worked out once, from the mid channel (the sum of the
+    channels), and accumulated once. Each channel is resynthesised at that phase
+    plus its own phase relative to the mid channel in the frame, so the phase
+    differences between channels, and with them the stereo image, are those of
+    the input. For one channel this is the plain vocoder.
+    '''
+    window_size = len(window)
+    s1 = np.fft.rfft(window * frames[:, starts], axis=-1)
+    s2 = np.fft.rfft(window * frames[:, starts + hop], axis=-1)
+    mid1, mid2 = s1.sum(axis=0), s2.sum(axis=0)
+
+    # Phase advance between the two frames, s2 * conj(s1) has the angle of s2 / s1
+    advance = mid2 * np.conj(mid1)
+    magnitude = np.abs(advance)
+    # Silent bins (s1 == 0) do not move the phase
+    advance = np.divide(advance, magnitude, out=np.ones_like(advance), where=magnitude > 0)
+    advance[0] *= phasor
+    phasors = np.cumprod(advance, axis=0)
+    # Renormalise so rounding does not build up over a long track
+    phasor = phasors[-1] / np.abs(phasors[-1])
+
+    # s2 * conj(mid2) / |mid2| has the magnitude of s2 and its angle relative to
+    # the mid channel, bins where the channels cancel keep their own phase
+    magnitude = np.abs(mid2)
+    relative = np.divide(np.conj(mid2), magnitude, out=np.ones_like(mid2), where=magnitude > 0)
+    rephased = np.fft.irfft(s2 * relative * phasors, n=window_size, axis=-1)
+    return window * rephased, phasor
+
+
+def phase_vocoder(sound_array, factor, window_size=2**13, hop=2**11):
+    '''
+    Input: signal of shape (samples,) or (samples, channels), stretch factor, window size and hop in samples
+    Output: stretched signal (float64) with the same channels, len(sound_array) / factor + window_size samples
+
+    factor > 1 makes the sound shorter, factor < 1 makes it longer. The output is
+    not normalised.
+
+    Every channel is framed at the same positions and all of them go through the
+    same batched FFT and one phase accumulation, so stereo costs one pass rather
+    than one per channel and the phase differences between channels are kept.
+    '''
+    sound_array = np.asarray(sound_array)
+    assert sound_array.ndim in (1, 2), "sound_array must have shape (samples,) or (samples, channels)"
+    mono = sound_array.ndim == 1
+    # Channels first so each channel's frames are rows of one strided view
+    channels = sound_array[np.newaxis] if mono else np.ascontiguousarray(sound_array.T)
+
+    window = np.hanning(window_size)
+    result = np.zeros((len(channels), int(channels.shape[1] / factor + window_size)))
+    analysis, synthesis = analysis_positions(channels.shape[1], factor, window_size, hop)
+
+    if len(analysis):
+        frames = sliding_window_view(channels, window_size, axis=1)
+        # Phase kept as a unit phasor per bin, shared by the channels, multiplying
+        # phasors adds their angles and needs no angle/exp/modulo calls
+        phasor = initial_phasor(window_size)
+        # Keep the memory per batch the same whatever the number of channels
+        batch_size = max(FRAME_BATCH // len(channels), 1)
+
+        for batch in range(0, len(analysis), batch_size):
+            rephased, phasor = rephase(frames, analysis[batch:batch + batch_size], window, hop, phasor)
+            overlap_add(result, rephased, synthesis[batch:batch + batch_size])
+
+    return result[0] if mono else result.T
+
+
+def speedx(sound_array, factor):
+    """ Multiplies the sound's speed by some `factor` """
+    indices = np.round( np.arange(0, len(sound_array), factor) )
+    indices = indices[indices < len(sound_array)].astype(int)
+    return sound_array[ indices.astype(int) ]
+
+
+def shift_and_stretch(sound_array, shift_amount=0.0, stretch_amount=1.0, window_size=2**13, hop=2**11, timer=None):
+    '''
+    Input: signal of shape (samples,) or (samples, channels), semitones, rate (> 1 faster, < 1 slower)
+    Output: float64 signal with the same channels, its peak at PEAK_LEVEL (int16 scale)
+
+    A pitch shift of n semitones is a stretch by 1/2**(n/12) then speeding up by
+    2**(n/12), so any shift and stretch is one vocoder pass:
+
+        stretch by stretch_amount / 2**(n/12), then speedx by 2**(n/12)
+
+    With shift_amount 0 this is the time stretch, with stretch_amount 1 the pitch shift.
+    https://zulko.github.io/blog/2014/03/29/soundstretching-and-pitch-shifting-in-python/
+    '''
+    assert stretch_amount > 0, "stretch_amount must be positive"
+    factor = 2**(1.0 * shift_amount / 12.0)
+
+    with stage(timer, "vocoder"):
+        result = phase_vocoder(sound_array, stretch_amount / factor, window_size, hop)
+        # One scale for every channel so the balance between them is kept
+        result = PEAK_LEVEL * result / result.max()
+    if shift_amount == 0:
+        return result
+    with stage(timer, "speedx"):
+        return speedx(result[window_size:], factor)
+
+
+class StreamingVocoder:
+    '''
+    phase_vocoder a block at a time.
+
+    Usage:
+        vocoder = StreamingVocoder(factor, channels=2)
+        for block in blocks:
+            output = vocoder.push(block)
+            ...
+        output = vocoder.finish()
+
+    Blocks are (samples, channels), or (samples,) for one channel, and so is the
+    output of push and finish (float64, not normalised, possibly empty). Together
+    the outputs are the samples phase_vocoder gives for the whole signal, the
+    frames are the same and so is the phase carried from frame to frame, only
+    the batches it is renormalised at differ.
+
+    Input is kept from the next analysis frame on and output from the next
+    synthesis frame on, so memory depends on the window, hop, factor and block
+    size and not on the length of the track.
+    '''
+
+    def __init__(self, factor, channels=1, window_size=2**13, hop=2**11):
+        assert factor > 0, "factor must be positive"
+        self.factor = factor
+        self.window_size = window_size
+        self.hop = hop
+        self.step = hop * factor
+        self.window = np.hanning(window_size)
+        self.phasor = initial_phasor(window_size)
+        self.batch_size = max(FRAME_BATCH // channels, 1)
+        # Channels first like phase_vocoder, with the absolute index of their first sample
+        self.input = np.zeros((channels, 0))
+        self.input_start = 0
+        self.output = np.zeros((channels, 0))
+        self.output_start = 0
+        self.received = 0
+        self.frame = 0
+
+    def push(self, block):
+        '''Add a block of input, returns the output no later frame can change'''
+        block = np.asarray(block, dtype=float)
+        block = block.reshape(-1, 1) if block.ndim == 1 else block
+        assert block.shape[1] == len(self.input), "block has the wrong number of channels"
+        self.input = np.concatenate((self.input, block.T), axis=1)
+        self.received += len(block)
+
+        # Frames phase_vocoder would have for the input so far (see analysis_positions)
+        stop = self.received - (self.window_size + self.hop)
+        available = int(np.ceil(stop / self.step)) if stop > 0 else 0
+        while self.frame < available:
+            self._run(np.arange(self.frame, min(self.frame + self.batch_size, available)))
+
+        # Keep the input from the next analysis frame on
+        start = int(self.frame * self.step)
+        self.input = self.input[:, start - self.input_start:]
+        self.input_start = start
+        return self._emit(int(self.frame * self.step / self.factor))
+
+    def finish(self):
+        '''The rest of the output, up to the length phase_vocoder gives'''
+        return self._emit(int(self.received / self.factor + self.window_size))
+
+    def _run(self, batch):
+        positions = batch * self.step
+        analysis = positions.astype(int) - self.input_start
+        synthesis = (positions / self.factor).astype(int) - self.output_start
+
+        frames = sliding_window_view(self.input, self.window_size, axis=1)
+        rephased, self.phasor = rephase(frames, analysis, self.window, self.hop, self.phasor)
+
+        missing = synthesis[-1] + self.window_size - self.output.shape[1]
+        if missing > 0:
+            self.output = np.concatenate((self.output, np.zeros((len(self.output), missing))), axis=1)
+        overlap_add(self.output, rephased, synthesis)
+        self.frame = batch[-1] + 1
+
+    def _emit(self, end):
+        '''Hand back the output before the absolute sample end'''
+        count = end - self.output_start
+        if count > self.output.shape[1]:
+            # Past the last frame phase_vocoder's result is zeros
+            self.output = np.concatenate((self.output, np.zeros((len(self.output), count - self.output.shape[1]))), axis=1)
+        finished, self.output = self.output[:, :count], self.output[:, count:]
+        self.output_start = end
+        return finished.T
+
+
+class StreamingNormaliser:
+    '''
+    Scale vocoder output to int16 a block at a time with a fixed gain.
+
+    Usage:
+        normaliser = StreamingNormaliser(channels=2)
+        for block in blocks:
+            samples = normaliser.push(block)
+            ...
+        samples = normaliser.finish()
+
+    The batch path divides by the peak of the whole output, which is not known
+    until the end. Here the gain does not depend on the signal: input is taken to
+    be bounded by full_scale (decoded float samples are in [-1, 1)) and the
+    vocoder scales the level of a signal by the overlap-add gain of its windows
+    (overlap_gain), so level / (full_scale * overlap_gain) puts the output of a
+    full scale input at about level. Quiet passages stay quiet and a fade stays a fade, a quiet track comes
+    out as much quieter than the batch path makes it as it is below full scale.
+    PEAK_LEVEL leaves 18 dB of headroom, anything that still gets past int16 is
+    clipped.
+    '''
+
+    def __init__(self, channels=1, level=PEAK_LEVEL, window_size=2**13, hop=2**11, full_scale=1.0):
+        self.channels = channels
+        self.gain = level / (full_scale * overlap_gain(window_size, hop))
+
+    def push(self, block):
+        '''Scale a block of float samples (samples, channels), returns the int16 samples'''
+        block = np.asarray(block, dtype=float)
+        block = block.reshape(-1, self.channels) if block.ndim == 1 else block
+        return np.clip(block * self.gain, -2**15, 2**15 - 1).astype(np.int16)
+
+    def finish(self):
+        '''Nothing is held back, kept so the normaliser is used like StreamingVocoder'''
+        return np.zeros((0, self.channels), dtype=np.int16)
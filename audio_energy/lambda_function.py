@@ -1,21 +1,19 @@
 import json
-from essentia import standard as es
-import io
-import tempfile
-from pydub import AudioSegment
-import os
-import base64
+from audio_common.decode import decode, BlockDecoder, is_stream
+from audio_common.energy import average_energy, RunningEnergy
+from audio_common.timing import stage, request_timer, timed_handler
+from audio_common.body import RAW_TYPES
+from audio_common.storage import has_input, accepts_input, check_input, read_input, close_input
 
 # Define a function to calculate the average energy of an audio file
-def compute_average_energy(audio_bytes) -> float:
+def compute_average_energy(audio_bytes, timer=None, streaming=True, frame_size=1024, hop_size=1024) -> float:
     '''
-    Input: audio file path (string)
+    Input: audio bytes or a readable stream (an object in storage)
     Output: average energy (float)
 
     Description:
-    We use essentia Energy function to calculate the energy in specific
-    frames of audio, we store the energy of each frame in an array and
-    then calculate the average.
+    We calculate the energy (sum of squares) of specific frames of audio and
+    then calculate the average across all frames.
     A frame is a fixed length window from the audio file.
 
     NOTE: 44,100 samples/second == 44,100 Hz == 44.1kHz
@@ -24,60 +22,114 @@ def compute_average_energy(audio_bytes) -> float:
 
     hop size is how much each frame is overlayed on top of the previous frame
 
-    Essentia can only read from file, for api we need data to be read from the body
-    variable which will be binary so we create a temp file to allow read.
+    The body is decoded once in memory to a mono float32 array at 44.1kHz (what
+    MonoLoader used to give us), there is no temp file or re-encode. Pass a
+    StageTimer as timer to record the stage timings.
+
+    Frames are laid out the same as essentia's FrameGenerator and all of their
+    energies are computed in one numpy reduction (see audio_common.energy)
+    rather than calling es.Energy on each frame.
+
+    With streaming the audio is decoded and measured a block at a time (see
+    stream_average_energy) so memory does not grow with the length of the track,
+    otherwise the whole track is decoded into memory first.
 
     '''
     assert audio_bytes, "audio_bytes must not be empty"
-    assert isinstance(audio_bytes, bytes), "audio_bytes must be of type bytes"
+    assert isinstance(audio_bytes, RAW_TYPES) or is_stream(audio_bytes), "audio_bytes must be of type bytes"
+
+    if streaming:
+        return stream_average_energy(audio_bytes, timer, frame_size, hop_size)
 
-    # Create mp3 audio
-    audio_bytes = io.BytesIO(audio_bytes)
-    audio = AudioSegment.from_file(audio_bytes, format="mp3")
-    # Use temp file to get around essentia disk only read
-    with tempfile.NamedTemporaryFile(delete=True, suffix=".mp3") as temp_audio_file:
-        audio.export(temp_audio_file.name, format="mp3")
-        # store temp file name
-        temp_file_path = temp_audio_file.name
- 
-        # load the audio
-        loader = es.MonoLoader(filename=temp_file_path)
-        audio = loader()
+    # Decode straight to a numpy buffer
+    audio, _ = decode(audio_bytes, sample_rate=44100, timer=timer)
 
+    with stage(timer, "energy"):
+        return average_energy(audio, frame_size, hop_size)
+
+
+def stream_average_energy(audio_bytes, timer=None, frame_size=1024, hop_size=1024) -> float:
+    '''
+    Input: audio bytes or a readable stream
+    Output: average energy (float)
 
-    # Compute the energy of each frame in the audio
-    energy_calculator = es.Energy()
-    energies = [energy_calculator(frame) for frame in es.FrameGenerator(audio, frameSize=1024, hopSize=1024)]
+    Same result as the in memory path but ffmpeg's output is read a block at a
+    time and only a running sum of the frame energies is kept, so peak memory is
+    one block whatever the length of the track.
+    '''
+    running = RunningEnergy(frame_size, hop_size)
 
-    # Calculate the average energy across all frames
-    average_energy = sum(energies) / len(energies)
+    with BlockDecoder(audio_bytes, sample_rate=44100, timer=timer) as decoder:
+        for block in decoder:
+            with stage(timer, "energy"):
+                running.add(block)
 
-    return average_energy
+    assert running.samples, "No audio samples decoded"
+    return running.average()
 
 
+@timed_handler("audio_energy")
 def lambda_handler(event, context):
     try:
         # Check structure
-        if "body" not in event:
+        if not has_input(event):
             return {
                 "statusCode": 400,
                 "body": json.dumps({"error": "Missing body in request"})
             }
         
-        # Check encoding flag
-        is_base64 = event.get("isBase64Encoded", False)
-        if not is_base64:
+        # Check encoding, raw binary bodies and objects in storage need none
+        if not accepts_input(event):
             return {
                 "statusCode": 422,
                 "body": json.dumps({"error": "Audio file must be in base64 encoding"})
             }
+
+        # Optional object in storage in place of the body
+        try:
+            check_input(event)
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": str(e)})
+            }
+        except LookupError as e:
+            return {
+                "statusCode": 404,
+                "body": json.dumps({"client error": str(e)})
+            }
+    
+        # Optional processing mode, stream keeps memory use constant
+        parameters = event.get("queryStringParameters") or {}
+        mode = parameters.get("mode", "stream")
+        if mode not in ("stream", "memory"):
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": "mode parameter must be stream or memory"})
+            }
+
+        # Optional frame and hop sizes in samples
+        try:
+            frame_size = int(parameters.get("frame_size", 1024))
+            hop_size = int(parameters.get("hop_size", frame_size))
+            assert frame_size > 0 and hop_size > 0
+        except (ValueError, AssertionError):
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": "frame_size and hop_size parameters must be positive integers"})
+            }
     
         # Main function code
         try:
-            # Decode body
-            binary_data = base64.b64decode(event["body"])
+            timer = request_timer()
+            # Decode body, an object in storage is streamed to the decoder
+            binary_data = read_input(event, timer)
             # Run duration function
-            energy = compute_average_energy(binary_data)
+            try:
+                energy = compute_average_energy(binary_data, timer, streaming=(mode == "stream"),
+                                                frame_size=frame_size, hop_size=hop_size)
+            finally:
+                close_input(binary_data)
 
             return {
                 "statusCode": 200,
@@ -1,6 +1,9 @@
 import unittest
 from unittest.mock import patch
 import json
+import sys
+sys.path.append('..') # shared audio_common package lives in the repository root
+from base64 import b64decode
 from lambda_function import lambda_handler, compute_average_energy
 
 class TestAudioEnergy(unittest.TestCase):
@@ -10,13 +13,14 @@ class TestAudioEnergy(unittest.TestCase):
         ''' Test with a valid audio file'''
 
         file = 'tinsing.mp3'
-        expected_output = 0.6480382863947269
+        # Decoded directly rather than through a lossy mp3 re-export, exact value depends on the ffmpeg build
+        expected_output = 0.7183236260750584
 
         with open(f'../music_files/{file}', 'rb') as audio_file:
             audio = audio_file.read()
             output = compute_average_energy(audio)
 
-        self.assertEqual(output, expected_output)
+        self.assertAlmostEqual(output, expected_output, places=4)
 
     
     def test_compute_average_energy_empty_bytes(self):
@@ -39,21 +43,45 @@ class TestAudioEnergy(unittest.TestCase):
 
         self.assertEqual(str(assertion.exception), expected_output)
 
+    def test_streaming_matches_memory(self):
+        '''Test the streaming and in memory paths give the same energy'''
+
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            audio = b64decode(json.load(f)['body'])
+
+        streamed = compute_average_energy(audio, streaming=True)
+        in_memory = compute_average_energy(audio, streaming=False)
+
+        self.assertAlmostEqual(streamed, in_memory, places=5)
+
+    def test_overlapping_frames(self):
+        '''Test both paths agree when frames overlap'''
+
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            audio = b64decode(json.load(f)['body'])
+
+        streamed = compute_average_energy(audio, streaming=True, frame_size=2048, hop_size=512)
+        in_memory = compute_average_energy(audio, streaming=False, frame_size=2048, hop_size=512)
+
+        self.assertAlmostEqual(streamed, in_memory, places=5)
+
     # --- Testing For Lambda Handler ---
     def test_valid_payload(self):
         '''Test output on a valid payload'''
 
         expected_outputs = {
             'statusCode': 200,
-            'body': '{"audio file average energy": 0.6480382863947269}'
+            'body': {"audio file average energy": 0.7183236260750584}
         }
 
         with open('../general_testing/mp3_api_gateway.json') as f:
             payload = json.load(f)
         
         response = lambda_handler(payload, None)
+        body = json.loads(response['body'])
         self.assertEqual(response["statusCode"], expected_outputs['statusCode'])
-        self.assertEqual(response['body'], expected_outputs['body'])
+        self.assertEqual(body.keys(), expected_outputs['body'].keys())
+        self.assertAlmostEqual(body["audio file average energy"], expected_outputs['body']["audio file average energy"], places=4)
 
     def test_body_exists(self):
         '''Test no body in payload'''
@@ -84,6 +112,38 @@ class TestAudioEnergy(unittest.TestCase):
         self.assertEqual(response["statusCode"], expected_output['statusCode'])
         self.assertIn(expected_output['body'],response['body'])
 
+    def test_invalid_mode(self):
+        '''Test an unknown processing mode'''
+
+        expected_output = {
+            'statusCode' : 422,
+            'body' : '{"client error": "mode parameter must be stream or memory"}'
+        }
+
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            payload = json.load(f)
+            payload['queryStringParameters']['mode'] = 'invalid'
+
+        response = lambda_handler(payload, None)
+        self.assertEqual(response["statusCode"], expected_output['statusCode'])
+        self.assertEqual(response['body'], expected_output['body'])
+
+    def test_invalid_hop_size(self):
+        '''Test a hop size that is not a positive integer'''
+
+        expected_output = {
+            'statusCode' : 422,
+            'body' : '{"client error": "frame_size and hop_size parameters must be positive integers"}'
+        }
+
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            payload = json.load(f)
+            payload['queryStringParameters']['hop_size'] = '0'
+
+        response = lambda_handler(payload, None)
+        self.assertEqual(response["statusCode"], expected_output['statusCode'])
+        self.assertEqual(response['body'], expected_output['body'])
+
     def test_body_encoding(self):
         '''Test body for valid base64 encoding'''
 
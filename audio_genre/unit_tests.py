@@ -1,6 +1,9 @@
 import unittest
 from unittest.mock import patch
 import json
+import numpy as np
+import sys
+sys.path.append('..') # shared audio_common package lives in the repository root
 from lambda_function import handler, get_genres, process_genres
 
 class TestAudioGenre(unittest.TestCase):
@@ -177,6 +180,44 @@ class TestAudioGenre(unittest.TestCase):
         self.assertEqual(response['statusCode'], expected_output['statusCode'])
         self.assertEqual(response['body'], expected_output['body'])
 
+    def test_invalid_level(self):
+        '''Test a level that is neither style nor parent'''
+
+        expected_output = {
+            "statusCode" : 422,
+            "body" : '{"client error": "level parameter must be style or parent"}'
+        }
+
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            payload = json.load(f)
+            payload['queryStringParameters']['level'] = 'subgenre'
+
+        response = handler(payload, None)
+        self.assertEqual(response['statusCode'], expected_output['statusCode'])
+        self.assertEqual(response['body'], expected_output['body'])
+
+    def test_invalid_mode(self):
+        '''Test a mode that is neither full nor fast'''
+
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            payload = json.load(f)
+            payload['queryStringParameters']['mode'] = 'quick'
+
+        response = handler(payload, None)
+        self.assertEqual(response['statusCode'], 422)
+        self.assertEqual(response['body'], '{"client error": "mode parameter must be full or fast"}')
+
+    def test_top_n_out_of_range(self):
+        '''Test top_n outside the number of genres (or parent genres) is a client error'''
+        for top_n, level, message in (('-1', 'style', '399'), ('400', 'style', '399'), ('15', 'parent', '14')):
+            with open('../general_testing/mp3_api_gateway.json') as f:
+                payload = json.load(f)
+                payload['queryStringParameters'].update(top_n=top_n, level=level)
+
+            response = handler(payload, None)
+            self.assertEqual(response['statusCode'], 422)
+            self.assertEqual(response['body'], json.dumps({"client error": f"top_n parameter must be an integer from 0 to {message}"}))
+
     def test_missing_top_n(self):
         '''Test for when query string params exists but no top n parameter is inside'''
 
@@ -193,5 +234,19 @@ class TestAudioGenre(unittest.TestCase):
         self.assertEqual(response['statusCode'], expected_output['statusCode'])
         self.assertEqual(response['body'], expected_output['body'])
 
-
-
+    def test_fast_mode_headers(self):
+        '''Test fast mode reports the windows it used and that the embedding cache was bypassed'''
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            payload = json.load(f)
+            payload['queryStringParameters'].update(mode='fast', top_n='3')
+
+        with patch('lambda_function.decode', return_value=(np.zeros(16000 * 60, dtype=np.float32), 16000)), \
+                patch('lambda_function.registry') as registry, \
+                patch('lambda_function.sampled_activations', return_value=(np.linspace(0, 1, 400), 8)):
+            registry.report.return_value = {}
+            response = handler(payload, None)
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(response['headers']['X-Embedding-Cache'], 'bypass')
+        self.assertEqual(response['headers']['X-Analysis-Windows'], '8')
+        self.assertEqual(len(json.loads(response['body'])), 3)
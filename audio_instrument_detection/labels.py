@@ -1,42 +0,0 @@
-labels =  [
-        "accordion",
-        "acousticbassguitar",
-        "acousticguitar",
-        "bass",
-        "beat",
-        "bell",
-        "bongo",
-        "brass",
-        "cello",
-        "clarinet",
-        "classicalguitar",
-        "computer",
-        "doublebass",
-        "drummachine",
-        "drums",
-        "electricguitar",
-        "electricpiano",
-        "flute",
-        "guitar",
-        "harmonica",
-        "harp",
-        "horn",
-        "keyboard",
-        "oboe",
-        "orchestra",
-        "organ",
-        "pad",
-        "percussion",
-        "piano",
-        "pipeorgan",
-        "rhodes",
-        "sampler",
-        "saxophone",
-        "strings",
-        "synthesizer",
-        "trombone",
-        "trumpet",
-        "viola",
-        "violin",
-        "voice"
-    ]
\ No newline at end of file
@@ -1,69 +1,69 @@
 import json
 from essentia import standard as es
-import io
-import tempfile
-from pydub import AudioSegment
-import os
-import base64
 import numpy as np
+from audio_common.embeddings import get_embeddings, embed_windows, MODEL_SAMPLE_RATE
+from audio_common.decode import decode, RESAMPLE_QUALITIES, DEFAULT_QUALITY
+from audio_common.timing import stage, note, request_timer, timed_handler
+from audio_common.models import registry, preload_enabled
+from audio_common.labels import INSTRUMENTS, top_items, check_top_n
+from audio_common.sampling import sampled_activations, fast_mode_options
+from audio_common.body import RAW_TYPES
+from audio_common.storage import has_input, accepts_input, check_input, read_input
 
 
-def get_instruments(audio_bytes):
-    '''Return the top n genres for a given audio'''
-    assert audio_bytes, "audio_bytes must not be empty"
-    assert isinstance(audio_bytes, bytes), "audio_bytes must be of type bytes"
-    # Create mp3 audio
-    audio_bytes = io.BytesIO(audio_bytes)
-    audio = AudioSegment.from_file(audio_bytes, format="mp3")
-    number_of_channels = audio.channels
-    sample_width = audio.sample_width
-    frame_rate = audio.frame_rate
-
-    # Use temp file to get around essentia disk only read , using wav to avoid loss from compression
-    temp_audio_file = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
-    audio.export(temp_audio_file.name, format="wav")
-    # store temp file name
-    temp_file_path = temp_audio_file.name
-    temp_audio_file.close()
-
-    # load the audio
-    audio = es.MonoLoader(filename=temp_file_path, sampleRate=frame_rate, resampleQuality=4)()
-
-    # remove the temp file
-    os.remove(temp_audio_file.name)
+# Graphs are read once per container, see audio_common.models
+INSTRUMENT_GRAPH = "mtg_jamendo_instrument-discogs-effnet-1.pb"
+registry.register("mtg_jamendo_instrument", lambda: es.TensorflowPredict2D(graphFilename=INSTRUMENT_GRAPH))
 
-        
-    embedding_model = es.TensorflowPredictEffnetDiscogs(graphFilename="discogs-effnet-bs64-1.pb", output="PartitionedCall:1")
-    embeddings = embedding_model(audio)
 
-    model = es.TensorflowPredict2D(graphFilename="mtg_jamendo_instrument-discogs-effnet-1.pb")
-    activations = model(embeddings)
+def instrument_activations(audio_bytes, timer=None, quality=DEFAULT_QUALITY):
+    '''Mean activation of every instrument for a given audio, in INSTRUMENTS order'''
+    assert audio_bytes, "audio_bytes must not be empty"
+    assert isinstance(audio_bytes, RAW_TYPES), "audio_bytes must be of type bytes"
+    # Cached by the content of the upload, decoded and embedded on a miss
+    embeddings = get_embeddings(audio_bytes, timer, quality=quality)
+
+    with stage(timer, "predictions"):
+        model = registry.get("mtg_jamendo_instrument")
+        activations = model(embeddings)
 
     # Why do we use mean
-    activations_mean = np.mean(activations, axis=0)
+    return np.mean(activations, axis=0)
 
 
-    out = dict(zip(labels, activations_mean.tolist()))
+def sampled_instrument_activations(audio_bytes, timer=None, quality=DEFAULT_QUALITY, **options):
+    '''
+    Mean activation of every instrument over a few windows of the audio (see audio_common.sampling)
+    Returns (activations, windows used or None if the audio was analysed whole)
 
-    return out
+    The windows are embedded directly, the embedding cache is neither read nor filled
+    '''
+    assert audio_bytes, "audio_bytes must not be empty"
+    assert isinstance(audio_bytes, RAW_TYPES), "audio_bytes must be of type bytes"
 
+    note(timer, "embedding_cache", "bypass")
+    audio, sample_rate = decode(audio_bytes, sample_rate=MODEL_SAMPLE_RATE, timer=timer, quality=quality)
+    model = registry.get("mtg_jamendo_instrument")
 
-def process_instruments(predictions, n):
-    '''Return top n outputs from the function'''
-    assert n < len(predictions), 'N must be less than the number of predictions'
-    output = dict(sorted(predictions.items(), key=lambda item: item[1], reverse=True)[:n])
+    def predict(windows):
+        embeddings = embed_windows(windows, timer)
+        with stage(timer, "predictions"):
+            return model(embeddings)
 
-    return output
+    activations, windows = sampled_activations(audio, sample_rate, predict, **options)
+    note(timer, "windows", windows)
+    return activations, windows
 
-import json
-from essentia import standard as es
-import io
-import tempfile
-from pydub import AudioSegment
-import os
-import base64
-import numpy as np
-# from audio_genre.labels import labels
+
+def get_instruments(audio_bytes, timer=None):
+    '''Return every instrument and its activation for a given audio'''
+    activations = instrument_activations(audio_bytes, timer)
+    return dict(zip(INSTRUMENTS.names, activations.tolist()))
+
+
+def process_instruments(predictions, n):
+    '''Return top n outputs from the function'''
+    return top_items(predictions, n)
 
 
 '''
@@ -82,65 +82,36 @@ CD into folder before runnning test?
 # pip install essentia==2.1b6.dev1177
 
 
-labels =  [
-        "accordion",
-        "acousticbassguitar",
-        "acousticguitar",
-        "bass",
-        "beat",
-        "bell",
-        "bongo",
-        "brass",
-        "cello",
-        "clarinet",
-        "classicalguitar",
-        "computer",
-        "doublebass",
-        "drummachine",
-        "drums",
-        "electricguitar",
-        "electricpiano",
-        "flute",
-        "guitar",
-        "harmonica",
-        "harp",
-        "horn",
-        "keyboard",
-        "oboe",
-        "orchestra",
-        "organ",
-        "pad",
-        "percussion",
-        "piano",
-        "pipeorgan",
-        "rhodes",
-        "sampler",
-        "saxophone",
-        "strings",
-        "synthesizer",
-        "trombone",
-        "trumpet",
-        "viola",
-        "violin",
-        "voice"
-    ]
-
+@timed_handler("audio_instrument_detection")
 def handler(event, context):
     try:
         # Check structure
-        if "body" not in event:
+        if not has_input(event):
             return {
                 "statusCode": 400,
                 "body": json.dumps({"error": "Missing body in request"})
             }
         
-        # Check encoding
-        is_base64 = event.get("isBase64Encoded", False)
-        if not is_base64:
+        # Check encoding, raw binary bodies and objects in storage need none
+        if not accepts_input(event):
             return {
                 "statusCode": 422,
                 "body": json.dumps({"error": "Audio file must be in base64 encoding"})
             }
+
+        # Optional object in storage in place of the body
+        try:
+            check_input(event)
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": str(e)})
+            }
+        except LookupError as e:
+            return {
+                "statusCode": 404,
+                "body": json.dumps({"client error": str(e)})
+            }
         parameters = event.get("queryStringParameters", False)
         if not parameters:
             return {
@@ -160,17 +131,52 @@ def handler(event, context):
                 "statusCode": 422,
                 "body": json.dumps({"client error": "top_n parameter is not a string"})
             }
+        try:
+            check_top_n(top_n, len(INSTRUMENTS))
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": str(e)})
+            }
     
+        # Resampling quality tier used to decode to the model rate
+        quality = parameters.get("resample_quality", DEFAULT_QUALITY)
+        if quality not in RESAMPLE_QUALITIES:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": f"resample_quality parameter must be one of: {', '.join(RESAMPLE_QUALITIES)}"})
+            }
+
+        # Fast mode analyses a few windows of the track instead of all of it
+        try:
+            fast = fast_mode_options(parameters, top_n)
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": str(e)})
+            }
+
         # Main function code
         try:
-            # Decode body
-            binary_data = base64.b64decode(event["body"])
+            timer = request_timer()
+            # Decode body, an object in storage is read whole as the embedding cache hashes it
+            binary_data = read_input(event, timer, stream=False)
             # Run duration function
-            full_output = get_instruments(binary_data)
-            final_output = process_instruments(full_output,top_n)
+            if fast is None:
+                activations = instrument_activations(binary_data, timer, quality)
+            else:
+                activations, _ = sampled_instrument_activations(binary_data, timer, quality, **fast)
+            # Load times and hit counts of the graphs, logged in the request's metric record
+            note(timer, "models", registry.report())
+            final_output = INSTRUMENTS.top(activations, top_n)
 
             return {
                 "statusCode": 200,
+                "headers": {
+                    "X-Embedding-Cache": timer.notes.get("embedding_cache", "miss"),
+                    # Windows analysed in fast mode, "full" when every patch was
+                    "X-Analysis-Windows": str(timer.notes.get("windows") or "full"),
+                },
                 "body": json.dumps(final_output)
             }
         # Handle exception from main function
@@ -189,3 +195,7 @@ def handler(event, context):
             "body": json.dumps({"error": str(e)})
         }
 
+
+# Load the graphs during the container init phase so warm requests only pay for inference
+if preload_enabled():
+    registry.preload()
@@ -1,6 +1,9 @@
 import unittest
 from unittest.mock import patch
 import json
+import numpy as np
+import sys
+sys.path.append('..') # shared audio_common package lives in the repository root
 from lambda_function import handler, get_instruments, process_instruments
 
 class TestAudioGenre(unittest.TestCase):
@@ -179,6 +182,17 @@ class TestAudioGenre(unittest.TestCase):
         self.assertEqual(response['statusCode'], expected_output['statusCode'])
         self.assertEqual(response['body'], expected_output['body'])
 
+    def test_top_n_out_of_range(self):
+        '''Test top_n outside the number of instruments is a client error'''
+        for top_n in ('-1', '40'):
+            with open('../general_testing/mp3_api_gateway.json') as f:
+                payload = json.load(f)
+                payload['queryStringParameters']['top_n'] = top_n
+
+            response = handler(payload, None)
+            self.assertEqual(response['statusCode'], 422)
+            self.assertEqual(response['body'], json.dumps({"client error": "top_n parameter must be an integer from 0 to 39"}))
+
     def test_missing_top_n(self):
         '''Test for when query string params exists but no top n parameter is inside'''
 
@@ -195,5 +209,19 @@ class TestAudioGenre(unittest.TestCase):
         self.assertEqual(response['statusCode'], expected_output['statusCode'])
         self.assertEqual(response['body'], expected_output['body'])
 
-
-
+    def test_fast_mode_headers(self):
+        '''Test fast mode reports the windows it used and that the embedding cache was bypassed'''
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            payload = json.load(f)
+            payload['queryStringParameters'].update(mode='fast', top_n='3')
+
+        with patch('lambda_function.decode', return_value=(np.zeros(16000 * 60, dtype=np.float32), 16000)), \
+                patch('lambda_function.registry') as registry, \
+                patch('lambda_function.sampled_activations', return_value=(np.linspace(0, 1, 40), 8)):
+            registry.report.return_value = {}
+            response = handler(payload, None)
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(response['headers']['X-Embedding-Cache'], 'bypass')
+        self.assertEqual(response['headers']['X-Analysis-Windows'], '8')
+        self.assertEqual(len(json.loads(response['body'])), 3)
@@ -0,0 +1,128 @@
+import json
+from audio_common.timing import request_timer, timed_handler
+from audio_common.storage import has_input, accepts_input, check_input, input_reference, read_input
+from audio_common import jobs
+
+'''
+Submit and poll jobs for long running audio operations (see audio_common.jobs).
+
+    POST ?operation=<name>&<the operation's parameters>   audio as the body, or
+         input_bucket and input_key                      -> 202 {"job_id", "state", ...}
+    GET  ?job_id=<id>                                     -> 200 the job record, 404 if unknown
+
+The method is taken from the event (HTTP API or REST API), a request without
+one is a status call when it names a job_id and a submit otherwise.
+'''
+
+
+def request_method(event):
+    method = (event.get("requestContext") or {}).get("http", {}).get("method") or event.get("httpMethod")
+    if method is None:
+        parameters = event.get("queryStringParameters") or {}
+        method = "GET" if "job_id" in parameters else "POST"
+    return method.upper()
+
+
+def submit_job(event):
+    # Check structure
+    if not has_input(event):
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": "Missing body in request"})
+        }
+
+    # Check encoding, raw binary bodies and objects in storage need none
+    if not accepts_input(event):
+        return {
+            "statusCode": 422,
+            "body": json.dumps({"error": "Audio file must be in base64 encoding"})
+        }
+
+    # Optional object in storage in place of the body
+    try:
+        check_input(event)
+    except ValueError as e:
+        return {
+            "statusCode": 422,
+            "body": json.dumps({"client error": str(e)})
+        }
+    except LookupError as e:
+        return {
+            "statusCode": 404,
+            "body": json.dumps({"client error": str(e)})
+        }
+
+    parameters = event.get("queryStringParameters") or {}
+    if "operation" not in parameters:
+        return {
+            "statusCode": 422,
+            "body": json.dumps({"client error": "Missing query parameters (operation)"})
+        }
+
+    timer = request_timer()
+    reference = input_reference(event)
+    try:
+        # The operation's own parameters are checked when the job runs
+        record = jobs.submit(parameters["operation"], parameters, event.get("headers"),
+                             audio=None if reference else read_input(event, timer, stream=False),
+                             input_reference=reference, timer=timer)
+    except ValueError as e:
+        return {
+            "statusCode": 422,
+            "body": json.dumps({"client error": str(e)})
+        }
+
+    return {
+        "statusCode": 202,
+        "headers": {"Content-Type": "application/json"},
+        "body": json.dumps({"job_id": record["job_id"], "operation": record["operation"], "state": record["state"]})
+    }
+
+
+def job_status(event):
+    parameters = event.get("queryStringParameters") or {}
+    if "job_id" not in parameters:
+        return {
+            "statusCode": 422,
+            "body": json.dumps({"client error": "Missing query parameters (job_id)"})
+        }
+    try:
+        record = jobs.status(parameters["job_id"])
+    except ValueError as e:
+        return {
+            "statusCode": 422,
+            "body": json.dumps({"client error": str(e)})
+        }
+    if record is None:
+        return {
+            "statusCode": 404,
+            "body": json.dumps({"client error": f"no job {parameters['job_id']}"})
+        }
+
+    return {
+        "statusCode": 200,
+        "headers": {"Content-Type": "application/json"},
+        "body": json.dumps(record)
+    }
+
+
+@timed_handler("audio_jobs")
+def lambda_handler(event, context):
+    try:
+        method = request_method(event)
+        if method == "POST":
+            return submit_job(event)
+        if method == "GET":
+            return job_status(event)
+        return {
+            "statusCode": 405,
+            "body": json.dumps({"client error": "method must be POST to submit a job or GET for its status"})
+        }
+
+    # Catch any other exceptions
+    except Exception as e:
+        print("Error:", str(e))
+        return {
+            "statusCode": 500,
+            "body": json.dumps({"error": str(e)})
+        }
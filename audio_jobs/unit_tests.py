@@ -0,0 +1,134 @@
+import unittest
+from unittest.mock import patch
+import json
+import os
+import sys
+import time
+import signal
+import tempfile
+sys.path.append('..') # shared audio_common package lives in the repository root
+from lambda_function import lambda_handler, request_method
+from audio_common import jobs
+from audio_common.jobs import FileJobStore, LocalQueue
+from audio_common.encode import encode
+from audio_common.decode import decode
+from audio_common.storage import LocalStorage
+from audio_common.testing import sine, RATE
+import numpy as np
+from base64 import b64encode
+
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        # Storage, records and workers all under a temporary directory. Workers
+        # are spawned, they find the storage through the environment
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.storage = LocalStorage(f"{directory.name}/storage")
+        environment = patch.dict(os.environ, {"AUDIO_STORAGE": "local", "AUDIO_STORAGE_ROOT": self.storage.root})
+        environment.start()
+        self.addCleanup(environment.stop)
+        self.store = FileJobStore(f"{directory.name}/jobs")
+        self.queue = LocalQueue(workers=1, store_root=self.store.root)
+        self.addCleanup(self.queue.shutdown)
+        for target, value in (("audio_common.storage.default", self.storage),
+                              ("audio_common.jobs.default_store", self.store),
+                              ("audio_common.jobs.default_queue", self.queue)):
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def submit(self, parameters, method="POST"):
+        data, _ = encode(sine(440, 3), RATE, "wav")
+        return lambda_handler({
+            "body": b64encode(data).decode("utf-8"),
+            "isBase64Encoded": True,
+            "queryStringParameters": parameters,
+            "requestContext": {"http": {"method": method}}
+        }, None)
+
+    def poll(self, job_id, timeout=60):
+        deadline = time.time() + timeout
+        while True:
+            response = lambda_handler({"queryStringParameters": {"job_id": job_id},
+                                       "requestContext": {"http": {"method": "GET"}}}, None)
+            record = json.loads(response["body"])
+            if record["state"] in ("done", "failed") or time.time() > deadline:
+                return response, record
+            time.sleep(0.05)
+
+    def test_request_method(self):
+        self.assertEqual(request_method({"requestContext": {"http": {"method": "get"}}}), "GET")
+        self.assertEqual(request_method({"httpMethod": "POST"}), "POST")
+        self.assertEqual(request_method({"queryStringParameters": {"job_id": "0" * 32}}), "GET")
+        self.assertEqual(request_method({"body": ""}), "POST")
+
+    def test_audio_job(self):
+        '''A stretch is queued, run by a worker and its output left in storage'''
+        response = self.submit({"operation": "pitch_time", "stretch_amount": "1.5", "output_format": "wav"})
+        self.assertEqual(response["statusCode"], 202)
+        submitted = json.loads(response["body"])
+        self.assertEqual(submitted["state"], "queued")
+
+        response, record = self.poll(submitted["job_id"])
+        self.assertEqual(response["statusCode"], 200)
+        self.assertEqual(record["state"], "done")
+        self.assertEqual(record["step"], "finished")
+        self.assertNotIn("headers", record)
+        for timing in ("queue_ms", "load", "run", "run_ms", "total_ms"):
+            self.assertIn(timing, record["timings"])
+        self.assertGreaterEqual(record["timings"]["total_ms"], record["timings"]["run_ms"])
+
+        output = record["result"]
+        self.assertEqual(output, {"bucket": jobs.JOB_BUCKET, "key": f"{submitted['job_id']}/output.wav",
+                                  "content_type": "audio/wav"})
+        audio, _ = decode(self.storage.read(output["bucket"], output["key"]))
+        self.assertAlmostEqual(len(audio) / RATE, 2, delta=0.3)
+
+    def test_failed_job(self):
+        '''The handler's client error is kept in the record'''
+        response = self.submit({"operation": "pitch_time", "stretch_amount": "0"})
+        _, record = self.poll(json.loads(response["body"])["job_id"])
+        self.assertEqual(record["state"], "failed")
+        self.assertEqual(record["status_code"], 422)
+        self.assertIn("client error", record["error"])
+
+    def test_worker_killed(self):
+        '''A job whose worker dies is failed and the next job gets a new pool'''
+        response = self.submit({"operation": "energy"})
+        for process in list(self.queue.pool._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+        _, record = self.poll(json.loads(response["body"])["job_id"])
+        self.assertEqual(record["state"], "failed")
+        self.assertIn("worker failed", record["error"])
+        self.assertIn("total_ms", record["timings"])
+
+        response = self.submit({"operation": "energy"})
+        _, record = self.poll(json.loads(response["body"])["job_id"])
+        self.assertEqual(record["state"], "done")
+
+    def test_queue_position(self):
+        '''Queued records report how many jobs are ahead of them'''
+        with patch.object(self.queue, "submit"):
+            first = json.loads(self.submit({"operation": "energy"})["body"])["job_id"]
+            second = json.loads(self.submit({"operation": "energy"})["body"])["job_id"]
+        self.assertEqual(jobs.status(first)["queue_position"], 0)
+        self.assertEqual(jobs.status(second)["queue_position"], 1)
+
+    def test_client_errors(self):
+        self.assertEqual(self.submit({"operation": "reverse"})["statusCode"], 422)
+        self.assertEqual(self.submit({})["statusCode"], 422)
+        self.assertEqual(self.submit({"operation": "pitch_time", "output_format": "aiff"})["statusCode"], 422)
+        self.assertEqual(self.submit({"operation": "energy"}, method="DELETE")["statusCode"], 405)
+        self.assertEqual(lambda_handler({"requestContext": {"http": {"method": "POST"}}}, None)["statusCode"], 400)
+
+        status = lambda event: lambda_handler({"queryStringParameters": event,
+                                               "requestContext": {"http": {"method": "GET"}}}, None)["statusCode"]
+        self.assertEqual(status({"job_id": "../../etc/passwd"}), 422)
+        self.assertEqual(status({"job_id": "0" * 32}), 404)
+        self.assertEqual(status({}), 422)
+
+
+if __name__ == '__main__':
+    unittest.main()
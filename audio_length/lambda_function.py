@@ -1,44 +1,75 @@
-import base64
-import io
-from pydub import AudioSegment
 import json
+from audio_common.mp3 import get_duration_ms
+from audio_common.decode import decode
+from audio_common.timing import stage, request_timer, timed_handler
+from audio_common.storage import has_input, accepts_input, check_input, read_input
 
 
-def get_audio_length(audio_bytes):
-            audio_file = io.BytesIO(audio_bytes)
-            audio = AudioSegment.from_file(audio_file, format="mp3")
-            duration = len(audio) / 1000.0  # Convert ms to seconds
+def get_audio_length(audio_bytes, timer=None):
+    '''
+    Input: mp3 bytes
+    Output: (duration in seconds (float), method used (string))
 
-            return duration
+    The duration is read from the Xing/Info/VBRI header or by walking the frame
+    headers, so the audio is not decoded and memory use is constant. Header
+    durations leave out the encoder delay and padding so can be a few ms shorter
+    than the decoded audio.
+    Only when the stream is malformed do we fall back to a full decode ("decode").
+    '''
+    try:
+        with stage(timer, "headers"):
+            duration_ms, method = get_duration_ms(audio_bytes)
+    except ValueError as e:
+        print("Header duration failed, decoding:", str(e))
+        samples, sample_rate = decode(audio_bytes, mono=False, timer=timer)
+        duration_ms, method = 1000 * len(samples) / sample_rate, "decode"
+
+    return duration_ms / 1000.0, method
 
+@timed_handler("audio_length")
 def lambda_handler(event, context):
     try:
         # Check structure
-        if "body" not in event:
+        if not has_input(event):
             return {
                 "statusCode": 400,
                 "body": json.dumps({"error": "Missing body in request"})
             }
         
-        # Check encoding
-        headers = event.get("headers")
+        # Check encoding, raw binary bodies and objects in storage need none
+        headers = event.get("headers") or {}
         is_base64 = headers.get("isBase64Encoded", False )
-        if not is_base64:
+        if not accepts_input(event, encoded=is_base64):
             return {
                 "statusCode": 422,
                 "body": json.dumps({"error": "Audio file must be in base64 encoding"})
             }
+
+        # Optional object in storage in place of the body
+        try:
+            check_input(event)
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": str(e)})
+            }
+        except LookupError as e:
+            return {
+                "statusCode": 404,
+                "body": json.dumps({"client error": str(e)})
+            }
     
         # Main function code
         try:
-            # Decode body
-            binary_data = base64.b64decode(event["body"])
+            # Decode body, an object in storage is read whole as the frame walk seeks around it
+            timer = request_timer()
+            binary_data = read_input(event, timer, stream=False, encoded=bool(is_base64))
             # Run duration function
-            duration = get_audio_length(binary_data)
+            duration, method = get_audio_length(binary_data, timer)
 
             return {
                 "statusCode": 200,
-                "body": json.dumps({"Audio file length (seconds)": duration})
+                "body": json.dumps({"Audio file length (seconds)": duration, "method": method})
             }
         # Handle exception from main function
         except Exception as e:
@@ -1,11 +1,14 @@
 import unittest
 from unittest.mock import patch, MagicMock
 import json
+import sys
+sys.path.append('..') # shared audio_common package lives in the repository root
+from base64 import b64decode
 from lambda_function import lambda_handler, get_audio_length
 
 class TestAudioLength(unittest.TestCase):
 
-    @patch("lambda_function.get_audio_length", return_value=16.7)
+    @patch("lambda_function.get_audio_length", return_value=(16.7, "xing"))
     def test_body_exists(self,mock_audio_length):
         '''Test no body in payload'''
 
@@ -16,7 +19,7 @@ class TestAudioLength(unittest.TestCase):
         self.assertEqual(response["statusCode"], 400)
         self.assertIn('Missing body in request', response['body'])
 
-    @patch("lambda_function.get_audio_length", return_value=16.7)
+    @patch("lambda_function.get_audio_length", return_value=(16.7, "xing"))
     def test_body_encoding(self,mock_audio_length):
         '''Test valid base64'''
 
@@ -27,7 +30,7 @@ class TestAudioLength(unittest.TestCase):
         self.assertEqual(response["statusCode"], 200)
     
 
-    # @patch("lambda_function.get_audio_length", return_value=16.7)
+    # @patch("lambda_function.get_audio_length", return_value=(16.7, "xing"))
     def test_valid_run(self):
         '''Test valid function ouput'''
 
@@ -36,4 +39,26 @@ class TestAudioLength(unittest.TestCase):
 
         response = lambda_handler(valid_payload, None)
         self.assertEqual(response["statusCode"], 200)
-    
+
+    def test_audio_length_from_headers(self):
+        '''Test duration is read from the frame headers without decoding'''
+
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            audio = b64decode(json.load(f)['body'])
+
+        with patch("lambda_function.decode") as mock_decode:
+            duration, method = get_audio_length(audio)
+
+        mock_decode.assert_not_called()
+        self.assertEqual(method, "frames")
+        self.assertAlmostEqual(duration, 16.17, places=2)
+
+    @patch("lambda_function.decode", return_value=([0] * 44100, 44100))
+    def test_audio_length_malformed(self, mock_decode):
+        '''Test a malformed stream falls back to a full decode'''
+
+        duration, method = get_audio_length(b'Not an mp3 stream')
+
+        mock_decode.assert_called_once()
+        self.assertEqual(method, "decode")
+        self.assertEqual(duration, 1.0)
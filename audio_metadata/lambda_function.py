@@ -1,61 +1,89 @@
 import json
-from essentia import standard as es
-import io
-import tempfile
-from pydub import AudioSegment
-import os
-import base64
+from audio_common.id3 import read_id3v2, read_id3v1
+from audio_common.mp3 import find_first_frame
+from audio_common.timing import stage, request_timer, timed_handler
+from audio_common.storage import has_input, accepts_input, check_input, read_input
 
 
-def get_metadata(audio_bytes):
+def get_metadata(audio_bytes, timer=None):
     '''
     Given an mpeg format file return the metadata stored in the
     file.
 
+    Everything is read straight from the raw bytes, the ID3v2 tag at the start,
+    the ID3v1 tag in the last 128 bytes and the first MPEG frame header for the
+    bitrate, sample rate and channels. Nothing is decoded so the time taken does
+    not grow with the length of the track.
+    ID3v2 values are used over ID3v1 ones. Embedded cover art is returned as
+    byte offset and length in the file rather than the image.
     '''
-    # Create mp3 audio
-    audio_bytes = io.BytesIO(audio_bytes)
-    audio = AudioSegment.from_file(audio_bytes, format="mp3")
-    # Use temp file to get around essentia disk only read
-    temp_audio_file = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-    audio.export(temp_audio_file.name, format="mp3")
-    # store temp file name
-    temp_file_path = temp_audio_file.name
-    temp_audio_file.close()
+    assert audio_bytes, "audio_bytes must not be empty"
 
-    # load the audio
+    with stage(timer, "metadata"):
+        id3v2 = read_id3v2(audio_bytes) or {}
+        id3v1 = read_id3v1(audio_bytes) or {}
+        _, header = find_first_frame(audio_bytes)
 
-    metadata = es.MetadataReader(filename=temp_file_path, failOnError=True)()
+    if header is None:
+        raise ValueError("No MPEG audio frames found")
 
-    os.remove(temp_audio_file.name)
+    # Same fields essentia's MetadataReader returned
+    metadata = {}
+    for name in ("title", "artist", "album", "comment", "genre", "tracknumber", "date"):
+        metadata[name] = id3v2.get(name, id3v1.get(name, ""))
+    metadata["bitrate"] = header["bitrate"] // 1000
+    metadata["sampleRate"] = header["sample_rate"]
+    metadata["channels"] = header["channels"]
+
+    metadata["mpeg"] = {"version": header["version"], "layer": header["layer"], "channel_mode": header["channel_mode"]}
+    metadata["id3"] = [version for version, tag in ((id3v2.get("version"), id3v2), ("1", id3v1)) if tag]
+    metadata["tags"] = id3v2.get("tags", {})
+    metadata["pictures"] = id3v2.get("pictures", [])
+    if "genre_id" in id3v1:
+        metadata["id3v1_genre_id"] = id3v1["genre_id"]
 
     return metadata
 
 
 
+@timed_handler("audio_metadata")
 def lambda_handler(event, context):
     try:
         # Check structure
-        if "body" not in event:
+        if not has_input(event):
             return {
                 "statusCode": 400,
                 "body": json.dumps({"error": "Missing body in request"})
             }
         
-        # Check encoding
-        is_base64 = event.get("isBase64Encoded", False)
-        if not is_base64:
+        # Check encoding, raw binary bodies and objects in storage need none
+        if not accepts_input(event):
             return {
                 "statusCode": 422,
                 "body": json.dumps({"error": "Audio file must be in base64 encoding"})
             }
+
+        # Optional object in storage in place of the body
+        try:
+            check_input(event)
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": str(e)})
+            }
+        except LookupError as e:
+            return {
+                "statusCode": 404,
+                "body": json.dumps({"client error": str(e)})
+            }
     
         # Main function code
         try:
-            # Decode body
-            binary_data = base64.b64decode(event["body"])
+            timer = request_timer()
+            # Decode body, an object in storage is read whole as the tag readers seek around it
+            binary_data = read_input(event, timer, stream=False)
             # Run duration function
-            metadata = get_metadata(binary_data)
+            metadata = get_metadata(binary_data, timer)
 
             return {
                 "statusCode": 200,
@@ -0,0 +1,65 @@
+import unittest
+from unittest.mock import patch
+import json
+import sys
+sys.path.append('..') # shared audio_common package lives in the repository root
+from lambda_function import lambda_handler, get_metadata
+
+class TestAudioMetadata(unittest.TestCase):
+
+    # --- Testing For Get Metadata Function ---
+    def test_get_metadata_valid_audio(self):
+        '''Test stream info is read from the first frame header'''
+
+        expected_output = {
+            'bitrate': 128,
+            'sampleRate': 44100,
+            'channels': 2,
+            'id3': [],
+            'pictures': []
+        }
+
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            payload = json.load(f)
+
+        response = lambda_handler(payload, None)
+        metadata = json.loads(response['body'])['Audio file metadata']
+
+        self.assertEqual(response['statusCode'], 200)
+        for key, value in expected_output.items():
+            self.assertEqual(metadata[key], value)
+
+    def test_get_metadata_not_audio(self):
+        '''Test bytes without any MPEG frames'''
+
+        with self.assertRaises(ValueError):
+            get_metadata(b'Not an mp3 file')
+
+    def test_get_metadata_empty_bytes(self):
+        '''Test with no audio bytes'''
+
+        with self.assertRaises(AssertionError) as assertion:
+            get_metadata(b'')
+
+        self.assertEqual(str(assertion.exception), 'audio_bytes must not be empty')
+
+    # --- Testing For Lambda Handler ---
+    def test_body_exists(self):
+        '''Test no body in payload'''
+
+        with open('../general_testing/no_body_payload.json') as f:
+            payload = json.load(f)
+
+        response = lambda_handler(payload, None)
+        self.assertEqual(response["statusCode"], 400)
+        self.assertIn("Missing body in request", response['body'])
+
+    def test_metadata_error(self):
+        '''Test output when get metadata throws error'''
+
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            payload = json.load(f)
+
+        with patch('lambda_function.get_metadata', side_effect=Exception("Processing error")):
+            response = lambda_handler(payload, None)
+            self.assertEqual(response['statusCode'], 500)
@@ -0,0 +1,364 @@
+import os
+import json
+import base64
+from time import perf_counter_ns
+import numpy as np
+from audio_common.decode import decode, resample, is_stream, RESAMPLE_QUALITIES, DEFAULT_QUALITY
+from audio_common.encode import encode, negotiate
+from audio_common.energy import average_energy
+from audio_common.embeddings import embed_audio, MODEL_SAMPLE_RATE
+from audio_common.labels import GENRES, INSTRUMENTS, check_top_n
+from audio_common.models import registry, preload_enabled
+from audio_common.timing import stage, request_timer, timed_handler
+from audio_common import vocoder
+from audio_common.body import RAW_TYPES
+from audio_common.storage import has_input, accepts_input, check_input, read_input, close_input, output_reference, write_audio
+
+'''
+Run an ordered list of operations on one upload in one request.
+
+Every function takes base64 audio in and gives base64 MP3 or JSON back, so a
+workflow of several steps paid a decode, an encode and a transfer per step, and
+chaining them with Step Functions broke on anything over about 5 s of audio
+(see the pitch and time chain demo). Here the upload is decoded once to float32
+PCM, every operation works on that buffer in memory and the audio is encoded
+once at the end.
+
+Query parameters:
+    operations: JSON list (or a JSON string of one) of {"op": name, ...parameters}
+        pitch_shift  amount (semitones)                audio
+        time_stretch amount (rate, > 1 faster)         audio
+        trim         start, end (seconds, optional)    audio
+        length                                         analysis, seconds
+        energy       frame_size, hop_size              analysis, like audio_energy
+        genre        top_n, level (style|parent)       analysis, like audio_genre
+        instrument   top_n                             analysis, like audio_instrument_detection
+    output_format / bitrate or the Accept header, see audio_common.encode
+    resample_quality: as for the genre function
+
+Audio operations change the buffer for the operations after them, analyses
+read it as it is at that point. pitch_shift and time_stretch next to each other
+are run as one vocoder pass (see audio_pitch_time). genre and instrument are only
+offered when their graphs are deployed next to this file.
+
+The response is JSON: "steps" has one entry per step run with its operations,
+its time in ms and, for analyses, its result. "audio" (base64) and
+"content_type" are there when any audio operation was run, "timings" has the
+decode, encode and base64 stages.
+'''
+
+WINDOW_SIZE = 2**13
+HOP = 2**11
+# Rate audio_energy decodes at
+ENERGY_SAMPLE_RATE = 44100
+MAX_OPERATIONS = 16
+
+GENRE_GRAPH = "genre_discogs400-discogs-effnet-1.pb"
+INSTRUMENT_GRAPH = "mtg_jamendo_instrument-discogs-effnet-1.pb"
+
+
+def build_head(graph, **options):
+    # Imported here so the audio operations run without essentia
+    from essentia import standard as es
+    return es.TensorflowPredict2D(graphFilename=graph, **options)
+
+
+# Graphs are read once per container, a head is only offered when its graph is deployed with the function
+if os.path.exists(GENRE_GRAPH):
+    registry.register("genre_discogs400", lambda: build_head(GENRE_GRAPH, input="serving_default_model_Placeholder", output="PartitionedCall:0"))
+if os.path.exists(INSTRUMENT_GRAPH):
+    registry.register("mtg_jamendo_instrument", lambda: build_head(INSTRUMENT_GRAPH))
+
+# Operation name -> (registered model, LabelSet of its outputs)
+HEADS = {
+    "genre": ("genre_discogs400", GENRES),
+    "instrument": ("mtg_jamendo_instrument", INSTRUMENTS),
+}
+
+
+# --- Operations, each parse checks the parameters before anything is decoded ---
+
+def number(spec, key, default=None, convert=float):
+    '''Parameter key of an operation as a number, ValueError with a message for the client'''
+    value = spec.get(key, default)
+    if value is None:
+        raise ValueError(f"{spec['op']} needs a {key} parameter")
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{spec['op']} parameter {key} must be a number")
+
+
+def parse_pitch_shift(spec, settings):
+    return {"shift_amount": number(spec, "amount"), "stretch_amount": 1.0}
+
+
+def parse_time_stretch(spec, settings):
+    amount = number(spec, "amount")
+    if amount <= 0:
+        raise ValueError("time_stretch parameter amount must be positive")
+    return {"shift_amount": 0.0, "stretch_amount": amount}
+
+
+def parse_trim(spec, settings):
+    start = number(spec, "start", 0)
+    end = None if spec.get("end") is None else number(spec, "end")
+    if start < 0 or (end is not None and end <= start):
+        raise ValueError("trim parameters must have 0 <= start < end")
+    return {"start": start, "end": end}
+
+
+def parse_length(spec, settings):
+    return {}
+
+
+def parse_energy(spec, settings):
+    frame_size = number(spec, "frame_size", 1024, int)
+    hop_size = number(spec, "hop_size", frame_size, int)
+    if frame_size <= 0 or hop_size <= 0:
+        raise ValueError("energy parameters frame_size and hop_size must be positive integers")
+    return {"frame_size": frame_size, "hop_size": hop_size}
+
+
+def parse_head(spec, settings):
+    name = HEADS[spec["op"]][0]
+    if name not in registry.factories:
+        raise ValueError(f"{spec['op']} is not available: its graph is not deployed")
+    top_n = number(spec, "top_n", 5, int)
+    level = spec.get("level", "style")
+    if level not in ("style", "parent") or (level == "parent" and spec["op"] != "genre"):
+        raise ValueError(f"{spec['op']} parameter level must be style" + (" or parent" if spec["op"] == "genre" else ""))
+    labels = HEADS[spec["op"]][1]
+    check_top_n(top_n, len(labels.parents) if level == "parent" else len(labels), f"{spec['op']} parameter top_n")
+    return {"head": spec["op"], "top_n": top_n, "level": level}
+
+
+def shift_and_stretch(audio, rate, timer, shift_amount, stretch_amount):
+    '''
+    One vocoder pass for any number of pitch shifts and time stretches in a row
+    (see audio_common.vocoder.shift_and_stretch), back to float at the peak level
+    the pitch shift and time stretch functions write
+    '''
+    result = vocoder.shift_and_stretch(audio, shift_amount, stretch_amount, WINDOW_SIZE, HOP, timer)
+    return (result / 2**15).astype(np.float32), rate
+
+
+def trim(audio, rate, timer, start, end):
+    first = int(round(start * rate))
+    last = len(audio) if end is None else min(int(round(end * rate)), len(audio))
+    if first >= last:
+        raise ValueError(f"trim leaves no audio, the audio is {len(audio) / rate:.3f} seconds")
+    return audio[first:last], rate
+
+
+def length(audio, rate, timer, settings):
+    return {"Audio file length (seconds)": len(audio) / rate}
+
+
+def energy(audio, rate, timer, settings, frame_size, hop_size):
+    mono, _ = resample(audio, rate, ENERGY_SAMPLE_RATE, timer=timer, quality=settings["quality"])
+    with stage(timer, "energy"):
+        return {"audio file average energy": average_energy(mono, frame_size, hop_size)}
+
+
+def classify(audio, rate, timer, settings, head, top_n, level):
+    '''Mean activations of a classifier head over the whole buffer, ranked like the head's function'''
+    name, labels = HEADS[head]
+    mono, _ = resample(audio, rate, MODEL_SAMPLE_RATE, timer=timer, quality=settings["quality"])
+    embeddings = embed_audio(mono, timer)
+    with stage(timer, "predictions"):
+        activations = np.mean(registry.get(name)(embeddings), axis=0)
+    if level == "parent":
+        return labels.top_parents(activations, top_n)
+    return labels.top(activations, top_n)
+
+
+# name -> (parse, run, whether it changes the audio)
+OPERATIONS = {
+    "pitch_shift": (parse_pitch_shift, shift_and_stretch, True),
+    "time_stretch": (parse_time_stretch, shift_and_stretch, True),
+    "trim": (parse_trim, trim, True),
+    "length": (parse_length, length, False),
+    "energy": (parse_energy, energy, False),
+    "genre": (parse_head, classify, False),
+    "instrument": (parse_head, classify, False),
+}
+
+
+def plan(operations, settings):
+    '''
+    Input: list of operation specs, request settings (quality)
+    Output: list of steps (operation names, run, changes audio, parameters)
+
+    Raises ValueError with a message for the client for any invalid operation,
+    so nothing is decoded for a request that cannot run. Pitch shifts and time
+    stretches next to each other are folded into one step.
+    '''
+    if isinstance(operations, str):
+        try:
+            operations = json.loads(operations)
+        except ValueError:
+            raise ValueError("operations parameter must be a JSON list")
+    if not isinstance(operations, list) or not operations:
+        raise ValueError("operations parameter must be a non empty list")
+    if len(operations) > MAX_OPERATIONS:
+        raise ValueError(f"operations parameter can have at most {MAX_OPERATIONS} operations")
+
+    steps = []
+    for spec in operations:
+        if not isinstance(spec, dict) or spec.get("op") not in OPERATIONS:
+            raise ValueError(f"every operation must be an object with op one of: {', '.join(OPERATIONS)}")
+        parse, run, changes_audio = OPERATIONS[spec["op"]]
+        parameters = parse(spec, settings)
+
+        previous = steps[-1] if steps else None
+        if run is shift_and_stretch and previous and previous[1] is shift_and_stretch:
+            previous[3]["shift_amount"] += parameters["shift_amount"]
+            previous[3]["stretch_amount"] *= parameters["stretch_amount"]
+            previous[0].append(spec["op"])
+        else:
+            steps.append(([spec["op"]], run, changes_audio, parameters))
+    return steps
+
+
+def run_pipeline(audio_bytes, steps, settings, timer=None):
+    '''
+    Input: encoded audio, steps from plan, request settings
+    Output: (int16 samples or None if no step changed the audio, sample rate, step reports)
+    '''
+    assert audio_bytes, "audio_bytes must not be empty"
+    assert isinstance(audio_bytes, RAW_TYPES) or is_stream(audio_bytes), "audio_bytes must be of type bytes"
+
+    audio, rate = decode(audio_bytes, mono=False, timer=timer)
+    if audio.shape[1] == 1:
+        audio = audio.reshape(-1)
+
+    reports = []
+    changed = False
+    for names, run, changes_audio, parameters in steps:
+        start = perf_counter_ns()
+        if changes_audio:
+            audio, rate = run(audio, rate, timer, **parameters)
+            report = {"operations": names}
+            changed = True
+        else:
+            report = {"operations": names, "result": run(audio, rate, timer, settings, **parameters)}
+        report["ms"] = round((perf_counter_ns() - start) / 1e6, 3)
+        reports.append(report)
+
+    if not changed:
+        return None, rate, reports
+    samples = np.round(np.asarray(audio) * 2**15).clip(-2**15, 2**15 - 1).astype(np.int16)
+    return samples, rate, reports
+
+
+@timed_handler("audio_pipeline")
+def handler(event, context):
+    try:
+        # Check structure
+        if not has_input(event):
+            return {
+                "statusCode": 400,
+                "body": json.dumps({"error": "Missing body in request"})
+            }
+
+        # Check encoding, raw binary bodies and objects in storage need none
+        if not accepts_input(event):
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"error": "Audio file must be in base64 encoding"})
+            }
+
+        # Optional object in storage in place of the body
+        try:
+            check_input(event)
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": str(e)})
+            }
+        except LookupError as e:
+            return {
+                "statusCode": 404,
+                "body": json.dumps({"client error": str(e)})
+            }
+
+        parameters = event.get("queryStringParameters", False)
+        if not parameters or "operations" not in parameters:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": "Missing query parameters (operations)"})
+            }
+
+        # Resampling quality tier for the analyses that need it
+        settings = {"quality": parameters.get("resample_quality", DEFAULT_QUALITY)}
+        if settings["quality"] not in RESAMPLE_QUALITIES:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": f"resample_quality parameter must be one of: {', '.join(RESAMPLE_QUALITIES)}"})
+            }
+
+        # Every operation is checked before the audio is decoded
+        try:
+            steps = plan(parameters["operations"], settings)
+            output_format, bitrate = negotiate(parameters, event.get("headers"))
+            output_object = output_reference(parameters, "audio_pipeline", output_format)
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": str(e)})
+            }
+
+        # Main function code
+        try:
+            timer = request_timer()
+            # Decode body, an object in storage is streamed to the decoder
+            binary_data = read_input(event, timer)
+            try:
+                samples, rate, reports = run_pipeline(binary_data, steps, settings, timer)
+            except ValueError as e:
+                # An operation that cannot be applied to this audio, such as trimming past the end
+                return {
+                    "statusCode": 422,
+                    "body": json.dumps({"client error": str(e)})
+                }
+            finally:
+                close_input(binary_data)
+
+            output = {"steps": reports}
+            if samples is not None and output_object is not None:
+                # Written to storage, only the reference comes back
+                output["audio_object"] = write_audio(output_object, samples, rate, output_format, bitrate, timer)
+            elif samples is not None:
+                audio, media_type = encode(samples, rate, output_format, bitrate, timer)
+                with timer.stage("base64"):
+                    output["audio"] = base64.b64encode(audio).decode("utf-8")
+                output["content_type"] = media_type
+            output["timings"] = timer.report()
+
+            return {
+                "statusCode": 200,
+                "headers": {"Content-Type": "application/json"},
+                "body": json.dumps(output)
+            }
+        # Handle exception from main function
+        except Exception as e:
+            print("Error:", str(e))
+            return {
+                "statusCode": 500,
+                "body": json.dumps({"error, decoding or pipeline failed": str(e)})
+            }
+
+    # Catch any other exceptions
+    except Exception as e:
+        print("Error:", str(e))
+        return {
+            "statusCode": 500,
+            "body": json.dumps({"error": str(e)})
+        }
+
+
+# Load the graphs during the container init phase so warm requests only pay for inference,
+# the embedding model is only needed when a head is deployed
+if preload_enabled() and (os.path.exists(GENRE_GRAPH) or os.path.exists(INSTRUMENT_GRAPH)):
+    registry.preload()
@@ -0,0 +1,145 @@
+import unittest
+from unittest.mock import patch
+import json
+import sys
+sys.path.append('..') # shared audio_common package lives in the repository root
+from lambda_function import handler, plan, run_pipeline, shift_and_stretch, trim
+from audio_common.decode import decode
+from audio_common.encode import encode
+from audio_common.energy import average_energy
+from audio_common.testing import sine, RATE
+import numpy as np
+from base64 import b64encode, b64decode
+
+SETTINGS = {"quality": "default"}
+
+
+def wav_bytes(duration=3):
+    data, _ = encode(sine(440, duration), RATE, "wav")
+    return data
+
+
+class TestPipeline(unittest.TestCase):
+
+    # --- Tests for planning ---
+
+    def test_plan_folds_vocoder_operations(self):
+        '''Pitch shifts and time stretches in a row are one step'''
+        steps = plan([{"op": "pitch_shift", "amount": 4}, {"op": "time_stretch", "amount": 1.5},
+                      {"op": "pitch_shift", "amount": -1}, {"op": "length"}, {"op": "time_stretch", "amount": 2}],
+                     SETTINGS)
+
+        self.assertEqual([names for names, _, _, _ in steps],
+                         [["pitch_shift", "time_stretch", "pitch_shift"], ["length"], ["time_stretch"]])
+        self.assertEqual(steps[0][3], {"shift_amount": 3.0, "stretch_amount": 1.5})
+
+    def test_plan_json_string(self):
+        steps = plan('[{"op": "trim", "start": 1, "end": 2}]', SETTINGS)
+        self.assertEqual(steps[0][3], {"start": 1.0, "end": 2.0})
+
+    def test_plan_invalid(self):
+        '''Invalid operations are refused before anything runs'''
+        for operations in ([], "not json", [{"op": "reverse"}], ["trim"], [{"op": "pitch_shift"}],
+                           [{"op": "time_stretch", "amount": 0}], [{"op": "trim", "start": 2, "end": 1}],
+                           [{"op": "energy", "frame_size": "big"}], [{"op": "length"}] * 17):
+            with self.assertRaises(ValueError):
+                plan(operations, SETTINGS)
+
+    def test_plan_head_not_deployed(self):
+        '''genre is refused when its graph is not deployed'''
+        with self.assertRaises(ValueError) as error:
+            plan([{"op": "genre"}], SETTINGS)
+        self.assertIn("genre is not available", str(error.exception))
+
+    # --- Tests for running ---
+
+    def test_shift_and_stretch(self):
+        '''One pass gives the duration of the stretch and the pitch of the shift'''
+        audio = sine(440, 5).astype(np.float32) / 2**15
+        altered, rate = shift_and_stretch(audio, RATE, None, 12.0, 1.25)
+
+        fft_data = np.fft.rfft(altered)
+        peak = np.fft.rfftfreq(len(altered))[np.argmax(np.abs(fft_data))] * rate
+        self.assertAlmostEqual(len(altered) / rate, 5 / 1.25, delta=0.5)
+        self.assertAlmostEqual(peak, 880, delta=5)
+
+    def test_trim(self):
+        audio = np.arange(RATE * 2, dtype=np.float32)
+        trimmed, _ = trim(audio, RATE, None, 0.5, None)
+        self.assertEqual(len(trimmed), RATE * 1.5)
+        with self.assertRaises(ValueError):
+            trim(audio, RATE, None, 3, None)
+
+    def test_analyses_see_earlier_operations(self):
+        '''Analyses read the buffer as the operations before them left it'''
+        steps = plan([{"op": "length"}, {"op": "trim", "end": 1}, {"op": "length"}, {"op": "energy"}], SETTINGS)
+        samples, rate, reports = run_pipeline(wav_bytes(3), steps, SETTINGS)
+
+        self.assertAlmostEqual(reports[0]["result"]["Audio file length (seconds)"], 3, places=3)
+        self.assertAlmostEqual(reports[2]["result"]["Audio file length (seconds)"], 1, places=3)
+        self.assertEqual(len(samples), rate)
+        # Same energy as decoding the trimmed audio on its own
+        expected = average_energy(decode(encode(samples, rate, "wav")[0], sample_rate=44100)[0])
+        self.assertAlmostEqual(reports[3]["result"]["audio file average energy"], expected, places=2)
+        self.assertTrue(all("ms" in report for report in reports))
+
+    def test_analysis_only(self):
+        '''No audio comes back when no operation changed it'''
+        samples, _, reports = run_pipeline(wav_bytes(), plan([{"op": "length"}], SETTINGS), SETTINGS)
+        self.assertIsNone(samples)
+        self.assertEqual(len(reports), 1)
+
+    def test_genre(self):
+        '''genre runs the head on the embeddings of the buffer at 16 kHz'''
+        with patch("lambda_function.embed_audio", return_value=np.ones((3, 1280))) as embed, \
+                patch("lambda_function.registry") as registry:
+            registry.factories = {"genre_discogs400": None}
+            registry.get.return_value = lambda embeddings: np.tile(np.linspace(0, 1, 400), (len(embeddings), 1))
+            steps = plan([{"op": "genre", "top_n": 2}], SETTINGS)
+            _, _, reports = run_pipeline(wav_bytes(), steps, SETTINGS)
+
+        self.assertEqual(len(embed.call_args[0][0]), 3 * 16000)
+        self.assertEqual(len(reports[0]["result"]), 2)
+
+    # --- Tests for the handler ---
+
+    def event(self, operations, **parameters):
+        return {
+            "body": b64encode(wav_bytes()).decode("utf-8"),
+            "isBase64Encoded": True,
+            "queryStringParameters": dict(parameters, operations=json.dumps(operations))
+        }
+
+    def test_valid_run(self):
+        response = handler(self.event([{"op": "pitch_shift", "amount": 2}, {"op": "time_stretch", "amount": 1.5},
+                                       {"op": "length"}], output_format="wav"), None)
+        self.assertEqual(response["statusCode"], 200)
+        output = json.loads(response["body"])
+
+        self.assertEqual(output["content_type"], "audio/wav")
+        self.assertEqual([step["operations"] for step in output["steps"]], [["pitch_shift", "time_stretch"], ["length"]])
+        self.assertAlmostEqual(output["steps"][1]["result"]["Audio file length (seconds)"], 2, delta=0.3)
+        audio, _ = decode(b64decode(output["audio"]))
+        self.assertAlmostEqual(len(audio) / RATE, 2, delta=0.3)
+        self.assertIn("decode", output["timings"])
+
+    def test_invalid_operations(self):
+        response = handler(self.event([{"op": "reverse"}]), None)
+        self.assertEqual(response["statusCode"], 422)
+
+    def test_trim_past_end(self):
+        response = handler(self.event([{"op": "trim", "start": 10}]), None)
+        self.assertEqual(response["statusCode"], 422)
+        self.assertIn("trim leaves no audio", json.loads(response["body"])["client error"])
+
+    def test_missing_operations(self):
+        response = handler({"body": "", "isBase64Encoded": True, "queryStringParameters": {"output_format": "wav"}}, None)
+        self.assertEqual(response["statusCode"], 422)
+
+    def test_missing_body(self):
+        response = handler({"isBase64Encoded": True}, None)
+        self.assertEqual(response["statusCode"], 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
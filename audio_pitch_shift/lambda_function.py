@@ -1,9 +1,15 @@
 from json import dumps as json_dumps
 from pydub import AudioSegment
 from io import BytesIO
-from base64 import b64decode, b64encode
+from base64 import b64encode
 from time import strftime, gmtime
 import numpy as np
+from audio_common.vocoder import shift_and_stretch
+from audio_common.encode import encode, negotiate
+from audio_common.decode import decode, is_stream
+from audio_common.timing import request_timer, timed_handler
+from audio_common.body import RAW_TYPES
+from audio_common.storage import has_input, accepts_input, check_input, read_input, close_input, output_reference, write_audio
 
 def read(audio_buffer, normalized=False):
     """MP3 to numpy array - https://stackoverflow.com/questions/53633177/how-to-read-a-mp3-audio-file-into-a-numpy-array-save-a-numpy-array-to-mp3"""
@@ -30,82 +36,39 @@ def log(message,type):
     """ Helper function to log messages with a timestamp. """
     print(f"{strftime('%d/%m/%Y %H:%M:%S', gmtime())} [{type}] {message}")
 
-def speedx(sound_array, factor):
-    """ Multiplies the sound's speed by some `factor` """
-    indices = np.round( np.arange(0, len(sound_array), factor) )
-    indices = indices[indices < len(sound_array)].astype(int)
-    return sound_array[ indices.astype(int) ]
-
-def stretch(sound_array, f, window_size, h):
+def np_pitchshift(snd_array, n, window_size=2**13, h=2**11, timer=None):
     """ 
-    Stretches the sound by a factor `f`
-    https://zulko.github.io/blog/2014/03/29/soundstretching-and-pitch-shifting-in-python/
+    Changes the pitch of a sound by ``n`` semitones.
 
+    The vocoder pass, normalisation and speedx are audio_common.vocoder's
+    shift_and_stretch, shared with the other audio functions. Stereo input
+    (samples, 2) is shifted in one pass and stays stereo
     """
-    if len(sound_array.shape) == 2:  # Stereo signal
-        sound_array = sound_array.mean(axis=1).astype('int16')  # Convert to mono
-
-    phase  = np.zeros(window_size)
-    hanning_window = np.hanning(window_size)
-    result = np.zeros(int(len(sound_array) / f + window_size))  # Cast to int
-
-    for i in np.arange(0, len(sound_array)-(window_size+h), h*f):
-        a1 = sound_array[int(i): int(i) + window_size]
-        a2 = sound_array[int(i) + h: int(i) + window_size + h]
-
+    return shift_and_stretch(snd_array, n, 1.0, window_size, h, timer).astype('int16')
 
-        s1 =  np.fft.fft(hanning_window * a1)
-        s2 =  np.fft.fft(hanning_window * a2)
-        phase = (phase + np.angle(s2/s1)) % (2*np.pi)  # Corrected modulo
-        a2_rephased = np.fft.ifft(np.abs(s2)*np.exp(1j*phase))
-
-        i2 = int(i/f)
-        result[i2 : i2 + window_size] += (hanning_window * a2_rephased.real)
-
-    result = ((2**(16-4)) * result/result.max())
-    return result.astype('int16')
-
-def stretch_stereo(sound_array, f, window_size, h):
-    if len(sound_array.shape) == 1:
-        # Mono audio
-        return stretch(sound_array, f, window_size, h)
-    
-    # Stereo audio
-    left_channel = stretch(sound_array[:, 0], f, window_size, h)
-    right_channel = stretch(sound_array[:, 1], f, window_size, h)
-    
-    # Combine the two channels back into stereo
-    return np.column_stack((left_channel, right_channel))
-
-def np_pitchshift(snd_array, n, window_size=2**13, h=2**11):
-    """ Changes the pitch of a sound by ``n`` semitones. """
-    factor = 2**(1.0 * n / 12.0)
-    
-    stretched = stretch(snd_array, 1.0/factor, window_size, h)
-    return speedx(stretched[window_size:], factor)
-
-def pitch_shift(audio_bytes, shift_amount):
+def shift_audio(audio_bytes, shift_amount, timer=None):
     assert audio_bytes, "audio_bytes must not be empty"
-    assert isinstance(audio_bytes, bytes), "audio_bytes must be of type bytes"
+    assert isinstance(audio_bytes, RAW_TYPES) or is_stream(audio_bytes), "audio_bytes must be of type bytes"
     assert isinstance(shift_amount, float), "shift_amount must be of type float"
     '''
     shift pitch by n semitones
     https://batulaiko.medium.com/how-to-pitch-shift-in-python-c59b53a84b6d
+    Returns (frame rate, int16 samples) for the caller to encode
     '''
-    log("pitch_shift: Writing audio to buffer", "INFO")
-    audio_buffer = BytesIO(audio_bytes)
-    fr, y = read(audio_buffer)
+    # Decoded by ffmpeg straight from the request bytes, no BytesIO copy for pydub.
+    # The vocoder normalises its output so float samples give the same result as int16 ones
+    log("pitch_shift: Decoding audio", "INFO")
+    y, fr = decode(audio_bytes, mono=False, timer=timer)
+    if y.shape[1] == 1:
+        y = y.reshape(-1)
 
     log("Shifting Pitch", "INFO")
-    if y.ndim == 2:
-        # Stereo audio
-        y_hat = np.column_stack([
-            np_pitchshift(y[:, 0], shift_amount),
-            np_pitchshift(y[:, 1], shift_amount)
-        ])
-    else:
-        # Mono audio
-        y_hat = np_pitchshift(y, shift_amount)
+    # Mono or stereo, both channels are shifted together
+    return fr, np_pitchshift(y, shift_amount, timer=timer)
+
+def pitch_shift(audio_bytes, shift_amount):
+    '''shift pitch by n semitones, returns mp3 bytes'''
+    fr, y_hat = shift_audio(audio_bytes, shift_amount)
 
     log("Pitch Shift: Writing Output", "INFO")
     output_buffer = BytesIO()
@@ -117,22 +80,35 @@ def pitch_shift(audio_bytes, shift_amount):
     return output_buffer.getvalue()
 
 
+@timed_handler("audio_pitch_shift")
 def lambda_handler(event, context):
     try:
         # Check structure
         log("lambda_handler: Checking structure", "INFO")
-        if "body" not in event:
+        if not has_input(event):
             return {
                 "statusCode": 400,
                 "body": json_dumps({"client error": "Missing body in request"})
             }
-        # Check encoding
-        is_base64 = event.get("isBase64Encoded", False)
-        if not is_base64:
+        # Check encoding, raw binary bodies and objects in storage need none
+        if not accepts_input(event):
             return {
                 "statusCode": 422,
                 "body": json_dumps({"client error": "Audio file must be in base64 encoding"})
             }
+        # Optional object in storage in place of the body
+        try:
+            check_input(event)
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json_dumps({"client error": str(e)})
+            }
+        except LookupError as e:
+            return {
+                "statusCode": 404,
+                "body": json_dumps({"client error": str(e)})
+            }
         # Extract query parameters
         log("lambda_handler: Getting query parameters", "INFO")
         parameters = event.get("queryStringParameters", False)
@@ -147,11 +123,23 @@ def lambda_handler(event, context):
                 "statusCode": 422,
                 "body": json_dumps({"client error": "Missing query parameters (shift_amount)"})
             }
+        # Output format from output_format or the Accept header, mp3 by default,
+        # written to storage when an output_bucket is given
+        try:
+            output_format, bitrate = negotiate(parameters, event.get("headers"))
+            output_object = output_reference(parameters, "audio_pitch_shift", output_format)
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json_dumps({"client error": str(e)})
+            }
         
         # Decode body
         log("lambda_handler: Decoding body", "INFO")
+        timer = request_timer()
         try:
-            binary_data = b64decode(event["body"])
+            # An object in storage is streamed to the decoder
+            binary_data = read_input(event, timer)
         except Exception as e:
             log(f"lambda_handler: Base64 decoding failed: {str(e)}", "ERROR")
             return {
@@ -164,6 +152,7 @@ def lambda_handler(event, context):
         try:
             shift_amount = float(shift_amount)
         except Exception as e:
+            close_input(binary_data)
             return {
                 "statusCode": 422,
                 "body": {
@@ -171,22 +160,39 @@ def lambda_handler(event, context):
             }
         log("lambda_handler: Running pitch shift", "INFO")
         try:
-            altered_audio = pitch_shift(binary_data,shift_amount)
+            fr, y_hat = shift_audio(binary_data, shift_amount, timer)
+            if output_object is not None:
+                log(f"lambda_handler: Writing {output_format} to storage", "INFO")
+                reference = write_audio(output_object, y_hat, fr, output_format, bitrate, timer)
+            else:
+                log(f"lambda_handler: Encoding {output_format}", "INFO")
+                altered_audio, media_type = encode(y_hat, fr, output_format, bitrate, timer)
         except Exception as e:
             log(f"lambda_handler: Pitch function failed: {str(e)}", "ERROR")
-            print(f"\n Binary data: {binary_data[:10]}")
+            first_bytes = None if is_stream(binary_data) else bytes(binary_data[:10])
+            print(f"\n Binary data: {first_bytes}")
             return {
                 "statusCode": 500,
                 "body": {
                     "Audio function error": str(e),
-                    "first 10 bytes data" : binary_data[:10]
+                    "first 10 bytes data" : first_bytes
                     }
             }
+        finally:
+            close_input(binary_data)
+
+        if output_object is not None:
+            return {
+                "statusCode": 200,
+                "headers": {"Content-Type": "application/json"},
+                "body": json_dumps(reference)
+            }
 
         # Encode the output
         log("lambda_handler: Encoding output", "INFO")
         try:
-            encoded_audio = b64encode(altered_audio).decode("utf-8")
+            with timer.stage("base64"):
+                encoded_audio = b64encode(altered_audio).decode("utf-8")
         except Exception as e:
             log("Handler - Error encoding:", str(e))
             return {
@@ -196,7 +202,7 @@ def lambda_handler(event, context):
 
         return {
             "statusCode": 200,
-            "headers": {"Content-Type": "audio/mpeg"},
+            "headers": {"Content-Type": media_type},
             "body": encoded_audio,
             "isBase64Encoded": True
         }
@@ -1,6 +1,8 @@
 import unittest
 from unittest.mock import patch
 import json
+import sys
+sys.path.append('..') # shared audio_common package lives in the repository root
 from lambda_function import lambda_handler, pitch_shift, read, write
 import numpy as np
 from io import BytesIO
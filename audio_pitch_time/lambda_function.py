@@ -0,0 +1,172 @@
+import math
+from json import dumps as json_dumps
+from base64 import b64encode
+from time import strftime, gmtime
+from audio_common.decode import decode, is_stream
+from audio_common.encode import encode, negotiate
+from audio_common.timing import request_timer, timed_handler
+from audio_common.body import RAW_TYPES
+from audio_common.storage import has_input, accepts_input, check_input, read_input, close_input, output_reference, write_audio
+from audio_common.vocoder import shift_and_stretch
+
+'''
+Pitch shift and time stretch in one request.
+
+The chain demo ran audio_pitch_shift then audio_time_stretch, so the audio was
+decoded, vocoded and encoded to MP3 twice. A pitch shift of n semitones is a
+stretch by 1/2**(n/12) followed by speeding up by 2**(n/12) (speedx), and a time
+stretch by f is a stretch by f, so both fold into one vocoder pass:
+
+    stretch by f / 2**(n/12), then speedx by 2**(n/12)
+
+giving the duration of the time stretch and the pitch of the shift, with one
+decode, one vocoder pass, one resample and one encode. The fold is
+audio_common.vocoder's shift_and_stretch, which the pitch shift, time stretch
+and pipeline functions run too.
+
+Query parameters:
+    shift_amount: semitones (default 0)
+    stretch_amount: rate, > 1 faster, < 1 slower (default 1)
+    output_format / bitrate or the Accept header, see audio_common.encode
+'''
+
+WINDOW_SIZE = 2**13
+HOP = 2**11
+
+
+def log(message,type):
+    """ Helper function to log messages with a timestamp. """
+    print(f"{strftime('%d/%m/%Y %H:%M:%S', gmtime())} [{type}] {message}")
+
+def pitch_time(sound_array, shift_amount=0.0, stretch_amount=1.0, window_size=WINDOW_SIZE, h=HOP, timer=None):
+    '''
+    Shift the pitch by shift_amount semitones and stretch the time by stretch_amount in one vocoder pass.
+    With shift_amount 0 this is the time stretch, with stretch_amount 1 the pitch shift.
+    '''
+    return shift_and_stretch(sound_array, shift_amount, stretch_amount, window_size, h, timer).astype('int16')
+
+def pitch_time_audio(audio_bytes, shift_amount=0.0, stretch_amount=1.0, timer=None):
+    '''
+    Input: encoded audio, semitones, rate
+    Output: (sample rate, int16 samples) for the caller to encode
+    '''
+    assert audio_bytes, "audio_bytes must not be empty"
+    assert isinstance(audio_bytes, RAW_TYPES) or is_stream(audio_bytes), "audio_bytes must be of type bytes"
+
+    samples, sample_rate = decode(audio_bytes, mono=False, timer=timer)
+    if samples.shape[1] == 1:
+        samples = samples.reshape(-1)
+    return sample_rate, pitch_time(samples, shift_amount, stretch_amount, timer=timer)
+
+
+@timed_handler("audio_pitch_time")
+def lambda_handler(event, context):
+    try:
+        # Check structure
+        log("lambda_handler: Checking structure", "INFO")
+        if not has_input(event):
+            return {
+                "statusCode": 400,
+                "body": json_dumps({"client error": "Missing body in request"})
+            }
+        # Check encoding, raw binary bodies and objects in storage need none
+        if not accepts_input(event):
+            return {
+                "statusCode": 422,
+                "body": json_dumps({"client error": "Audio file must be in base64 encoding"})
+            }
+        # Optional object in storage in place of the body
+        try:
+            check_input(event)
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json_dumps({"client error": str(e)})
+            }
+        except LookupError as e:
+            return {
+                "statusCode": 404,
+                "body": json_dumps({"client error": str(e)})
+            }
+        # Extract query parameters
+        log("lambda_handler: Getting query parameters", "INFO")
+        parameters = event.get("queryStringParameters", False)
+        if not parameters or ("shift_amount" not in parameters and "stretch_amount" not in parameters):
+            return {
+                "statusCode": 422,
+                "body": json_dumps({"client error": "Missing query parameters (shift_amount and/or stretch_amount)"})
+            }
+        try:
+            shift_amount = float(parameters.get("shift_amount", 0))
+            stretch_amount = float(parameters.get("stretch_amount", 1))
+        except (TypeError, ValueError):
+            shift_amount = stretch_amount = math.nan
+        # inf and nan parse as floats but the vocoder cannot use them
+        if not (math.isfinite(shift_amount) and math.isfinite(stretch_amount) and stretch_amount > 0):
+            return {
+                "statusCode": 422,
+                "body": json_dumps({"client error": "shift_amount must be a number and stretch_amount a positive number"})
+            }
+        # Output format from output_format or the Accept header, mp3 by default,
+        # written to storage when an output_bucket is given
+        try:
+            output_format, bitrate = negotiate(parameters, event.get("headers"))
+            output_object = output_reference(parameters, "audio_pitch_time", output_format)
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json_dumps({"client error": str(e)})
+            }
+
+        # Decode body
+        log("lambda_handler: Decoding body", "INFO")
+        try:
+            # An object in storage is streamed to the decoder
+            binary_data = read_input(event)
+        except Exception as e:
+            log(f"lambda_handler: Base64 decoding failed: {str(e)}", "ERROR")
+            return {
+                "statusCode": 500,
+                "body": json_dumps({"Decoding Error": str(e)})
+            }
+
+        log("lambda_handler: Running pitch shift and time stretch", "INFO")
+        try:
+            timer = request_timer()
+            sample_rate, altered = pitch_time_audio(binary_data, shift_amount, stretch_amount, timer)
+            if output_object is not None:
+                reference = write_audio(output_object, altered, sample_rate, output_format, bitrate, timer)
+            else:
+                altered_audio, media_type = encode(altered, sample_rate, output_format, bitrate, timer)
+                with timer.stage("base64"):
+                    encoded_audio = b64encode(altered_audio).decode("utf-8")
+        except Exception as e:
+            log(f"lambda_handler: Pitch time function failed: {str(e)}", "ERROR")
+            return {
+                "statusCode": 500,
+                "body": json_dumps({"Audio function error": str(e)})
+            }
+        finally:
+            close_input(binary_data)
+
+        if output_object is not None:
+            return {
+                "statusCode": 200,
+                "headers": {"Content-Type": "application/json"},
+                "body": json_dumps(reference)
+            }
+
+        return {
+            "statusCode": 200,
+            "headers": {"Content-Type": media_type},
+            "body": encoded_audio,
+            "isBase64Encoded": True
+        }
+
+    # Catch any other exceptions
+    except Exception as e:
+        print("Error - other:", str(e))
+        return {
+            "statusCode": 500,
+            "body": json_dumps({"other error": str(e)})
+        }
@@ -0,0 +1,109 @@
+import unittest
+from unittest.mock import patch
+import json
+import sys
+import tempfile
+sys.path.append('..') # shared audio_common package lives in the repository root
+from lambda_function import lambda_handler, pitch_time
+from audio_common.encode import encode
+from audio_common.decode import decode
+from audio_common.storage import LocalStorage
+from audio_common.testing import sine, RATE
+from audio_common.vocoder import shift_and_stretch
+import numpy as np
+from base64 import b64encode
+
+
+def peak_frequency(samples, rate=RATE):
+    fft_data = np.fft.rfft(samples)
+    freqs = np.fft.rfftfreq(len(samples))
+    return abs(freqs[np.argmax(np.abs(fft_data))] * rate)
+
+
+class TestPitchTime(unittest.TestCase):
+
+    # --- Tests for the combined engine ---
+
+    def test_matches_shift_and_stretch(self):
+        '''The engine is the shared shift_and_stretch, as int16'''
+        wave = sine(440, 3)
+        for shift_amount, stretch_amount in ((4.0, 1.0), (0.0, 1.5), (-3.0, 0.8)):
+            np.testing.assert_array_equal(pitch_time(wave, shift_amount, stretch_amount),
+                                          shift_and_stretch(wave, shift_amount, stretch_amount).astype(np.int16))
+
+    def test_shift_and_stretch(self):
+        '''One pass gives the duration of the stretch and the pitch of the shift'''
+        duration = 5
+        shift_amount = 12.0
+        stretch_amount = 1.5
+        altered = pitch_time(sine(440, duration), shift_amount, stretch_amount)
+
+        self.assertAlmostEqual(len(altered) / RATE, duration / stretch_amount, delta=0.5)
+        self.assertAlmostEqual(peak_frequency(altered), 880, delta=5)
+
+    def test_stereo(self):
+        '''Stereo input stays stereo'''
+        wave = np.stack([sine(440, 2), sine(660, 2)], axis=1)
+        altered = pitch_time(wave, 2.0, 0.8)
+        self.assertEqual(altered.ndim, 2)
+        self.assertEqual(altered.shape[1], 2)
+
+    # --- Tests for the handler ---
+
+    def event(self, parameters):
+        data, _ = encode(sine(440, 3), RATE, "wav")
+        return {
+            "body": b64encode(data).decode("utf-8"),
+            "isBase64Encoded": True,
+            "queryStringParameters": parameters
+        }
+
+    def test_valid_run(self):
+        response = lambda_handler(self.event({"shift_amount": "3", "stretch_amount": "1.25",
+                                              "output_format": "pcm_s16le"}), None)
+        self.assertEqual(response["statusCode"], 200)
+        self.assertTrue(response["headers"]["Content-Type"].startswith("audio/x-raw"))
+
+    def test_missing_parameters(self):
+        response = lambda_handler(self.event({"output_format": "wav"}), None)
+        self.assertEqual(response["statusCode"], 422)
+
+    def test_invalid_amounts(self):
+        for parameters in ({"shift_amount": "up"}, {"stretch_amount": "0"}, {"stretch_amount": "-1"},
+                           {"stretch_amount": "inf"}, {"stretch_amount": "nan"}, {"shift_amount": "-inf"}):
+            response = lambda_handler(self.event(parameters), None)
+            self.assertEqual(response["statusCode"], 422)
+            self.assertIn("client error", json.loads(response["body"]))
+
+    def test_invalid_output_format(self):
+        response = lambda_handler(self.event({"shift_amount": "2", "output_format": "aiff"}), None)
+        self.assertEqual(response["statusCode"], 422)
+
+    def test_missing_body(self):
+        response = lambda_handler({"isBase64Encoded": True}, None)
+        self.assertEqual(response["statusCode"], 400)
+
+    def test_storage_references(self):
+        '''Audio read from and written to storage, only the reference comes back'''
+        with tempfile.TemporaryDirectory() as directory:
+            storage = LocalStorage(directory)
+            with storage.writer("audio", "in.wav") as f:
+                f.write(encode(sine(440, 3), RATE, "wav")[0])
+
+            with patch("audio_common.storage.default", storage):
+                response = lambda_handler({"queryStringParameters": {
+                    "stretch_amount": "1.5", "output_format": "wav", "input_bucket": "audio",
+                    "input_key": "in.wav", "output_bucket": "audio", "output_key": "out/stretched.wav"}}, None)
+                missing = lambda_handler({"queryStringParameters": {
+                    "stretch_amount": "1.5", "input_bucket": "audio", "input_key": "none.wav"}}, None)
+
+            self.assertEqual(response["statusCode"], 200)
+            self.assertEqual(json.loads(response["body"]),
+                             {"bucket": "audio", "key": "out/stretched.wav", "content_type": "audio/wav"})
+            audio, _ = decode(storage.read("audio", "out/stretched.wav"))
+            self.assertAlmostEqual(len(audio) / RATE, 2, delta=0.3)
+            self.assertEqual(missing["statusCode"], 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
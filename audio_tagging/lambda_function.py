@@ -0,0 +1,194 @@
+import json
+from essentia import standard as es
+import numpy as np
+from audio_common.embeddings import get_embeddings
+from audio_common.decode import RESAMPLE_QUALITIES, DEFAULT_QUALITY
+from audio_common.timing import stage, note, request_timer, timed_handler
+from audio_common.models import registry, preload_enabled
+from audio_common.labels import GENRES, INSTRUMENTS, top_items, check_top_n
+from audio_common.body import RAW_TYPES
+from audio_common.storage import has_input, accepts_input, check_input, read_input
+
+'''
+Genre and instrument tagging in one request.
+
+audio_genre and audio_instrument_detection both decode the upload and run the
+same discogs-effnet-bs64 embedding model before their own classifier head. Here
+the audio is decoded and embedded once and every requested head is run on the
+same embedding matrix.
+
+Query parameters:
+    top_n: number of labels returned per head
+    heads: comma separated heads to run (default every head in HEADS)
+    resample_quality: fast, default or high, see audio_common.decode
+
+To add a head register its graph below and add it to HEADS.
+'''
+
+# Graphs are read once per container, see audio_common.models
+registry.register("genre_discogs400", lambda: es.TensorflowPredict2D(graphFilename="genre_discogs400-discogs-effnet-1.pb", input="serving_default_model_Placeholder", output="PartitionedCall:0"))
+registry.register("mtg_jamendo_instrument", lambda: es.TensorflowPredict2D(graphFilename="mtg_jamendo_instrument-discogs-effnet-1.pb"))
+
+# Head name used in requests -> (registered model, LabelSet of its outputs)
+HEADS = {
+    "genre": ("genre_discogs400", GENRES),
+    "instrument": ("mtg_jamendo_instrument", INSTRUMENTS),
+}
+
+
+def tag_activations(audio_bytes, heads, timer=None, quality=DEFAULT_QUALITY):
+    '''
+    Input: audio bytes, list of head names
+    Output: {head: mean activation of every label, in the order of its LabelSet}
+    '''
+    assert audio_bytes, "audio_bytes must not be empty"
+    assert isinstance(audio_bytes, RAW_TYPES), "audio_bytes must be of type bytes"
+    assert heads, "heads must not be empty"
+    unknown = [head for head in heads if head not in HEADS]
+    assert not unknown, f"Unknown heads: {', '.join(unknown)}"
+
+    # Cached by the content of the upload, decoded and embedded on a miss
+    embeddings = get_embeddings(audio_bytes, timer, quality=quality)
+
+    output = {}
+    for head in heads:
+        model_name = HEADS[head][0]
+        with stage(timer, f"predictions.{head}"):
+            activations = registry.get(model_name)(embeddings)
+        output[head] = np.mean(activations, axis=0)
+
+    return output
+
+
+def get_tags(audio_bytes, heads, timer=None):
+    '''
+    Input: audio bytes, list of head names
+    Output: {head: {label: mean activation}}
+    '''
+    activations = tag_activations(audio_bytes, heads, timer)
+    return {head: dict(zip(HEADS[head][1].names, head_activations.tolist()))
+            for head, head_activations in activations.items()}
+
+
+def process_tags(predictions, n):
+    '''Return the top n outputs of every head'''
+    output = {}
+    for head, head_predictions in predictions.items():
+        assert n < len(head_predictions), f'N must be less than the number of {head} predictions'
+        output[head] = top_items(head_predictions, n)
+
+    return output
+
+
+@timed_handler("audio_tagging")
+def handler(event, context):
+    try:
+        # Check structure
+        if not has_input(event):
+            return {
+                "statusCode": 400,
+                "body": json.dumps({"error": "Missing body in request"})
+            }
+
+        # Check encoding, raw binary bodies and objects in storage need none
+        if not accepts_input(event):
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"error": "Audio file must be in base64 encoding"})
+            }
+
+        # Optional object in storage in place of the body
+        try:
+            check_input(event)
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": str(e)})
+            }
+        except LookupError as e:
+            return {
+                "statusCode": 404,
+                "body": json.dumps({"client error": str(e)})
+            }
+
+        parameters = event.get("queryStringParameters", False)
+        if not parameters:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": "Missing query parameters - queryStringParameters: params_dict"})
+            }
+        top_n = parameters.get("top_n", False)
+        if not top_n:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": "Missing query parameters (top_n)"})
+            }
+        try:
+            top_n = int(top_n)
+        except Exception as e:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": "top_n parameter is not an integer"})
+            }
+
+        # Heads to run, every head by default
+        heads = [head.strip() for head in parameters.get("heads", ",".join(HEADS)).split(",") if head.strip()]
+        unknown = [head for head in heads if head not in HEADS]
+        if not heads or unknown:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": f"heads parameter must be a comma separated list of: {', '.join(HEADS)}"})
+            }
+        try:
+            check_top_n(top_n, min(len(HEADS[head][1]) for head in heads))
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": str(e)})
+            }
+
+        quality = parameters.get("resample_quality", DEFAULT_QUALITY)
+        if quality not in RESAMPLE_QUALITIES:
+            return {
+                "statusCode": 422,
+                "body": json.dumps({"client error": f"resample_quality parameter must be one of: {', '.join(RESAMPLE_QUALITIES)}"})
+            }
+
+        # Main function code
+        try:
+            timer = request_timer()
+            # Decode body, an object in storage is read whole as the embedding cache hashes it
+            binary_data = read_input(event, timer, stream=False)
+            activations = tag_activations(binary_data, heads, timer, quality)
+            # Load times and hit counts of the graphs, logged in the request's metric record
+            note(timer, "models", registry.report())
+            final_output = {}
+            for head, head_activations in activations.items():
+                labels = HEADS[head][1]
+                final_output[head] = labels.top(head_activations, top_n)
+
+            return {
+                "statusCode": 200,
+                "headers": {"X-Embedding-Cache": timer.notes.get("embedding_cache", "miss")},
+                "body": json.dumps(final_output)
+            }
+        # Handle exception from main function
+        except Exception as e:
+            print("Error:", str(e))
+            return {
+                "statusCode": 500,
+                "body": json.dumps({"error, decoding or tagging function failed": str(e)})
+            }
+
+    # Catch any other exceptions
+    except Exception as e:
+        print("Error:", str(e))
+        return {
+            "statusCode": 500,
+            "body": json.dumps({"error": str(e)})
+        }
+
+
+# Load the graphs during the container init phase so warm requests only pay for inference
+if preload_enabled():
+    registry.preload()
@@ -0,0 +1,189 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import io
+import json
+from contextlib import redirect_stdout
+import sys
+sys.path.append('..') # shared audio_common package lives in the repository root
+import numpy as np
+from lambda_function import handler, get_tags, process_tags, HEADS
+from audio_common.cache import ArrayCache
+
+class TestAudioTagging(unittest.TestCase):
+
+    def setUp(self):
+        # Fake embeddings must not end up in the shared /tmp cache
+        self.cache = ArrayCache(memory_bytes=0, disk_bytes=0)
+        patcher = patch('audio_common.embeddings.embedding_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fake_models(self):
+        '''Mock models standing in for the TensorFlow graphs, one embedding row per patch'''
+        models = {'discogs_effnet': MagicMock(return_value=np.zeros((3, 1280), dtype=np.float32))}
+        for model_name, labels in HEADS.values():
+            activations = np.tile(np.linspace(0, 1, len(labels), dtype=np.float32), (3, 1))
+            models[model_name] = MagicMock(return_value=activations)
+        return models
+
+    # --- Testing For Get Tags Function ---
+    def test_embeddings_computed_once(self):
+        '''Test every head runs on one embedding pass'''
+
+        models = self.fake_models()
+        with patch('audio_common.embeddings.decode', return_value=(np.zeros(16000, dtype=np.float32), 16000)) as decode, \
+                patch('lambda_function.registry.get', side_effect=models.get):
+            output = get_tags(b'audio', ['genre', 'instrument'])
+
+        decode.assert_called_once()
+        models['discogs_effnet'].assert_called_once()
+        for model_name, labels in HEADS.values():
+            models[model_name].assert_called_once()
+        self.assertEqual(len(output['genre']), len(HEADS['genre'][1]))
+        self.assertEqual(len(output['instrument']), len(HEADS['instrument'][1]))
+
+    def test_only_requested_heads(self):
+        '''Test heads that were not asked for are not run'''
+
+        models = self.fake_models()
+        with patch('audio_common.embeddings.decode', return_value=(np.zeros(16000, dtype=np.float32), 16000)), \
+                patch('lambda_function.registry.get', side_effect=models.get):
+            output = get_tags(b'audio', ['instrument'])
+
+        self.assertEqual(list(output), ['instrument'])
+        models[HEADS['genre'][0]].assert_not_called()
+
+    def test_get_tags_unknown_head(self):
+        '''Test asking for a head that does not exist'''
+
+        with self.assertRaises(AssertionError) as assertion:
+            get_tags(b'audio', ['mood'])
+
+        self.assertEqual(str(assertion.exception), 'Unknown heads: mood')
+
+    def test_get_tags_empty_bytes(self):
+        '''Test with empty audio bytes'''
+
+        with self.assertRaises(AssertionError) as assertion:
+            get_tags(b'', ['genre'])
+
+        self.assertEqual(str(assertion.exception), 'audio_bytes must not be empty')
+
+    # --- Testing For Process Tags Function ---
+    def test_process_tags(self):
+        '''Test top n is taken for every head'''
+        predictions = {
+            'genre': {"Genre A": 0.5, "Genre B": 0.3, "Genre C": 0.2},
+            'instrument': {"piano": 0.1, "drums": 0.7, "voice": 0.4},
+        }
+
+        output = process_tags(predictions, 2)
+        self.assertEqual(output, {
+            'genre': {"Genre A": 0.5, "Genre B": 0.3},
+            'instrument': {"drums": 0.7, "voice": 0.4},
+        })
+
+    # --- Testing For Handler Function ---
+    def test_valid_payload(self):
+        '''Test both heads are returned in one response'''
+
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            payload = json.load(f)
+
+        models = self.fake_models()
+        with patch('audio_common.embeddings.decode', return_value=(np.zeros(16000, dtype=np.float32), 16000)), \
+                patch('lambda_function.registry.get', side_effect=models.get):
+            response = handler(payload, None)
+
+        body = json.loads(response['body'])
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(set(body), {'genre', 'instrument'})
+        self.assertEqual(len(body['genre']), payload['queryStringParameters']['top_n'])
+
+    def test_models_in_metric_record(self):
+        '''Test the model counters go in the one metric record the request logs'''
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            payload = json.load(f)
+
+        models = self.fake_models()
+        output = io.StringIO()
+        with patch('audio_common.embeddings.decode', return_value=(np.zeros(16000, dtype=np.float32), 16000)), \
+                patch('lambda_function.registry.get', side_effect=models.get), redirect_stdout(output):
+            handler(payload, None)
+
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn('genre_discogs400', json.loads(lines[0])['notes']['models'])
+
+    def test_cache_hit(self):
+        '''Test a repeat upload is answered from the embedding cache'''
+
+        self.cache.memory_bytes = 2**20
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            payload = json.load(f)
+
+        models = self.fake_models()
+        with patch('audio_common.embeddings.decode', return_value=(np.zeros(16000, dtype=np.float32), 16000)), \
+                patch('lambda_function.registry.get', side_effect=models.get):
+            first = handler(payload, None)
+            second = handler(payload, None)
+
+        self.assertEqual(first['headers']['X-Embedding-Cache'], 'miss')
+        self.assertEqual(second['headers']['X-Embedding-Cache'], 'memory')
+        models['discogs_effnet'].assert_called_once()
+        self.assertEqual(first['body'], second['body'])
+
+    def test_invalid_heads(self):
+        '''Test an unknown head in the heads parameter'''
+
+        expected_output = {
+            "statusCode" : 422,
+            "body" : '{"client error": "heads parameter must be a comma separated list of: genre, instrument"}'
+        }
+
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            payload = json.load(f)
+            payload['queryStringParameters']['heads'] = 'genre,mood'
+
+        response = handler(payload, None)
+        self.assertEqual(response['statusCode'], expected_output['statusCode'])
+        self.assertEqual(response['body'], expected_output['body'])
+
+    def test_handler_missing_body(self):
+        '''Test missing body in payload'''
+        payload = {
+            'isBase64Encoded': True,
+            'queryStringParameters': {
+                "top_n": 5
+            }
+        }
+
+        response = handler(payload, None)
+        self.assertEqual(response["statusCode"], 400)
+        self.assertEqual(response['body'], json.dumps({"error": "Missing body in request"}))
+
+    def test_top_n_out_of_range(self):
+        '''Test top_n past the smallest head asked for is refused before anything runs'''
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            payload = json.load(f)
+            payload['queryStringParameters']['top_n'] = '40'
+
+        response = handler(payload, None)
+        self.assertEqual(response['statusCode'], 422)
+        self.assertEqual(response['body'], json.dumps({"client error": "top_n parameter must be an integer from 0 to 39"}))
+
+    def test_missing_top_n(self):
+        '''Test for when query string params exists but no top n parameter is inside'''
+
+        expected_output = {
+            "statusCode" : 422,
+            "body" : '{"client error": "Missing query parameters (top_n)"}'
+        }
+
+        with open('../general_testing/mp3_api_gateway.json') as f:
+            payload = json.load(f)
+            payload['queryStringParameters'].pop('top_n', None)
+
+        response = handler(payload, None)
+        self.assertEqual(response['statusCode'], expected_output['statusCode'])
+        self.assertEqual(response['body'], expected_output['body'])
@@ -1,7 +1,12 @@
 from json import dumps as json_dumps
 from pydub import AudioSegment
-from base64 import b64decode, b64encode
+from base64 import b64encode
 import numpy as np
+from audio_common.vocoder import shift_and_stretch, StreamingVocoder, StreamingNormaliser
+from audio_common.encode import encode, encode_blocks, negotiate, DEFAULT_FORMAT
+from audio_common.decode import decode, is_stream, BlockDecoder
+from audio_common.timing import stage, request_timer, timed_handler
+from audio_common.storage import has_input, accepts_input, check_input, read_input, close_input, output_reference, write_audio, write_audio_blocks
 from time import strftime, gmtime
 from io import BytesIO
 
@@ -46,35 +51,54 @@ def log(message,type):
     """ Helper function to log messages with a timestamp. """
     print(f"{strftime('%d/%m/%Y %H:%M:%S', gmtime())} [{type}] {message}")
 
-def stretch(sound_array, f, window_size, h):
+def stretch(sound_array, f, window_size, h, timer=None):
     """ 
     Stretches the sound by a factor `f`
-    https://zulko.github.io/blog/2014/03/29/soundstretching-and-pitch-stretching-in-python/
 
+    The vocoder pass and normalisation are audio_common.vocoder's
+    shift_and_stretch, shared with the other audio functions. Stereo input
+    (samples, 2) is stretched in one pass and stays stereo
     """
-    if len(sound_array.shape) == 2:  # Stereo signal
-        sound_array = sound_array.mean(axis=1).astype('int16')  # Convert to mono
-
-    phase  = np.zeros(window_size)
-    hanning_window = np.hanning(window_size)
-    result = np.zeros(int(len(sound_array) / f + window_size))  # Cast to int
-
-    for i in np.arange(0, len(sound_array)-(window_size+h), h*f):
-        a1 = sound_array[int(i): int(i) + window_size]
-        a2 = sound_array[int(i) + h: int(i) + window_size + h]
+    return shift_and_stretch(sound_array, 0.0, f, window_size, h, timer).astype('int16')
 
+def stream_stretch(blocks, f, channels, window_size=2**13, h=2**11, timer=None):
+    """
+    Stretches float blocks (samples, channels) by a factor `f`, yielding int16 blocks
 
-        s1 =  np.fft.fft(hanning_window * a1)
-        s2 =  np.fft.fft(hanning_window * a2)
-        phase = (phase + np.angle(s2/s1)) % (2*np.pi)  # Corrected modulo
-        a2_rephased = np.fft.ifft(np.abs(s2)*np.exp(1j*phase))
+    The same vocoder as stretch run a block at a time (audio_common.vocoder.StreamingVocoder)
+    so only about a window's worth of frames is held rather than the whole output.
+    The output is scaled with a fixed gain (StreamingNormaliser) so its level
+    follows the input's: a full scale input peaks at about stretch's level, a
+    quieter one comes out quieter where stretch would bring its peak up.
+    """
+    vocoder = StreamingVocoder(f, channels, window_size, h)
+    normaliser = StreamingNormaliser(channels, window_size=window_size, hop=h)
+    for block in blocks:
+        # Timed between yields so the consumer's encode is not counted
+        with stage(timer, "vocoder"):
+            samples = normaliser.push(vocoder.push(block))
+        if len(samples):
+            yield samples
+    with stage(timer, "vocoder"):
+        tail = (normaliser.push(vocoder.finish()), normaliser.finish())
+    for samples in tail:
+        if len(samples):
+            yield samples
 
-        i2 = int(i/f)
-        result[i2 : i2 + window_size] += (hanning_window * a2_rephased.real)
+def stretch_audio(audio_bytes, stretch_amount, timer=None):
+    '''
+    Time stretch of an audio file by a specified stretch_amount/rate
+    Returns (frame rate, int16 samples) for the caller to encode
 
-    result = ((2**(16-4)) * result/result.max())
-    return result.astype('int16')
+    The body is decoded by ffmpeg straight from the request bytes (any format
+    ffmpeg reads), there is no BytesIO copy for pydub. The vocoder normalises its
+    output so the float samples give the same result as pydub's int16 ones.
+    '''
+    y, fr = decode(audio_bytes, mono=False, timer=timer)
+    if y.shape[1] == 1:
+        y = y.reshape(-1)
 
+    return fr, stretch(y, stretch_amount, window_size=2**13, h=2**11, timer=timer)
 
 def time_stretch(audio_bytes, stretch_amount):
     '''
@@ -82,11 +106,7 @@ def time_stretch(audio_bytes, stretch_amount):
     rate > 1 then the audio is sped up
     0 < rate < 1 then the audio is slowed down
     '''
-    # Create mp3 audio
-    audio_bytes = BytesIO(audio_bytes)
-    fr, y = read(audio_bytes)
-
-    y_hat = stretch(y, stretch_amount, window_size=2**13, h=2**11)
+    fr, y_hat = stretch_audio(audio_bytes, stretch_amount)
 
     output_buffer = BytesIO()
     write(output_buffer, fr, y_hat)
@@ -96,25 +116,47 @@ def time_stretch(audio_bytes, stretch_amount):
     
     return output_buffer.getvalue()
 
+def stream_time_stretch(audio_bytes, stretch_amount, output_format=DEFAULT_FORMAT, bitrate=None, timer=None):
+    '''
+    Time stretch of an audio file decoded, stretched and encoded a block at a time (mode=stream)
+    Returns (encoded bytes, content type)
+    '''
+    with BlockDecoder(audio_bytes, mono=False, timer=timer) as decoder:
+        blocks = stream_stretch(decoder, stretch_amount, decoder.channels, timer=timer)
+        return encode_blocks(blocks, decoder.sample_rate, decoder.channels, output_format, bitrate, timer)
+
 
 
 
+@timed_handler("audio_time_stretch")
 def lambda_handler(event, context):
     try:
         # Check structure
         log("lambda_handler: Checking structure", "INFO")
-        if "body" not in event:
+        if not has_input(event):
             return {
                 "statusCode": 400,
                 "body": json_dumps({"client error": "Missing body in request"})
             }
-        # Check encoding
-        is_base64 = event.get("isBase64Encoded", False)
-        if not is_base64:
+        # Check encoding, raw binary bodies and objects in storage need none
+        if not accepts_input(event):
             return {
                 "statusCode": 422,
                 "body": json_dumps({"client error": "Audio file must be in base64 encoding"})
             }
+        # Optional object in storage in place of the body
+        try:
+            check_input(event)
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json_dumps({"client error": str(e)})
+            }
+        except LookupError as e:
+            return {
+                "statusCode": 404,
+                "body": json_dumps({"client error": str(e)})
+            }
         # Extract query parameters
         log("lambda_handler: Getting query parameters", "INFO")
         parameters = event.get("queryStringParameters", False)
@@ -129,11 +171,31 @@ def lambda_handler(event, context):
                 "statusCode": 422,
                 "body": json_dumps({"client error": "Missing query parameters (stretch_amount)"})
             }
+        # Optional processing mode, memory by default. stream keeps memory use constant
+        # but scales with a fixed gain rather than normalising the peak (see stream_stretch)
+        mode = parameters.get("mode", "memory")
+        if mode not in ("stream", "memory"):
+            return {
+                "statusCode": 422,
+                "body": json_dumps({"client error": "mode parameter must be stream or memory"})
+            }
+        # Output format from output_format or the Accept header, mp3 by default,
+        # written to storage when an output_bucket is given
+        try:
+            output_format, bitrate = negotiate(parameters, event.get("headers"))
+            output_object = output_reference(parameters, "audio_time_stretch", output_format)
+        except ValueError as e:
+            return {
+                "statusCode": 422,
+                "body": json_dumps({"client error": str(e)})
+            }
         
         # Decode body
         log("lambda_handler: Decoding body", "INFO")
+        timer = request_timer()
         try:
-            binary_data = b64decode(event["body"])
+            # An object in storage is streamed to the decoder
+            binary_data = read_input(event, timer)
         except Exception as e:
             log(f"lambda_handler: Base64 decoding failed: {str(e)}", "ERROR")
             return {
@@ -143,6 +205,7 @@ def lambda_handler(event, context):
         try:
             stretch_amount = float(stretch_amount)
         except Exception as e:
+            close_input(binary_data)
             return {
                 "statusCode": 422,
                 "body": {
@@ -152,21 +215,48 @@ def lambda_handler(event, context):
         # Run duration function
         log("lambda_handler: Running time stretch", "INFO")
         try:
-            altered_audio = time_stretch(binary_data,stretch_amount)
+            if mode == "stream" and output_object is not None:
+                # Decoded, stretched and written a block at a time
+                log(f"lambda_handler: Streaming {output_format} to storage", "INFO")
+                with BlockDecoder(binary_data, mono=False, timer=timer) as decoder:
+                    blocks = stream_stretch(decoder, stretch_amount, decoder.channels, timer=timer)
+                    reference = write_audio_blocks(output_object, blocks, decoder.sample_rate, decoder.channels,
+                                                   output_format, bitrate, timer)
+            elif mode == "stream":
+                log(f"lambda_handler: Streaming {output_format}", "INFO")
+                altered_audio, media_type = stream_time_stretch(binary_data, stretch_amount, output_format, bitrate, timer)
+            else:
+                fr, y_hat = stretch_audio(binary_data, stretch_amount, timer)
+                if output_object is not None:
+                    log(f"lambda_handler: Writing {output_format} to storage", "INFO")
+                    reference = write_audio(output_object, y_hat, fr, output_format, bitrate, timer)
+                else:
+                    log(f"lambda_handler: Encoding {output_format}", "INFO")
+                    altered_audio, media_type = encode(y_hat, fr, output_format, bitrate, timer)
         except Exception as e:
             log(f"lambda_handler: Stretch function failed: {str(e)}", "ERROR")
             return {
                 "statusCode": 500,
                 "body": {
                     "Audio function error": str(e),
-                    "first 10 bytes data" : binary_data[:10]
+                    "first 10 bytes data" : None if is_stream(binary_data) else bytes(binary_data[:10])
                     }
             }
+        finally:
+            close_input(binary_data)
+
+        if output_object is not None:
+            return {
+                "statusCode": 200,
+                "headers": {"Content-Type": "application/json"},
+                "body": json_dumps(reference)
+            }
 
         # Encode the output
         log("lambda_handler: Encoding output", "INFO")
         try:
-            encoded_audio = b64encode(altered_audio).decode("utf-8")
+            with timer.stage("base64"):
+                encoded_audio = b64encode(altered_audio).decode("utf-8")
         except Exception as e:
             log("Handler - Error encoding:", str(e))
             return {
@@ -176,7 +266,7 @@ def lambda_handler(event, context):
 
         return {
             "statusCode": 200,
-            "headers": {"Content-Type": "audio/mpeg"},
+            "headers": {"Content-Type": media_type},
             "body": encoded_audio,
             "isBase64Encoded": True
         }
@@ -1,9 +1,13 @@
 import unittest
 from unittest.mock import patch
 import json
-from lambda_function import lambda_handler, time_stretch, read, write
+import sys
+sys.path.append('..') # shared audio_common package lives in the repository root
+from lambda_function import lambda_handler, time_stretch, stretch, stream_stretch, read, write
 import numpy as np
 from io import BytesIO
+from base64 import b64decode
+from audio_common.timing import parse_server_timing
 
 class TestTimeStretch(unittest.TestCase):
     
@@ -48,6 +52,21 @@ class TestTimeStretch(unittest.TestCase):
         self.assertAlmostEqual(output_duration, expected_output['duration'],delta=1)
         self.assertAlmostEqual(output_frequency, expected_output['frequency'], delta=1)
 
+    def test_stretch_stereo(self):
+        '''Test stereo input stays stereo and keeps the channels apart'''
+
+        rate = 44100
+        stretch_factor = 1.5
+        t = np.linspace(0, 2, rate * 2)
+        left = (np.sin(2 * np.pi * 440 * t) * 32767).astype(np.int16)
+        stereo = np.column_stack((left, np.zeros_like(left)))
+
+        stretched = stretch(stereo, stretch_factor, window_size=2**13, h=2**11)
+
+        self.assertEqual(stretched.shape, (int(len(stereo) / stretch_factor + 2**13), 2))
+        self.assertTrue(stretched[:, 0].any())
+        self.assertFalse(stretched[:, 1].any())
+
     # --- Test for lambda function ---
 
     def test_valid_run(self):
@@ -80,6 +99,104 @@ class TestTimeStretch(unittest.TestCase):
 
 
 
+    def test_output_format(self):
+        '''Test the output is encoded in the requested format'''
+        with open("../general_testing/mp3_api_gateway.json", 'r') as file:
+            payload = json.load(file)
+            payload['queryStringParameters']['output_format'] = 'wav'
+            payload['queryStringParameters']['mode'] = 'memory'
+
+        samples = (np.sin(np.arange(44100) / 10) * 10000).astype(np.int16)
+        with patch('lambda_function.decode', return_value=(samples.reshape(-1, 1) / 2**15, 44100)):
+            response = lambda_handler(payload, None)
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(response['headers']['Content-Type'], 'audio/wav')
+        self.assertEqual(b64decode(response['body'])[:4], b'RIFF')
+
+    def test_accept_header(self):
+        '''Test the format is taken from the Accept header without output_format'''
+        with open("../general_testing/mp3_api_gateway.json", 'r') as file:
+            payload = json.load(file)
+            payload['headers'] = {'Accept': 'audio/x-raw'}
+            payload['queryStringParameters']['mode'] = 'memory'
+
+        samples = (np.sin(np.arange(44100) / 10) * 10000).astype(np.int16)
+        with patch('lambda_function.decode', return_value=(samples.reshape(-1, 1) / 2**15, 44100)):
+            response = lambda_handler(payload, None)
+
+        self.assertEqual(response['headers']['Content-Type'], 'audio/x-raw; format=S16LE; rate=44100; channels=1')
+        self.assertEqual(len(b64decode(response['body'])), 2 * int(len(samples) / 1.5 + 2**13))
+
+    def test_memory_timing(self):
+        '''Test the vocoder is timed once in memory mode, so the stages fit in the total'''
+        with open("../general_testing/mp3_api_gateway.json", 'r') as file:
+            payload = json.load(file)
+            payload['queryStringParameters']['mode'] = 'memory'
+
+        samples = (np.sin(np.arange(3 * 44100) / 10) * 10000).astype(np.int16)
+        with patch('lambda_function.decode', return_value=(samples.reshape(-1, 1) / 2**15, 44100)):
+            response = lambda_handler(payload, None)
+
+        stages = parse_server_timing(response['headers']['Server-Timing'])
+        total = stages.pop('total')
+        self.assertIn('vocoder', stages)
+        self.assertLessEqual(sum(stages.values()), total)
+
+    def test_stream_stretch(self):
+        '''Test the block stretch gives stretch's samples at a fixed gain, so a fade in is kept'''
+        t = np.arange(6 * 44100) / 44100
+        # Fades in over the clip, the right channel at half the level
+        left = (np.sin(2 * np.pi * 440 * t) * t / t[-1] * 32767).astype(np.int16)
+        stereo = np.column_stack((left, left // 2))
+        blocks = (stereo[i:i + 10000] / 2**15 for i in range(0, len(stereo), 10000))
+
+        streamed = np.concatenate(list(stream_stretch(blocks, 0.8, 2)))
+        expected = stretch(stereo / 2**15, 0.8, window_size=2**13, h=2**11)
+
+        self.assertEqual(streamed.shape, expected.shape)
+        # One gain for the whole output, found from its loudest sample
+        loudest = np.unravel_index(np.abs(expected).argmax(), expected.shape)
+        gain = streamed[loudest] / expected[loudest]
+        np.testing.assert_allclose(streamed, expected * gain, atol=1 + gain)
+
+        def level(samples, second):
+            return np.sqrt((samples[int(second * 44100 / 0.8):][:4410].astype(float) ** 2).mean())
+        for second in (1, 5):
+            self.assertAlmostEqual(level(streamed, second) / level(expected, second), gain, delta=0.01 * gain)
+        self.assertLess(level(streamed, 1), level(streamed, 5) / 3)
+
+    def test_stream_mode(self):
+        '''Test the handler streams only when asked, giving the length of the in memory path that is the default'''
+        with open("../general_testing/mp3_api_gateway.json", 'r') as file:
+            payload = json.load(file)
+            payload['queryStringParameters']['output_format'] = 'pcm_s16le'
+
+        default = lambda_handler(payload, None)
+        payload['queryStringParameters']['mode'] = 'stream'
+        streamed = lambda_handler(payload, None)
+        payload['queryStringParameters']['mode'] = 'memory'
+        in_memory = lambda_handler(payload, None)
+        payload['queryStringParameters']['mode'] = 'chunked'
+        invalid = lambda_handler(payload, None)
+
+        self.assertEqual(default['body'], in_memory['body'])
+        self.assertEqual(streamed['statusCode'], 200)
+        self.assertEqual(streamed['headers']['Content-Type'], in_memory['headers']['Content-Type'])
+        self.assertIn('vocoder;dur=', streamed['headers']['Server-Timing'])
+        self.assertEqual(len(b64decode(streamed['body'])), len(b64decode(in_memory['body'])))
+        self.assertEqual(invalid['statusCode'], 422)
+
+    def test_invalid_output_format(self):
+        '''Test an output format that is not supported'''
+        with open("../general_testing/mp3_api_gateway.json", 'r') as file:
+            payload = json.load(file)
+            payload['queryStringParameters']['output_format'] = 'aac'
+
+        response = lambda_handler(payload, None)
+        self.assertEqual(response['statusCode'], 422)
+        self.assertIn('output_format parameter must be one of', response['body'])
+
     def test_lambda_handler_missing_body(self):
         '''Test missing body in payload'''
         payload = {
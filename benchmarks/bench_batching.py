@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import threading
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from audio_common.batching import MicroBatcher
+from audio_common.embeddings import EMBEDDING_GRAPH, GRAPH_BATCH, PATCH_SIZE, run_patches
+
+'''
+Effnet throughput with and without cross request micro-batching.
+
+Run from the repository root: python benchmarks/bench_batching.py
+Each client sends REQUESTS_PER_CLIENT clips of PATCHES_PER_CLIP mel patches (a
+30 s clip at 16 kHz is about 29) as fast as it can. Prints requests per second
+at 1, 4 and 16 concurrent clients, calling the model directly and through a
+MicroBatcher.
+
+The real graph is used when essentia-tensorflow is installed and
+discogs-effnet-bs64-1.pb is in the working directory. Otherwise a simulated
+model stands in: every call costs SIMULATED_BATCH_MS per started batch of 64
+patches, as the bs64 graph pads every call to a whole batch, and calls run one
+at a time, as concurrent calls compete for the same cores. Only the shape of
+the result means anything with the simulated model.
+'''
+
+CLIENTS = [1, 4, 16]
+REQUESTS_PER_CLIENT = 8
+PATCHES_PER_CLIP = 29
+SIMULATED_BATCH_MS = 120
+MAX_WAIT_MS = 5
+device = threading.Lock()
+
+
+def simulated_model(patches):
+    batches = -(-len(patches) // GRAPH_BATCH)
+    with device:
+        time.sleep(batches * SIMULATED_BATCH_MS / 1000)  # sleep releases the GIL like TensorFlow does
+    return np.zeros((len(patches), 1280), dtype=np.float32)
+
+
+def real_model_available():
+    try:
+        from essentia import standard as es
+    except ImportError:
+        return False
+    return hasattr(es, "TensorflowPredict") and os.path.exists(EMBEDDING_GRAPH)
+
+
+def throughput(infer, clients, clip):
+    '''Requests per second with clients threads each sending REQUESTS_PER_CLIENT clips'''
+    def client():
+        for _ in range(REQUESTS_PER_CLIENT):
+            infer(clip)
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return clients * REQUESTS_PER_CLIENT / (time.perf_counter() - start)
+
+
+def main():
+    if real_model_available():
+        model, name = run_patches, "discogs-effnet-bs64"
+    else:
+        model, name = simulated_model, f"simulated ({SIMULATED_BATCH_MS} ms per batch of {GRAPH_BATCH})"
+    clip = np.random.default_rng(0).standard_normal((PATCHES_PER_CLIP, PATCH_SIZE, 96)).astype(np.float32)
+    model(clip)  # Load the graph before timing
+
+    print(f"model: {name}, {PATCHES_PER_CLIP} patches per request, max wait {MAX_WAIT_MS} ms")
+    print(f"{'clients':>8} {'direct req/s':>13} {'batched req/s':>14} {'speedup':>8} {'rows/batch':>11}")
+    for clients in CLIENTS:
+        batcher = MicroBatcher(model, max_batch_size=GRAPH_BATCH, max_wait_ms=MAX_WAIT_MS)
+        direct = throughput(model, clients, clip)
+        batched = throughput(batcher.submit, clients, clip)
+        rows_per_batch = batcher.stats["rows"] / batcher.stats["batches"]
+        print(f"{clients:>8} {direct:>13.1f} {batched:>14.1f} {batched / direct:>7.2f}x {rows_per_batch:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
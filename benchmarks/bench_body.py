@@ -0,0 +1,93 @@
+import os
+import re
+import sys
+import gc
+import json
+import base64
+from io import BytesIO
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from audio_common.body import read_body
+from audio_common.decode import decode
+
+'''
+Peak RSS of reading a request body, per MB of upload, before and after
+audio_common.body.
+
+Run from the repository root on Linux: python benchmarks/bench_body.py
+The upload is the test mp3 from general_testing repeated to each of SIZES MB.
+Every case runs in its own process. The event is built first, then the peak RSS
+is reset (/proc/self/clear_refs) and the body is read, and then decoded at
+16 kHz mono as the ML functions do. Prints the growth of the peak over the RSS
+with the event in memory, per MB of upload:
+
+    b64decode           what every handler did
+    b64decode+BytesIO   plus the BytesIO pitch shift and time stretch gave pydub
+    buffer cold         read_body, first request of the container
+    buffer warm         read_body, the buffer left by an earlier request is reused
+    raw                 read_body of a raw binary body, no base64
+
+ffmpeg runs in its own process so only the PCM it hands back is counted.
+'''
+
+SIZES = [1, 4, 16]  # MB of mp3
+CASES = ["b64decode", "b64decode+BytesIO", "buffer cold", "buffer warm", "raw"]
+
+
+def status(field):
+    return int(re.search(rf"{field}:\s+(\d+)", open("/proc/self/status").read()).group(1)) / 1024
+
+
+def reset_peak():
+    gc.collect()
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    return status("VmRSS")
+
+
+def upload(megabytes):
+    with open(os.path.join("general_testing", "mp3_api_gateway.json")) as f:
+        mp3 = base64.b64decode(json.load(f)["body"])
+    return (mp3 * -(-megabytes * 2**20 // len(mp3)))[:megabytes * 2**20]
+
+
+def run(case, megabytes):
+    '''Child process: (peak growth reading the body, peak growth with the decode) in MB'''
+    data = upload(megabytes)
+    if case == "raw":
+        event = {"body": data}
+    else:
+        event = {"body": base64.b64encode(data).decode("ascii"), "isBase64Encoded": True}
+        del data
+    if case == "buffer warm":
+        read_body(event)
+
+    base = reset_peak()
+    if case.startswith("b64decode"):
+        audio = base64.b64decode(event["body"])
+        if case.endswith("BytesIO"):
+            buffer = BytesIO(audio)
+    else:
+        audio = read_body(event)
+    body = status("VmHWM") - base
+    samples, _ = decode(audio, sample_rate=16000)
+    return body, status("VmHWM") - base
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "run":
+        print(json.dumps(run(sys.argv[2], int(sys.argv[3]))))
+        return
+
+    import subprocess
+    print("peak RSS growth per MB of upload (MB/MB)")
+    print(f"{'case':>18} {'MB':>4} {'body':>6} {'+decode':>8}")
+    for megabytes in SIZES:
+        for case in CASES:
+            process = subprocess.run([sys.executable, __file__, "run", case, str(megabytes)],
+                                     stdout=subprocess.PIPE, check=True, text=True)
+            body, total = json.loads(process.stdout.strip().splitlines()[-1])
+            print(f"{case:>18} {megabytes:>4} {body / megabytes:>6.2f} {total / megabytes:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+import time
+import base64
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from audio_common.decode import decode
+from audio_common.encode import encode, OUTPUT_FORMATS
+
+'''
+Encode time and payload size of every output format of audio_common.encode.
+
+Run from the repository root: python benchmarks/bench_encode.py
+The reference clip is the test mp3 from general_testing decoded to int16 stereo
+and repeated to REFERENCE_SECONDS. For every format and bitrate prints the best
+of REPEATS encode times, the encoded size and the size of the base64 body the
+lambda returns.
+'''
+
+REFERENCE_SECONDS = 60
+REPEATS = 3
+
+
+def reference_clip():
+    with open(os.path.join("general_testing", "mp3_api_gateway.json")) as f:
+        samples, rate = decode(base64.b64decode(json.load(f)["body"]), mono=False)
+    samples = np.round(samples * 2**15).clip(-2**15, 2**15 - 1).astype(np.int16)
+    repeats = -(-REFERENCE_SECONDS * rate // len(samples))
+    return np.tile(samples, (repeats, 1))[:REFERENCE_SECONDS * rate], rate
+
+
+def main():
+    samples, rate = reference_clip()
+    print(f"{REFERENCE_SECONDS} s, {rate} Hz, {samples.shape[1]} channels")
+    print(f"{'format':>10} {'bitrate':>8} {'ms':>8} {'KB':>8} {'base64 KB':>10}")
+    for output_format, (_, _, bitrates, default_bitrate) in OUTPUT_FORMATS.items():
+        for bitrate in bitrates or (None,):
+            times = []
+            for _ in range(REPEATS):
+                start = time.perf_counter()
+                data, _ = encode(samples, rate, output_format, bitrate)
+                times.append((time.perf_counter() - start) * 1000)
+            label = f"{bitrate}{'*' if bitrate == default_bitrate else ''}" if bitrate else "-"
+            print(f"{output_format:>10} {label:>8} {min(times):>8.1f} {len(data) / 1024:>8.0f} "
+                  f"{4 * -(-len(data) // 3) / 1024:>10.0f}")
+    print("* default bitrate")
+
+
+if __name__ == "__main__":
+    main()
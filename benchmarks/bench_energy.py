@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from audio_common.energy import frame_energies, RunningEnergy
+from audio_common.decode import BLOCK_SIZE
+
+try:
+    from essentia import standard as es
+except ImportError:
+    es = None
+
+'''
+Frame energy: es.Energy over es.FrameGenerator (what audio_energy used to do)
+against the numpy engine in audio_common.energy, on its own and a block at a time.
+
+Run from the repository root: python benchmarks/bench_energy.py
+Prints the time of the best of REPEATS runs and the largest relative difference
+between the average energies. The essentia loop is skipped if it is not installed.
+'''
+
+SAMPLE_RATE = 44100
+DURATIONS = [30, 180, 600]  # seconds
+SIZES = [(1024, 1024), (1024, 512)]  # (frame size, hop size)
+REPEATS = 3
+
+
+def best_time(function):
+    '''Best wall time of REPEATS runs in ms and the last result'''
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = function()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def essentia_loop(signal, frame_size, hop_size):
+    energy = es.Energy()
+    energies = [energy(frame) for frame in es.FrameGenerator(signal, frameSize=frame_size, hopSize=hop_size)]
+    return sum(energies) / len(energies)
+
+
+def numpy_engine(signal, frame_size, hop_size):
+    energies = frame_energies(signal, frame_size, hop_size)
+    return energies.sum() / len(energies)
+
+
+def numpy_blocks(signal, frame_size, hop_size):
+    running = RunningEnergy(frame_size, hop_size)
+    for start in range(0, len(signal), BLOCK_SIZE):
+        running.add(signal[start:start + BLOCK_SIZE])
+    return running.average()
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'seconds':>8} {'frame':>6} {'hop':>5} {'method':>14} {'ms':>10} {'speedup':>8} {'rel diff':>10}")
+    for duration in DURATIONS:
+        signal = rng.uniform(-0.5, 0.5, duration * SAMPLE_RATE).astype(np.float32)
+        for frame_size, hop_size in SIZES:
+            methods = [("numpy", numpy_engine), ("numpy blocks", numpy_blocks)]
+            if es is not None:
+                methods.insert(0, ("essentia loop", essentia_loop))
+
+            results = []
+            for name, function in methods:
+                elapsed, average = best_time(lambda: function(signal, frame_size, hop_size))
+                results.append((name, elapsed, average))
+
+            baseline_ms, baseline = results[0][1], results[0][2]
+            for name, elapsed, average in results:
+                print(f"{duration:>8} {frame_size:>6} {hop_size:>5} {name:>14} {elapsed:>10.2f} "
+                      f"{baseline_ms / elapsed:>7.1f}x {abs(average - baseline) / baseline:>10.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import time
+import base64
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'audio_pitch_time'))
+from audio_common.decode import decode
+from audio_common.encode import encode
+from lambda_function import pitch_time
+
+'''
+Pitch shift then time stretch: the two function chain against audio_pitch_time.
+
+Run from the repository root: python benchmarks/bench_pitch_time.py
+The reference clip is the test mp3 from general_testing repeated to each of
+DURATIONS in stereo. The chain is what the client did before, each hop decoding
+the request, running its vocoder pass and answering with 320k MP3:
+
+    decode -> pitch shift -> mp3 -> decode -> time stretch -> mp3
+
+and the combined function does one decode, one vocoder pass and one encode. The
+vocoder passes are the same code as the two functions (all of them run
+audio_common.vocoder's shift_and_stretch). Prints the
+best of REPEATS wall times for each and the time spent in the vocoder.
+'''
+
+DURATIONS = [30, 180]  # seconds
+SHIFT_AMOUNT = 4.0
+STRETCH_AMOUNT = 1.25
+REPEATS = 3
+
+
+def reference_mp3(seconds):
+    with open(os.path.join("general_testing", "mp3_api_gateway.json")) as f:
+        samples, rate = decode(base64.b64decode(json.load(f)["body"]), mono=False)
+    samples = np.round(samples * 2**15).clip(-2**15, 2**15 - 1).astype(np.int16)
+    repeats = -(-seconds * rate // len(samples))
+    data, _ = encode(np.tile(samples, (repeats, 1))[:seconds * rate], rate, "mp3")
+    return data
+
+
+def hop(audio_bytes, shift_amount=0.0, stretch_amount=1.0):
+    '''One function of the chain: decode, one vocoder pass, encode to mp3'''
+    samples, rate = decode(audio_bytes, mono=False)
+    vocoder_start = time.perf_counter()
+    altered = pitch_time(samples, shift_amount, stretch_amount)
+    vocoder_ms = (time.perf_counter() - vocoder_start) * 1000
+    data, _ = encode(altered, rate, "mp3")
+    return data, vocoder_ms
+
+
+def chained(audio_bytes):
+    shifted, first_ms = hop(audio_bytes, shift_amount=SHIFT_AMOUNT)
+    stretched, second_ms = hop(shifted, stretch_amount=STRETCH_AMOUNT)
+    return stretched, first_ms + second_ms
+
+
+def combined(audio_bytes):
+    return hop(audio_bytes, SHIFT_AMOUNT, STRETCH_AMOUNT)
+
+
+def best(function, audio_bytes):
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        _, vocoder_ms = function(audio_bytes)
+        times.append(((time.perf_counter() - start) * 1000, vocoder_ms))
+    return min(times)
+
+
+def main():
+    print(f"shift {SHIFT_AMOUNT:+} semitones, stretch {STRETCH_AMOUNT}, 320k mp3 in and out, best of {REPEATS}")
+    print(f"{'seconds':>8} {'chain ms':>9} {'vocoder':>8} {'combined ms':>12} {'vocoder':>8} {'speedup':>8}")
+    for seconds in DURATIONS:
+        audio_bytes = reference_mp3(seconds)
+        chain_ms, chain_vocoder = best(chained, audio_bytes)
+        combined_ms, combined_vocoder = best(combined, audio_bytes)
+        print(f"{seconds:>8} {chain_ms:>9.0f} {chain_vocoder:>8.0f} {combined_ms:>12.0f} {combined_vocoder:>8.0f} "
+              f"{chain_ms / combined_ms:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import io
+import os
+import sys
+import json
+import time
+import wave
+import base64
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from audio_common.decode import decode, RESAMPLE_QUALITIES
+from audio_common.embeddings import MODEL_SAMPLE_RATE, EMBEDDING_GRAPH
+
+'''
+Decoding for the ML functions: each resampling tier against decoding at the
+source rate, and how far each tier drifts from the "high" tier.
+
+Run from the repository root: python benchmarks/bench_resample.py
+Uses the test mp3 from general_testing and 3 minutes of 44.1 kHz stereo made up
+of tones and noise. For every input and tier prints:
+    ms: decode time, best of REPEATS
+    samples: samples handed to the model
+    signal: largest sample difference from "high"
+    mel: largest difference of the effnet mel bands from "high" (needs essentia)
+    activations: largest difference of the mean effnet embedding from "high"
+                 (needs essentia-tensorflow and discogs-effnet-bs64-1.pb)
+"essentia q4" is the old route: source rate decode then essentia's Resample at
+quality 4, the quality MonoLoader was called with.
+'''
+
+REPEATS = 3
+SYNTHETIC_SECONDS = 180
+
+
+def synthetic_wav(seconds, sample_rate=44100):
+    '''Stereo WAV bytes of two chords and some noise'''
+    rng = np.random.default_rng(0)
+    t = np.arange(seconds * sample_rate) / sample_rate
+    left = sum(np.sin(2 * np.pi * f * t) for f in (220, 277, 330, 5000)) / 5
+    right = sum(np.sin(2 * np.pi * f * t) for f in (196, 247, 294, 7500)) / 5
+    stereo = np.stack([left, right], axis=1) + 0.05 * rng.standard_normal((len(t), 2))
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes((np.clip(stereo, -1, 1) * 32767).astype("<i2").tobytes())
+    return buffer.getvalue()
+
+
+def best_of(function):
+    '''Best wall time in ms of REPEATS calls and the last result'''
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = function()
+        times.append((time.perf_counter() - start) * 1000)
+    return min(times), result
+
+
+def essentia_q4(audio_bytes):
+    from essentia import standard as es
+    audio, rate = decode(audio_bytes)
+    return es.Resample(inputSampleRate=rate, outputSampleRate=MODEL_SAMPLE_RATE, quality=4)(audio)
+
+
+def feature_functions():
+    '''Mel band and embedding functions for what is installed'''
+    features = {}
+    try:
+        from essentia import standard as es
+    except ImportError:
+        return features
+    mel = es.TensorflowInputMusiCNN()
+    features["mel"] = lambda audio: np.array([mel(frame) for frame in es.FrameGenerator(
+        audio, frameSize=512, hopSize=256, startFromZero=True, validFrameThresholdRatio=1)])
+    if hasattr(es, "TensorflowPredictEffnetDiscogs") and os.path.exists(EMBEDDING_GRAPH):
+        model = es.TensorflowPredictEffnetDiscogs(graphFilename=EMBEDDING_GRAPH, output="PartitionedCall:1")
+        features["activations"] = lambda audio: np.mean(model(audio), axis=0)
+    return features
+
+
+def main():
+    with open(os.path.join("general_testing", "mp3_api_gateway.json")) as f:
+        inputs = {"test mp3": base64.b64decode(json.load(f)["body"])}
+    inputs[f"{SYNTHETIC_SECONDS} s wav"] = synthetic_wav(SYNTHETIC_SECONDS)
+    features = feature_functions()
+
+    columns = ["signal"] + list(features)
+    print(f"{'input':>12} {'decode':>12} {'ms':>8} {'samples':>10}" + "".join(f" {name:>11}" for name in columns))
+    for name, audio_bytes in inputs.items():
+        routes = {"source rate": lambda: decode(audio_bytes)[0]}
+        for quality in RESAMPLE_QUALITIES:
+            routes[quality] = lambda quality=quality: decode(audio_bytes, sample_rate=MODEL_SAMPLE_RATE, quality=quality)[0]
+        if features:
+            routes["essentia q4"] = lambda: essentia_q4(audio_bytes)
+
+        results = {route: best_of(function) for route, function in routes.items()}
+        reference = results["high"][1]
+        reference_features = {feature: function(reference) for feature, function in features.items()}
+
+        for route, (ms, audio) in results.items():
+            drift = ""
+            if route != "source rate":
+                length = min(len(audio), len(reference))
+                drift = f" {np.abs(audio[:length] - reference[:length]).max():>11.2e}"
+                for feature, function in features.items():
+                    values, expected = function(audio), reference_features[feature]
+                    rows = min(len(values), len(expected))
+                    drift += f" {np.abs(values[:rows] - expected[:rows]).max():>11.2e}"
+            print(f"{name:>12} {route:>12} {ms:>8.0f} {len(audio):>10}{drift}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import os
+import re
+import sys
+import gc
+import json
+import base64
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from audio_common import storage
+from audio_common.storage import LocalStorage, read_input, close_input
+
+'''
+Peak RSS of streaming the energy of an upload, per MB of upload, with the audio
+in the request body and as an object in storage.
+
+Run from the repository root on Linux: python benchmarks/bench_storage.py
+The upload is the test mp3 from general_testing repeated to each of SIZES MB.
+Every case runs in its own process. The event is built first (and the object
+written to a temporary LocalStorage), then the peak RSS is reset
+(/proc/self/clear_refs) and the audio is read and measured a block at a time as
+audio_energy does in stream mode. Prints the growth of the peak over the RSS
+with the event in memory, per MB of upload:
+
+    base64 body     the body as API Gateway passes it
+    object          input_bucket and input_key, the file is ffmpeg's stdin
+
+ffmpeg runs in its own process so only what it hands back is counted.
+'''
+
+SIZES = [1, 4, 16]  # MB of mp3
+CASES = ["base64 body", "object"]
+
+
+def status(field):
+    return int(re.search(rf"{field}:\s+(\d+)", open("/proc/self/status").read()).group(1)) / 1024
+
+
+def reset_peak():
+    gc.collect()
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    return status("VmRSS")
+
+
+def upload(megabytes):
+    with open(os.path.join("general_testing", "mp3_api_gateway.json")) as f:
+        mp3 = base64.b64decode(json.load(f)["body"])
+    return (mp3 * -(-megabytes * 2**20 // len(mp3)))[:megabytes * 2**20]
+
+
+def run(case, megabytes, directory):
+    '''Child process: peak growth measuring the energy in MB'''
+    # Imported here so the path is set up first
+    from audio_energy.lambda_function import stream_average_energy
+
+    data = upload(megabytes)
+    if case == "object":
+        storage.default = LocalStorage(directory)
+        with storage.default.writer("audio", "track.mp3") as f:
+            f.write(data)
+        event = {"queryStringParameters": {"input_bucket": "audio", "input_key": "track.mp3"}}
+    else:
+        event = {"body": base64.b64encode(data).decode("ascii"), "isBase64Encoded": True}
+    del data
+
+    base = reset_peak()
+    audio = read_input(event)
+    try:
+        stream_average_energy(audio)
+    finally:
+        close_input(audio)
+    return status("VmHWM") - base
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "run":
+        print(json.dumps(run(sys.argv[2], int(sys.argv[3]), sys.argv[4])))
+        return
+
+    import subprocess
+    print("peak RSS growth per MB of upload (MB/MB)")
+    print(f"{'case':>12} {'MB':>4} {'peak':>6}")
+    for megabytes in SIZES:
+        for case in CASES:
+            with tempfile.TemporaryDirectory() as directory:
+                process = subprocess.run([sys.executable, __file__, "run", case, str(megabytes), directory],
+                                         stdout=subprocess.PIPE, check=True, text=True)
+            peak = json.loads(process.stdout.strip().splitlines()[-1])
+            print(f"{case:>12} {megabytes:>4} {peak / megabytes:>6.2f}")
+
+
+if __name__ == "__main__":
+    main()
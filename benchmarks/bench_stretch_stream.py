@@ -0,0 +1,93 @@
+import os
+import re
+import sys
+import gc
+import json
+import time
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+from audio_common.encode import encode, encode_blocks, BlockEncoder
+from audio_common.decode import decode, BlockDecoder
+
+'''
+Peak RSS and time of the time stretch in memory and streamed.
+
+Run from the repository root on Linux: python benchmarks/bench_stretch_stream.py
+The input is DURATIONS seconds of 44.1 kHz stereo noise as 320k mp3, slowed
+down to FACTOR of its speed (4x longer) and encoded as mp3, as the handler does:
+
+    memory      decode, stretch and encode the whole track (mode=memory)
+    stream      BlockDecoder, stream_stretch and encode_blocks (mode=stream), the
+                encoded mp3 is held for the response body
+    stream file the same written to a file with BlockEncoder, as to an output
+                object in storage (output_bucket)
+
+Every case runs in its own process. The mp3 is made first, then the peak RSS is
+reset (/proc/self/clear_refs) and the growth of the peak over it is printed.
+ffmpeg runs in its own processes so only what they hand back is counted.
+'''
+
+DURATIONS = [30, 120, 300]  # seconds
+FACTOR = 0.25
+CASES = ["memory", "stream", "stream file"]
+
+
+def status(field):
+    return int(re.search(rf"{field}:\s+(\d+)", open("/proc/self/status").read()).group(1)) / 1024
+
+
+def reset_peak():
+    gc.collect()
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    return status("VmRSS")
+
+
+def upload(seconds):
+    noise = np.random.default_rng(0).standard_normal((seconds * 44100, 2)) * 3000
+    data, _ = encode(noise.astype(np.int16), 44100, "mp3")
+    return data
+
+
+def run(case, seconds):
+    '''Child process: (peak growth in MB, seconds taken)'''
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'audio_time_stretch'))
+    from lambda_function import stretch, stream_stretch
+
+    data = upload(seconds)
+    base = reset_peak()
+    start = time.perf_counter()
+    if case == "memory":
+        samples, rate = decode(data, mono=False)
+        encode(stretch(samples, FACTOR, 2**13, 2**11), rate, "mp3")
+    elif case == "stream":
+        with BlockDecoder(data, mono=False) as decoder:
+            encode_blocks(stream_stretch(decoder, FACTOR, decoder.channels), decoder.sample_rate,
+                          decoder.channels, "mp3")
+    else:
+        with tempfile.TemporaryFile() as output, BlockDecoder(data, mono=False) as decoder:
+            with BlockEncoder(output, decoder.sample_rate, decoder.channels, "mp3") as encoder:
+                for block in stream_stretch(decoder, FACTOR, decoder.channels):
+                    encoder.write(block)
+    return status("VmHWM") - base, time.perf_counter() - start
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "run":
+        print(json.dumps(run(sys.argv[2], int(sys.argv[3]))))
+        return
+
+    import subprocess
+    print(f"time stretch to {FACTOR}x speed, 44.1 kHz stereo mp3 in and out")
+    print(f"{'case':>11} {'s':>5} {'peak MB':>8} {'time s':>7}")
+    for seconds in DURATIONS:
+        for case in CASES:
+            process = subprocess.run([sys.executable, __file__, "run", case, str(seconds)],
+                                     stdout=subprocess.PIPE, check=True, text=True)
+            peak, taken = json.loads(process.stdout.strip().splitlines()[-1])
+            print(f"{case:>11} {seconds:>5} {peak:>8.0f} {taken:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from audio_common.vocoder import phase_vocoder
+
+'''
+Phase vocoder: the per hop loop audio_time_stretch and audio_pitch_shift used
+against the batched audio_common.vocoder, on clips of noise.
+
+Run from the repository root: python benchmarks/bench_vocoder.py
+Prints the wall time of each and the largest difference relative to the peak of
+the loop's output, plus the batched time for the same clip in stereo (which the
+old time stretch downmixed to mono). The 10 minute loop takes a while.
+'''
+
+SAMPLE_RATE = 44100
+DURATIONS = [30, 180, 600]  # seconds
+WINDOW_SIZE = 2**13
+HOP = 2**11
+# Time stretch by 1.5 and the stretch used to pitch shift up 4 semitones
+FACTORS = [("stretch 1.5", 1.5), ("pitch +4", 1 / 2 ** (4 / 12))]
+
+
+def loop_stretch(sound_array, f, window_size, h):
+    '''The old phase vocoder, one hop at a time'''
+    phase = np.zeros(window_size)
+    hanning_window = np.hanning(window_size)
+    result = np.zeros(int(len(sound_array) / f + window_size))
+
+    for i in np.arange(0, len(sound_array) - (window_size + h), h * f):
+        a1 = sound_array[int(i): int(i) + window_size]
+        a2 = sound_array[int(i) + h: int(i) + window_size + h]
+
+        s1 = np.fft.fft(hanning_window * a1)
+        s2 = np.fft.fft(hanning_window * a2)
+        phase = (phase + np.angle(s2 / s1)) % (2 * np.pi)
+        a2_rephased = np.fft.ifft(np.abs(s2) * np.exp(1j * phase))
+
+        i2 = int(i / f)
+        result[i2: i2 + window_size] += (hanning_window * a2_rephased.real)
+    return result
+
+
+def timed(function, *args):
+    '''Wall time in ms and the result'''
+    start = time.perf_counter()
+    result = function(*args)
+    return (time.perf_counter() - start) * 1000, result
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'seconds':>8} {'operation':>12} {'loop ms':>10} {'batched ms':>11} {'speedup':>8} {'rel diff':>10} {'stereo ms':>10}")
+    for duration in DURATIONS:
+        stereo = (rng.standard_normal((duration * SAMPLE_RATE, 2)) * 3000).astype(np.int16)
+        signal = stereo[:, 0].copy()
+        for name, factor in FACTORS:
+            loop_ms, expected = timed(loop_stretch, signal, factor, WINDOW_SIZE, HOP)
+            batched_ms, output = timed(phase_vocoder, signal, factor, WINDOW_SIZE, HOP)
+            stereo_ms, _ = timed(phase_vocoder, stereo, factor, WINDOW_SIZE, HOP)
+            difference = np.abs(output - expected).max() / np.abs(expected).max()
+            print(f"{duration:>8} {name:>12} {loop_ms:>10.0f} {batched_ms:>11.0f} "
+                  f"{loop_ms / batched_ms:>7.2f}x {difference:>10.2e} {stereo_ms:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
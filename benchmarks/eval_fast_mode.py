@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from audio_common.decode import decode
+from audio_common.embeddings import embed_windows
+from audio_common.labels import GENRES, INSTRUMENTS, top_n
+from audio_common.sampling import sampled_activations
+
+'''
+Fast mode against full analysis on a reference set of tracks.
+
+Run from the repository root with the graphs in the working directory:
+    python benchmarks/eval_fast_mode.py [directory of tracks, default music_files]
+
+Needs essentia-tensorflow and discogs-effnet-bs64-1.pb,
+genre_discogs400-discogs-effnet-1.pb and mtg_jamendo_instrument-discogs-effnet-1.pb.
+For every head and fast mode setting prints, averaged over the tracks:
+    windows: windows used by the tracks long enough to be sampled
+    whole: share of tracks too short to sample, analysed whole
+    overlap: share of the full analysis top N found in the fast top N
+    top 1: share of tracks with the same top label
+    ms: embedding and prediction time, against the full analysis on the first row
+
+No results have been recorded yet. The embedding graph is not in the repository
+and the tracks need to be longer than the windows (48 s at the default 8), the
+clip in general_testing is analysed whole by every setting.
+'''
+
+TOP_N = 5
+# (windows, strategy, stable)
+SETTINGS = [(4, "even", False), (8, "even", False), (8, "stratified", False), (4, "even", True), (16, "even", False)]
+EXTENSIONS = (".mp3", ".wav", ".flac", ".ogg", ".m4a")
+GRAPHS = ("discogs-effnet-bs64-1.pb", "genre_discogs400-discogs-effnet-1.pb", "mtg_jamendo_instrument-discogs-effnet-1.pb")
+
+
+def build_heads():
+    from essentia import standard as es
+    return {
+        "genre": (es.TensorflowPredict2D(graphFilename="genre_discogs400-discogs-effnet-1.pb",
+                                         input="serving_default_model_Placeholder", output="PartitionedCall:0"), GENRES),
+        "instrument": (es.TensorflowPredict2D(graphFilename="mtg_jamendo_instrument-discogs-effnet-1.pb"), INSTRUMENTS),
+    }
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else "music_files"
+    missing = [graph for graph in GRAPHS if not os.path.exists(graph)]
+    if missing:
+        sys.exit(f"Missing graphs in {os.getcwd()}: {', '.join(missing)}")
+    tracks = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.lower().endswith(EXTENSIONS))
+    heads = build_heads()
+    print(f"{len(tracks)} tracks from {directory}, top {TOP_N}")
+
+    for head, (model, labels) in heads.items():
+        predict = lambda windows: model(embed_windows(windows))
+        results = {setting: {"windows": [], "whole": [], "overlap": [], "top 1": [], "ms": []} for setting in SETTINGS}
+        full_ms = []
+        for track in tracks:
+            with open(track, "rb") as f:
+                audio, sample_rate = decode(f.read())
+
+            start = time.perf_counter()
+            full = np.mean(predict([audio]), axis=0)
+            full_ms.append((time.perf_counter() - start) * 1000)
+            expected = top_n(full, TOP_N)
+
+            for setting in SETTINGS:
+                windows, strategy, stable = setting
+                start = time.perf_counter()
+                activations, used = sampled_activations(audio, sample_rate, predict, windows=windows, strategy=strategy,
+                                                        stable_n=TOP_N if stable else None)
+                result = results[setting]
+                result["ms"].append((time.perf_counter() - start) * 1000)
+                found = top_n(activations, TOP_N)
+                result["whole"].append(used is None)
+                if used is not None:
+                    result["windows"].append(used)
+                result["overlap"].append(len(set(found) & set(expected)) / TOP_N)
+                result["top 1"].append(found[0] == expected[0])
+
+        print(f"\n{head} ({len(labels)} labels)")
+        print(f"{'setting':>22} {'windows':>8} {'whole':>6} {'overlap':>8} {'top 1':>6} {'ms':>8}")
+        print(f"{'full':>22} {'':>8} {1:>6.2f} {1:>8.2f} {1:>6.2f} {np.mean(full_ms):>8.0f}")
+        for (windows, strategy, stable), result in results.items():
+            name = f"{windows} {strategy}{' stable' if stable else ''}"
+            print(f"{name:>22} {np.mean(result['windows'] or [0]):>8.1f} {np.mean(result['whole']):>6.2f} "
+                  f"{np.mean(result['overlap']):>8.2f} "
+                  f"{np.mean(result['top 1']):>6.2f} {np.mean(result['ms']):>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
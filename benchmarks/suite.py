@@ -0,0 +1,374 @@
+import os
+import re
+import sys
+import gc
+import json
+import time
+import base64
+import argparse
+import platform
+import resource
+import tempfile
+import importlib
+import subprocess
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+from audio_common.timing import StageTimer
+from audio_common.decode import decode
+from audio_common.encode import encode
+
+'''
+Benchmark suite for every audio function, replacing the hand typed numbers in
+analysis/evaluation_graph.ipynb.
+
+Run from the repository root on Linux:
+    python benchmarks/suite.py run --output benchmarks/results.json
+    python benchmarks/suite.py compare benchmarks/results.json --baseline benchmarks/baseline.json
+
+run measures each of FUNCTIONS on every clip, duration and format asked for
+(the defaults are all of them) and writes the results as JSON. A clip is:
+
+    synthetic   a chord with vibrato and a little noise, 44.1 kHz stereo
+    real        the test mp3 from general_testing repeated to the duration,
+                or each --real file repeated or cut to the duration
+
+encoded as 320k mp3 or 16 bit wav. Every case runs in its own process: the
+function's module is imported and its models built (load_ms) and the clip read,
+then the peak RSS is reset (/proc/self/clear_refs) and the function is called as
+its handler calls it. For each case the result has
+
+    wall_ms, cpu_ms     best of --repeats runs, CPU time includes ffmpeg's
+    peak_rss_mb         growth of the process's peak RSS over the RSS before the call
+    ffmpeg_rss_mb       peak RSS of the largest ffmpeg the call ran
+    stages              the function's own StageTimer stages (ms), for functions
+                        without a timer the decode, vocoder and encode calls are timed
+                        from outside, "other" is the rest of the wall time
+
+The embedding cache and decode cache are turned off so every run does the work.
+A function that cannot be imported (essentia missing, say) or fails on a clip is
+kept in the results with its error. Functions that only read mp3 headers
+(metadata) are not run on wav. The time stretch is run both ways: time_stretch
+decodes, stretches and encodes the whole clip (mode=memory), stream_stretch a
+block at a time (mode=stream).
+
+compare matches cases by function, clip, format and duration and flags a
+regression when a metric grows by more than --threshold (default 10%) and by
+more than its noise floor in FLOORS. It exits with 1 if anything regressed so
+it can gate a CI job. Keep a baseline per machine, the numbers are not portable.
+'''
+
+DURATIONS = [5, 30, 180, 600]  # seconds
+CLIPS = ["synthetic", "real"]
+FORMATS = ["mp3", "wav"]
+SAMPLE_RATE = 44100
+REPEATS = 3
+SHIFT_AMOUNT = 4.0
+STRETCH_AMOUNT = 1.25
+
+# name -> (module, function, extra arguments, takes a timer, formats, stages timed from outside)
+FUNCTIONS = {
+    "energy": ("audio_energy.lambda_function", "compute_average_energy", (), True, FORMATS, {}),
+    "length": ("audio_length.lambda_function", "get_audio_length", (), False, FORMATS,
+               {"get_duration_ms": "headers", "decode": "decode"}),
+    "metadata": ("audio_metadata.lambda_function", "get_metadata", (), True, ["mp3"], {}),
+    "pitch_shift": ("audio_pitch_shift.lambda_function", "pitch_shift", (SHIFT_AMOUNT,), False, FORMATS,
+                    {"decode": "decode", "np_pitchshift": "vocoder", "write": "encode"}),
+    "time_stretch": ("audio_time_stretch.lambda_function", "time_stretch", (STRETCH_AMOUNT,), False, FORMATS,
+                     {"decode": "decode", "stretch": "vocoder", "write": "encode"}),
+    # The handler's mode=stream path, time_stretch above is mode=memory (the default)
+    "stream_stretch": ("audio_time_stretch.lambda_function", "stream_time_stretch", (STRETCH_AMOUNT,), True, FORMATS, {}),
+    "genre": ("audio_genre.lambda_function", "get_genres", (), True, FORMATS, {}),
+    "instrument": ("audio_instrument_detection.lambda_function", "get_instruments", (), True, FORMATS, {}),
+}
+
+# The caches would answer every run after the first, read when audio_common.cache is imported
+ENVIRONMENT = {"EMBEDDING_CACHE_MEMORY_MB": "0", "EMBEDDING_CACHE_DISK_MB": "0", "DECODE_CACHE_MB": "0"}
+
+# Metrics compared and the change below which a difference is noise
+FLOORS = {"wall_ms": 10.0, "cpu_ms": 10.0, "peak_rss_mb": 5.0}
+THRESHOLD = 0.10
+
+
+def status(field):
+    return int(re.search(rf"{field}:\s+(\d+)", open("/proc/self/status").read()).group(1)) / 1024
+
+
+def reset_peak():
+    gc.collect()
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    return status("VmRSS")
+
+
+def cpu_seconds():
+    '''CPU time of this process and the children it has waited for (ffmpeg)'''
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+# --- Clips ---
+
+def synthetic_samples(seconds):
+    '''A major chord with vibrato on each channel and noise at -40 dB, int16 (samples, 2)'''
+    t = np.arange(seconds * SAMPLE_RATE) / SAMPLE_RATE
+    rng = np.random.default_rng(0)
+    channels = []
+    for root in (220.0, 330.0):
+        vibrato = 1 + 0.005 * np.sin(2 * np.pi * 5 * t)
+        tone = sum(np.sin(2 * np.pi * root * ratio * vibrato * t) for ratio in (1, 1.25, 1.5)) / 3
+        channels.append(0.5 * tone + 0.01 * rng.standard_normal(len(t)))
+    return np.round(np.stack(channels, axis=1) * 2**15).clip(-2**15, 2**15 - 1).astype(np.int16)
+
+
+def real_samples(seconds, path=None):
+    '''A real recording repeated or cut to seconds, int16 (samples, channels)'''
+    if path is None:
+        with open(os.path.join("general_testing", "mp3_api_gateway.json")) as f:
+            data = base64.b64decode(json.load(f)["body"])
+    else:
+        with open(path, "rb") as f:
+            data = f.read()
+    samples, rate = decode(data, sample_rate=SAMPLE_RATE, mono=False)
+    samples = np.round(samples * 2**15).clip(-2**15, 2**15 - 1).astype(np.int16)
+    repeats = -(-seconds * SAMPLE_RATE // len(samples))
+    return np.tile(samples, (repeats, 1))[:seconds * SAMPLE_RATE]
+
+
+def make_clips(directory, clips, durations, formats, real_paths):
+    '''Write every clip to directory, returns [(clip name, seconds, format, path)]'''
+    sources = []
+    if "synthetic" in clips:
+        sources.append(("synthetic", lambda seconds: synthetic_samples(seconds)))
+    if "real" in clips:
+        for path in real_paths or [None]:
+            name = "real" if path is None else f"real:{os.path.basename(path)}"
+            sources.append((name, lambda seconds, path=path: real_samples(seconds, path)))
+
+    made = []
+    for name, make in sources:
+        for seconds in durations:
+            samples = make(seconds)
+            for output_format in formats:
+                data, _ = encode(samples, SAMPLE_RATE, output_format)
+                path = os.path.join(directory, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', name)}_{seconds}.{output_format}")
+                with open(path, "wb") as f:
+                    f.write(data)
+                made.append((name, seconds, output_format, path))
+    return made
+
+
+# --- One case, in its own process ---
+
+def time_calls(module, names, current):
+    '''Time calls to module level functions of a function that takes no timer, on current["timer"]'''
+    for name, stage_name in names.items():
+        original = getattr(module, name)
+
+        def timed(*args, original=original, stage_name=stage_name, **kwargs):
+            with current["timer"].stage(stage_name):
+                return original(*args, **kwargs)
+        setattr(module, name, timed)
+
+
+def run_case(name, path, repeats):
+    '''Child process: the measurements of one function on one clip'''
+    module_name, function_name, arguments, takes_timer, _, outside = FUNCTIONS[name]
+
+    start = time.perf_counter()
+    try:
+        module = importlib.import_module(module_name)
+        from audio_common.models import registry
+        registry.preload()
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+    load_ms = (time.perf_counter() - start) * 1000
+    function = getattr(module, function_name)
+    current = {}
+    time_calls(module, outside, current)
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    best = None
+    peak = 0.0
+    for _ in range(repeats):
+        timer = current["timer"] = StageTimer()
+        base = reset_peak()
+        cpu_start = cpu_seconds()
+        start = time.perf_counter()
+        try:
+            if takes_timer:
+                function(data, *arguments, timer=timer)
+            else:
+                function(data, *arguments)
+        except Exception as e:
+            return {"error": f"{type(e).__name__}: {e}", "load_ms": round(load_ms, 3)}
+        wall_ms = (time.perf_counter() - start) * 1000
+        cpu_ms = (cpu_seconds() - cpu_start) * 1000
+        peak = max(peak, status("VmHWM") - base)
+
+        if best is None or wall_ms < best["wall_ms"]:
+            stages = timer.report()
+            rest = wall_ms - sum(stages.values())
+            if outside and rest > 0:
+                stages["other"] = round(rest, 3)
+            best = {"wall_ms": round(wall_ms, 3), "cpu_ms": round(cpu_ms, 3), "stages": stages}
+
+    return dict(best, peak_rss_mb=round(peak, 3), load_ms=round(load_ms, 3),
+                ffmpeg_rss_mb=round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 3))
+
+
+# --- run and compare ---
+
+def metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "commit": commit,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def key(result):
+    return (result["function"], result["clip"], result["format"], result["seconds"])
+
+
+def run(arguments):
+    results = []
+    print(f"{'function':>14} {'clip':>10} {'fmt':>4} {'s':>4} {'wall ms':>10} {'cpu ms':>10} {'peak MB':>8}  stages")
+    with tempfile.TemporaryDirectory() as directory:
+        clips = make_clips(directory, arguments.clips, arguments.durations, arguments.formats, arguments.real)
+        for name in arguments.functions:
+            for clip, seconds, output_format, path in clips:
+                if output_format not in FUNCTIONS[name][4]:
+                    continue
+                process = subprocess.run([sys.executable, os.path.abspath(__file__), "case", name, path,
+                                          str(arguments.repeats)],
+                                         stdout=subprocess.PIPE, text=True, env=dict(os.environ, **ENVIRONMENT),
+                                         cwd=arguments.model_dir or os.getcwd())
+                lines = process.stdout.strip().splitlines()
+                try:
+                    measured = json.loads(lines[-1])
+                except (IndexError, ValueError):
+                    measured = {"error": f"case exited with {process.returncode}"}
+                result = dict(function=name, clip=clip, format=output_format, seconds=seconds, **measured)
+                results.append(result)
+                if "error" in result:
+                    print(f"{name:>14} {clip[:10]:>10} {output_format:>4} {seconds:>4}  error: {result['error']}")
+                else:
+                    print(f"{name:>14} {clip[:10]:>10} {output_format:>4} {seconds:>4} {result['wall_ms']:>10.1f} "
+                          f"{result['cpu_ms']:>10.1f} {result['peak_rss_mb']:>8.1f}  {json.dumps(result['stages'])}")
+
+    with open(arguments.output, "w") as f:
+        json.dump({"metadata": metadata(), "results": results}, f, indent=1)
+    print(f"Results written to {arguments.output}")
+
+
+def compare(baseline, current, threshold=THRESHOLD):
+    '''
+    Input: two result files as loaded from JSON
+    Output: (regressions, improvements, cases missing from current, new cases),
+            a change is (case key, metric, baseline value, current value)
+    '''
+    before = {key(result): result for result in baseline["results"] if "error" not in result}
+    after = {key(result): result for result in current["results"]}
+    regressions, improvements = [], []
+    for case, result in after.items():
+        if case not in before:
+            continue
+        if "error" in result:
+            regressions.append((case, "error", None, result["error"]))
+            continue
+        for metric, floor in FLOORS.items():
+            old, new = before[case][metric], result[metric]
+            if abs(new - old) <= floor or abs(new - old) <= threshold * abs(old):
+                continue
+            (regressions if new > old else improvements).append((case, metric, old, new))
+    missing = sorted(set(before) - set(after))
+    added = sorted(set(after) - set(before))
+    return regressions, improvements, missing, added
+
+
+def print_changes(title, changes, baseline_stages=None, current_stages=None):
+    if not changes:
+        return
+    print(title)
+    for case, metric, old, new in changes:
+        label = " ".join(str(part) for part in case)
+        if metric == "error":
+            print(f"  {label}: failed, {new}")
+            continue
+        print(f"  {label}: {metric} {old:.1f} -> {new:.1f} ({(new - old) / old:+.0%})" if old else
+              f"  {label}: {metric} {old:.1f} -> {new:.1f}")
+        if baseline_stages is not None and case in baseline_stages and case in current_stages:
+            # Which stages moved, to point at the cause
+            old_stages, new_stages = baseline_stages[case], current_stages[case]
+            moved = {name: round(new_stages.get(name, 0) - old_stages.get(name, 0), 1)
+                     for name in set(old_stages) | set(new_stages)}
+            print(f"      stage change ms: {json.dumps(dict(sorted(moved.items(), key=lambda item: -abs(item[1]))))}")
+
+
+def run_compare(arguments):
+    with open(arguments.baseline) as f:
+        baseline = json.load(f)
+    with open(arguments.results) as f:
+        current = json.load(f)
+    regressions, improvements, missing, added = compare(baseline, current, arguments.threshold)
+
+    stages = lambda results: {key(result): result.get("stages", {}) for result in results["results"]}
+    print(f"baseline {baseline['metadata'].get('commit')} ({baseline['metadata'].get('created')}), "
+          f"current {current['metadata'].get('commit')} ({current['metadata'].get('created')}), "
+          f"threshold {arguments.threshold:.0%}")
+    print_changes("Regressions:", regressions, stages(baseline), stages(current))
+    print_changes("Improvements:", improvements)
+    if missing:
+        print("Not run this time:", ", ".join(" ".join(str(part) for part in case) for case in missing))
+    if added:
+        print("Not in the baseline:", ", ".join(" ".join(str(part) for part in case) for case in added))
+    print(f"{len(regressions)} regressions, {len(improvements)} improvements")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every audio function")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="measure and write results")
+    run_parser.add_argument("--functions", nargs="+", default=list(FUNCTIONS), choices=list(FUNCTIONS))
+    run_parser.add_argument("--durations", nargs="+", type=int, default=DURATIONS, help="seconds")
+    run_parser.add_argument("--clips", nargs="+", default=CLIPS, choices=CLIPS)
+    run_parser.add_argument("--formats", nargs="+", default=FORMATS, choices=FORMATS)
+    run_parser.add_argument("--real", nargs="+", help="audio files to use as the real clips")
+    run_parser.add_argument("--repeats", type=int, default=REPEATS)
+    run_parser.add_argument("--model-dir", help="directory holding the .pb graphs (default the working directory)")
+    run_parser.add_argument("--output", default=os.path.join("benchmarks", "results.json"))
+
+    compare_parser = commands.add_parser("compare", help="flag regressions against a baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("--baseline", default=os.path.join("benchmarks", "baseline.json"))
+    compare_parser.add_argument("--threshold", type=float, default=THRESHOLD, help="relative change, 0.1 is 10%%")
+
+    case_parser = commands.add_parser("case", help=argparse.SUPPRESS)
+    case_parser.add_argument("name")
+    case_parser.add_argument("path")
+    case_parser.add_argument("repeats", type=int)
+
+    arguments = parser.parse_args()
+    if arguments.command == "case":
+        print(json.dumps(run_case(arguments.name, arguments.path, arguments.repeats)))
+    elif arguments.command == "run":
+        run(arguments)
+    else:
+        sys.exit(run_compare(arguments))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import unittest
+import sys
+sys.path.append('..') # shared audio_common package lives in the repository root
+from suite import compare, FLOORS, THRESHOLD
+
+
+def result(function="pitch_shift", seconds=30, **metrics):
+    '''One suite result, the metrics default to 1000 ms and 100 MB'''
+    measured = {"wall_ms": 1000.0, "cpu_ms": 1000.0, "peak_rss_mb": 100.0}
+    measured.update(metrics)
+    return dict(function=function, clip="synthetic", format="mp3", seconds=seconds, **measured)
+
+
+def results(*cases):
+    return {"metadata": {}, "results": list(cases)}
+
+
+class TestCompare(unittest.TestCase):
+
+    def test_unchanged(self):
+        '''Test identical results give no changes'''
+        self.assertEqual(compare(results(result()), results(result())), ([], [], [], []))
+
+    def test_regression(self):
+        '''Test a metric over the threshold and its noise floor is a regression'''
+        regressions, improvements, _, _ = compare(results(result()), results(result(wall_ms=1200.0)))
+
+        self.assertEqual(regressions, [(("pitch_shift", "synthetic", "mp3", 30), "wall_ms", 1000.0, 1200.0)])
+        self.assertEqual(improvements, [])
+
+    def test_improvement(self):
+        '''Test a metric that falls by more than the threshold is an improvement'''
+        regressions, improvements, _, _ = compare(results(result()), results(result(peak_rss_mb=50.0)))
+
+        self.assertEqual(regressions, [])
+        self.assertEqual(improvements, [(("pitch_shift", "synthetic", "mp3", 30), "peak_rss_mb", 100.0, 50.0)])
+
+    def test_threshold(self):
+        '''Test a change within the threshold is not flagged, and the threshold can be set'''
+        within = 1000.0 * (1 + THRESHOLD) - 1
+        self.assertEqual(compare(results(result()), results(result(cpu_ms=within)))[0], [])
+        self.assertEqual(len(compare(results(result()), results(result(cpu_ms=within)), threshold=0.05)[0]), 1)
+
+    def test_noise_floor(self):
+        '''Test a large relative change within the metric's noise floor is not flagged'''
+        baseline = results(result(wall_ms=2.0, peak_rss_mb=1.0))
+        current = results(result(wall_ms=2.0 + FLOORS["wall_ms"], peak_rss_mb=1.0 + FLOORS["peak_rss_mb"]))
+        self.assertEqual(compare(baseline, current)[0], [])
+
+        current = results(result(wall_ms=2.0 + FLOORS["wall_ms"] + 1, peak_rss_mb=1.0))
+        self.assertEqual([change[1] for change in compare(baseline, current)[0]], ["wall_ms"])
+
+    def test_error(self):
+        '''Test a case that fails now is a regression and one that failed in the baseline is new'''
+        failed = dict(function="genre", clip="synthetic", format="mp3", seconds=30, error="ImportError: essentia")
+        fixed = result(function="genre")
+        baseline = results(result(), failed)
+        current = results(dict(result(), error="RuntimeError: ffmpeg"), fixed)
+
+        regressions, improvements, missing, added = compare(baseline, current)
+
+        self.assertEqual(regressions, [(("pitch_shift", "synthetic", "mp3", 30), "error", None, "RuntimeError: ffmpeg")])
+        self.assertEqual(improvements, [])
+        self.assertEqual(missing, [])
+        self.assertEqual(added, [("genre", "synthetic", "mp3", 30)])
+
+    def test_missing_and_added(self):
+        '''Test cases run only once are reported rather than compared'''
+        _, _, missing, added = compare(results(result(seconds=5), result()), results(result(), result(seconds=600)))
+
+        self.assertEqual(missing, [("pitch_shift", "synthetic", "mp3", 5)])
+        self.assertEqual(added, [("pitch_shift", "synthetic", "mp3", 600)])
@@ -0,0 +1,328 @@
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import argparse
+import importlib
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from audio_common import decode
+from audio_common.cache import AudioCache
+from audio_common.models import registry
+
+'''
+Every lambda function served from one process.
+
+Each function runs in its own container on lambda, with its own cold start and
+its own copy of numpy, essentia and the models. For on-prem deployment and load
+testing the server here imports every handler once and serves them behind the
+routes of the API Gateway stage (the URLs the frontend_example pages call):
+
+    POST /dev/average-audio-energy?...    audio_energy
+    POST /audio-genre?...                 audio_genre (the stage prefix is optional)
+    GET  /_server                         what is mounted, cache and batcher counters
+
+A request becomes the HTTP API (version 2.0) event the handlers get on lambda,
+with the upload as a raw binary body so there is no base64 step (see
+audio_common.body), and the handler's answer becomes the response. A body the
+handler base64 encoded is sent as binary like API Gateway does, or as the base64
+text the REST stage sends with base64_responses.
+
+Because the handlers share the process they share its warm state:
+    models          audio_common.models.registry, built once for every function
+    embeddings      audio_common.embeddings.embedding_cache, so genre, instrument
+                    and tagging requests for one upload run effnet once
+    decoded audio   audio_common.decode.decode_cache is turned on (DECODE_CACHE_MB,
+                    default SERVER_DECODE_CACHE_MB here), so the pitch shift and time
+                    stretch of one upload decode it once. The time stretch's
+                    mode=stream decodes block by block and does not use the cache
+    micro-batching  EFFNET_MICRO_BATCH defaults to 1 so concurrent ML requests share
+                    effnet batches (see audio_common.batching)
+
+Requests are handled by a pool of SERVER_WORKERS threads (default the CPU count),
+connections wait for a free worker rather than starting a thread each. ffmpeg,
+numpy and TensorFlow release the GIL for the heavy work. A handler that cannot be
+imported (essentia missing, say) answers 503 with the import error and the rest
+are still served.
+
+Run from the repository root, in the directory holding the model graphs:
+    python local_server/server.py --port 8080
+'''
+
+STAGE = "dev"
+WORKERS = int(os.environ.get("SERVER_WORKERS", os.cpu_count() or 1))
+DECODE_CACHE_MB = float(os.environ.get("SERVER_DECODE_CACHE_MB", 256))
+
+# route -> (function directory, handler function)
+ROUTES = {
+    "average-audio-energy": ("audio_energy", "lambda_handler"),
+    "audio-length": ("audio_length", "lambda_handler"),
+    "audio-metadata": ("audio_metadata", "lambda_handler"),
+    "audio-pitch-shift": ("audio_pitch_shift", "lambda_handler"),
+    "time-stretch": ("audio_time_stretch", "lambda_handler"),
+    "pitch-time-chain": ("audio_pitch_time", "lambda_handler"),
+    "audio-pipeline": ("audio_pipeline", "handler"),
+    "audio-genre": ("audio_genre", "handler"),
+    "instrument-detector": ("audio_instrument_detection", "handler"),
+    "audio-tagging": ("audio_tagging", "handler"),
+    "jobs": ("audio_jobs", "lambda_handler"),
+    "status": ("status_check", "lambda_handler"),
+}
+STATUS_ROUTE = "_server"
+
+# Request bodies of these types are passed as text like API Gateway does, anything else is binary
+TEXT_TYPES = ("text/", "application/json", "application/x-www-form-urlencoded")
+
+
+def configure(decode_cache_mb=DECODE_CACHE_MB, micro_batch=True):
+    '''
+    Shared state for a process serving every function, call before load_handlers.
+    The environment still wins: DECODE_CACHE_MB and EFFNET_MICRO_BATCH are only defaults here.
+    '''
+    # Read when audio_common.embeddings is imported by the first ML handler
+    os.environ.setdefault("EFFNET_MICRO_BATCH", "1" if micro_batch else "0")
+    megabytes = float(os.environ.get("DECODE_CACHE_MB", decode_cache_mb))
+    decode.decode_cache = AudioCache(memory_bytes=int(megabytes * 2**20))
+
+
+def load_handlers(routes=ROUTES):
+    '''Import every handler, returns ({route: handler}, {route: import error})'''
+    handlers, errors = {}, {}
+    for route, (directory, function) in routes.items():
+        try:
+            module = importlib.import_module(f"{directory}.lambda_function")
+            handlers[route] = getattr(module, function)
+        except Exception as e:
+            print(f"Error: {route} is not available, {directory} could not be imported:", str(e))
+            errors[route] = f"{type(e).__name__}: {e}"
+    return handlers, errors
+
+
+def split_route(path, stage=STAGE):
+    '''Route name of a request path, with or without the stage prefix'''
+    parts = [part for part in path.split("/") if part]
+    if parts and parts[0] == stage:
+        parts = parts[1:]
+    return "/".join(parts)
+
+
+def make_event(method, target, headers, body, route, stage=STAGE, source_ip="127.0.0.1"):
+    '''
+    Input: request method, target (path and query), headers (name -> value), body bytes
+    Output: API Gateway HTTP API (2.0) event
+
+    Repeated query parameters are joined with commas as API Gateway does.
+    Text bodies are str, anything else is passed as raw bytes.
+    '''
+    url = urlsplit(target)
+    parameters = {}
+    for name, value in parse_qsl(url.query, keep_blank_values=True):
+        parameters[name] = f"{parameters[name]},{value}" if name in parameters else value
+    headers = {name.lower(): value for name, value in headers.items()}
+
+    event = {
+        "version": "2.0",
+        "routeKey": f"{method} /{route}",
+        "rawPath": url.path,
+        "rawQueryString": url.query,
+        "headers": headers,
+        "queryStringParameters": parameters or None,
+        "requestContext": {
+            "http": {
+                "method": method,
+                "path": url.path,
+                "protocol": "HTTP/1.1",
+                "sourceIp": source_ip,
+                "userAgent": headers.get("user-agent", ""),
+            },
+            "requestId": uuid.uuid4().hex,
+            "routeKey": f"{method} /{route}",
+            "stage": stage,
+            "timeEpoch": int(time.time() * 1000),
+        },
+        "isBase64Encoded": False,
+    }
+    if body:
+        content_type = headers.get("content-type", "")
+        event["body"] = body.decode("utf-8", errors="replace") if content_type.startswith(TEXT_TYPES) else body
+    return event
+
+
+def make_response(result, base64_responses=False):
+    '''
+    Input: what a handler returned
+    Output: (status code, headers, body bytes)
+
+    A dict or list body is sent as JSON. A body flagged isBase64Encoded is
+    decoded to binary unless base64_responses is set.
+    '''
+    if not isinstance(result, dict) or "statusCode" not in result:
+        # API Gateway treats anything else as a 200 with a JSON body
+        result = {"statusCode": 200, "body": json.dumps(result), "headers": {"Content-Type": "application/json"}}
+
+    headers = dict(result.get("headers") or {})
+    body = result.get("body", b"")
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body)
+        headers.setdefault("Content-Type", "application/json")
+    if result.get("isBase64Encoded") and not base64_responses:
+        body = base64.b64decode(body)
+    elif isinstance(body, str):
+        body = body.encode("utf-8")
+    elif body is None:
+        body = b""
+    headers.setdefault("Content-Type", "text/plain; charset=utf-8")
+    return result["statusCode"], headers, bytes(body)
+
+
+def server_status(handlers, errors):
+    '''Mounted routes and the counters of the shared caches, models and batcher'''
+    report = {
+        "routes": sorted(handlers),
+        "unavailable": errors,
+        "decode_cache": dict(decode.decode_cache.stats, used_mb=round(decode.decode_cache.memory_used / 2**20, 3)),
+        "models": registry.report(),
+    }
+    # Only there once an ML handler has imported it
+    embeddings = sys.modules.get("audio_common.embeddings")
+    if embeddings is not None:
+        report["embedding_cache"] = dict(embeddings.embedding_cache.stats)
+        report["micro_batch"] = embeddings.MICRO_BATCH
+        report["batcher"] = dict(embeddings.embedding_batcher.stats)
+    return report
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    '''Turns each request into an event for the handler of its route'''
+
+    server_version = "AudioServer/0.1"
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def do_PUT(self):
+        self.dispatch()
+
+    def do_DELETE(self):
+        self.dispatch()
+
+    def dispatch(self):
+        server = self.server
+        route = split_route(urlsplit(self.path).path, server.stage)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        if route == STATUS_ROUTE:
+            return self.send(200, {"Content-Type": "application/json"},
+                             json.dumps(server_status(server.handlers, server.errors)).encode())
+        if route in server.errors:
+            return self.send(503, {"Content-Type": "application/json"},
+                             json.dumps({"error": f"{route} is not available: {server.errors[route]}"}).encode())
+        if route not in server.handlers:
+            return self.send(404, {"Content-Type": "application/json"},
+                             json.dumps({"message": "Not Found"}).encode())
+
+        event = make_event(self.command, self.path, dict(self.headers), body, route, server.stage,
+                           self.client_address[0])
+        start = time.perf_counter()
+        try:
+            result = server.handlers[route](event, None)
+            status, headers, payload = make_response(result, server.base64_responses)
+        except Exception as e:
+            # API Gateway answers 502 when the function itself fails
+            traceback.print_exc()
+            status, headers, payload = 502, {"Content-Type": "application/json"}, \
+                json.dumps({"message": "Internal Server Error", "error": str(e)}).encode()
+        headers["X-Handler-Ms"] = f"{(time.perf_counter() - start) * 1000:.3f}"
+        self.send(status, headers, payload)
+
+    def send(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, str(value))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PooledHTTPServer(HTTPServer):
+    '''
+    HTTPServer handing each connection to a fixed pool of threads, so a burst of
+    load queues for a worker rather than starting a thread per request.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, address, handlers, errors=None, workers=WORKERS, stage=STAGE, base64_responses=False):
+        self.handlers = handlers
+        self.errors = errors or {}
+        self.stage = stage
+        self.base64_responses = base64_responses
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="handler")
+        super().__init__(address, RequestHandler)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+def make_server(host="127.0.0.1", port=8080, workers=WORKERS, decode_cache_mb=DECODE_CACHE_MB,
+                micro_batch=True, routes=ROUTES, stage=STAGE, base64_responses=False, preload=False):
+    '''Configure the shared state, import the handlers and bind the server (port 0 picks a free port)'''
+    configure(decode_cache_mb, micro_batch)
+    handlers, errors = load_handlers(routes)
+    if preload:
+        # As the handlers preload on lambda
+        registry.preload()
+    return PooledHTTPServer((host, port), handlers, errors, workers, stage, base64_responses)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve every audio lambda function from one process")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="requests handled at once")
+    parser.add_argument("--decode-cache-mb", type=float, default=DECODE_CACHE_MB, help="0 turns it off")
+    parser.add_argument("--no-micro-batch", action="store_true", help="run effnet per request")
+    parser.add_argument("--model-dir", help="directory holding the .pb graphs (default the working directory)")
+    parser.add_argument("--preload", action="store_true", help="build every model before serving")
+    parser.add_argument("--base64-responses", action="store_true",
+                        help="send audio as base64 text like the REST stage the demo pages call")
+    arguments = parser.parse_args()
+
+    if arguments.model_dir:
+        os.chdir(arguments.model_dir)
+    server = make_server(arguments.host, arguments.port, arguments.workers, arguments.decode_cache_mb,
+                         not arguments.no_micro_batch, base64_responses=arguments.base64_responses,
+                         preload=arguments.preload)
+    print(f"Serving {len(server.handlers)} functions on http://{arguments.host}:{server.server_port}/{STAGE}/"
+          f" with {arguments.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
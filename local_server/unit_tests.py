@@ -0,0 +1,130 @@
+import unittest
+from unittest.mock import patch
+import os
+import json
+import sys
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append('..') # shared audio_common package lives in the repository root
+from server import make_server, make_event, make_response, split_route, ROUTES
+from audio_common import decode
+from audio_common.encode import encode
+from audio_common.testing import sine, RATE
+import numpy as np
+from base64 import b64encode
+
+ROUTES_TESTED = {route: ROUTES[route] for route in ("average-audio-energy", "audio-pitch-shift", "time-stretch",
+                                                    "pitch-time-chain", "status")}
+
+
+class TestEvents(unittest.TestCase):
+
+    def test_split_route(self):
+        self.assertEqual(split_route("/dev/time-stretch"), "time-stretch")
+        self.assertEqual(split_route("/time-stretch/"), "time-stretch")
+        self.assertEqual(split_route("/"), "")
+
+    def test_make_event(self):
+        '''Requests become HTTP API events, binary bodies stay bytes'''
+        event = make_event("POST", "/dev/time-stretch?stretch_amount=1.5&tag=a&tag=b",
+                           {"Content-Type": "audio/mpeg"}, b"\xff\xfb", "time-stretch")
+        self.assertEqual(event["requestContext"]["http"]["method"], "POST")
+        self.assertEqual(event["queryStringParameters"], {"stretch_amount": "1.5", "tag": "a,b"})
+        self.assertEqual(event["headers"], {"content-type": "audio/mpeg"})
+        self.assertEqual(event["body"], b"\xff\xfb")
+        self.assertFalse(event["isBase64Encoded"])
+
+        event = make_event("POST", "/audio-pipeline", {"Content-Type": "application/json"}, b'{"a": 1}',
+                           "audio-pipeline")
+        self.assertEqual(event["body"], '{"a": 1}')
+        self.assertIsNone(event["queryStringParameters"])
+        self.assertNotIn("body", make_event("GET", "/status", {}, b"", "status"))
+
+    def test_make_response(self):
+        '''Base64 bodies go out as binary unless asked for as text'''
+        result = {"statusCode": 200, "headers": {"Content-Type": "audio/wav"},
+                  "body": b64encode(b"RIFF").decode(), "isBase64Encoded": True}
+        self.assertEqual(make_response(result), (200, {"Content-Type": "audio/wav"}, b"RIFF"))
+        self.assertEqual(make_response(result, base64_responses=True)[2], b"UklGRg==")
+
+        status, headers, body = make_response({"statusCode": 422, "body": {"client error": "x"}})
+        self.assertEqual((status, headers["Content-Type"], json.loads(body)), (422, "application/json",
+                                                                              {"client error": "x"}))
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        # configure() replaces the decode cache and sets the micro-batching default, undo both
+        for patcher in (patch.object(decode, "decode_cache", decode.decode_cache), patch.dict(os.environ)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        routes = dict(ROUTES_TESTED, missing=("audio_missing", "handler"))
+        self.server = make_server(port=0, workers=2, decode_cache_mb=64, routes=routes)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.wav, _ = encode(sine(440, 3), RATE, "wav")
+
+    def request(self, method, path, body=None, headers=None):
+        connection = http.client.HTTPConnection("127.0.0.1", self.server.server_port, timeout=60)
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            connection.close()
+
+    def test_routes(self):
+        status, _, body = self.request("GET", "/dev/status")
+        self.assertEqual(status, 200)
+        self.assertTrue(body.startswith(b"Music API"))
+        self.assertEqual(self.request("GET", "/dev/nothing-here")[0], 404)
+
+        status, _, body = self.request("POST", "/dev/missing", b"audio")
+        self.assertEqual(status, 503)
+        self.assertIn("audio_missing", json.loads(body)["error"])
+
+    def test_audio_and_shared_decode(self):
+        '''A binary upload is answered with binary audio, the second decode of it is cached'''
+        for _ in range(2):
+            status, headers, body = self.request("POST", "/dev/pitch-time-chain?shift_amount=2&output_format=wav",
+                                                 self.wav, {"Content-Type": "audio/wav"})
+            self.assertEqual(status, 200)
+            self.assertEqual(headers["Content-Type"], "audio/wav")
+            self.assertTrue(body.startswith(b"RIFF"))
+            self.assertIn("X-Handler-Ms", headers)
+
+        report = json.loads(self.request("GET", "/_server")[2])
+        self.assertEqual(report["decode_cache"]["memory"], 1)
+        self.assertEqual(report["unavailable"], {"missing": "ModuleNotFoundError: No module named 'audio_missing'"})
+        self.assertEqual(os.environ["EFFNET_MICRO_BATCH"], "1")
+
+    def test_decode_shared_across_functions(self):
+        '''The time stretch reuses the pitch shift's decode of an upload, except when it streams'''
+        for path in ("/dev/audio-pitch-shift?shift_amount=2", "/dev/time-stretch?stretch_amount=1.5",
+                     "/dev/time-stretch?stretch_amount=1.5&mode=stream"):
+            status, _, _ = self.request("POST", path + "&output_format=wav", self.wav, {"Content-Type": "audio/wav"})
+            self.assertEqual(status, 200)
+
+        report = json.loads(self.request("GET", "/_server")[2])
+        self.assertEqual(report["decode_cache"]["memory"], 1)
+
+    def test_concurrent_requests(self):
+        '''More requests than workers are queued and all answered'''
+        def energy(_):
+            return self.request("POST", "/dev/average-audio-energy", self.wav)
+
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            responses = list(pool.map(energy, range(6)))
+
+        self.assertEqual([status for status, _, _ in responses], [200] * 6)
+        self.assertEqual(len({body for _, _, body in responses}), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()